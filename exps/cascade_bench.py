@@ -0,0 +1,249 @@
+"""attack cascade: cheap attacks first, expensive attacks only on samples that are still robust"""
+import torch
+import time
+import os
+import json
+
+from typing import Callable, List, Tuple
+
+from torch.utils.data import DataLoader
+from src import settings
+from src.config import set_seed
+from src.attack import LinfPGDAttack, attack_context
+from src.utils import (logger, load_model_state_dict, get_mean_and_std,
+                        get_cifar_test_dataloader,
+                        get_mnist_test_dataloader,
+                        get_svhn_test_dataloader,
+                        get_gtsrb_test_dataloder)
+
+
+EPSILON = 8/255
+STEP_SIZE = 2/255
+
+SupportDatasetList = ['cifar10', 'cifar100', 'mnist', 'svhn', 'svhntl', 'gtsrb']
+
+# an attack stage takes inputs in [0, 1] with their labels and returns mask of samples that are still robust
+Stage = Callable[[torch.Tensor, torch.Tensor], torch.Tensor]
+
+
+def make_eps(dataset: str) -> None:
+    global EPSILON, STEP_SIZE
+
+    if dataset == "mnist":
+        EPSILON = 0.15
+        STEP_SIZE = 0.01
+    else:
+        EPSILON = 8/255
+        STEP_SIZE = 2/255
+
+    logger.info(f"using epsion: {EPSILON}, step size: {STEP_SIZE}")
+
+
+def get_test_dataset(dataset: str, batch_size=256) -> DataLoader:
+    if dataset not in SupportDatasetList:
+        raise ValueError("dataset not supported")
+    if dataset.startswith("cifar"):
+        return get_cifar_test_dataloader(dataset=dataset, normalize=False, shuffle=False, batch_size=batch_size)
+    elif dataset == 'mnist':
+        return get_mnist_test_dataloader(normalize=False, shuffle=False, batch_size=batch_size)
+    elif dataset.startswith('svhn'):
+        return get_svhn_test_dataloader(dataset_norm_type=dataset, normalize=False, shuffle=False, batch_size=batch_size)
+    elif dataset == "gtsrb":
+        return get_gtsrb_test_dataloder(normalize=False, batch_size=batch_size)
+
+
+class NormalizationWrapper(torch.nn.Module):
+    def __init__(self, model, mean, std) -> None:
+        super().__init__()
+        self._model = model
+        self.register_buffer("_mean", torch.tensor(mean).view(3, 1, 1))
+        self.register_buffer("_std", torch.tensor(std).view(3, 1, 1))
+
+    def forward(self, x):
+        x = (x - self._mean) / self._std
+        return self._model(x)
+
+
+def _still_correct(model, inputs, labels) -> torch.Tensor:
+    with torch.no_grad():
+        return model(inputs).argmax(dim=1) == labels
+
+
+def make_pgd_stage(model: NormalizationWrapper, dataset: str, num_steps: int, device) -> Stage:
+    """`LinfPGDAttack` works in normalized space, so it attacks the wrapped model directly"""
+    attacker = LinfPGDAttack(model=model._model, epsilon=EPSILON, step_size=STEP_SIZE, num_steps=num_steps,
+                             dataset_name=dataset, device=device, early_stop=True)
+    attacker.print_parameters()
+
+    def _stage(inputs, labels):
+        normalized_inputs = (inputs - model._mean) / model._std
+        with attack_context(model):
+            adv_inputs = attacker.calc_perturbation(normalized_inputs, labels)
+        return _still_correct(model._model, adv_inputs, labels)
+
+    return _stage
+
+
+def make_foolbox_stage(model: NormalizationWrapper, attacker: str, device) -> Stage:
+    from foolbox.attacks import LinfDeepFoolAttack, L2CarliniWagnerAttack
+    from foolbox import PyTorchModel
+
+    fmodel = PyTorchModel(model, bounds=(0, 1), device=device)
+    if attacker == "LinfDeepFool":
+        fb_attacker = LinfDeepFoolAttack()
+    elif attacker == "L2CW":
+        fb_attacker = L2CarliniWagnerAttack(steps=100)
+    else:
+        raise ValueError(f"not support attacker type '{attacker}'")
+
+    def _stage(inputs, labels):
+        _, _, success = fb_attacker(fmodel, inputs, labels, epsilons=EPSILON)
+        return ~success
+
+    return _stage
+
+
+def make_auto_attack_stage(model: NormalizationWrapper, device, log_path=None) -> Stage:
+    from autoattack import AutoAttack
+
+    adversary = AutoAttack(model, norm="Linf", eps=EPSILON, log_path=log_path, version="standard", device=device)
+
+    def _stage(inputs, labels):
+        with torch.no_grad():
+            adv_inputs = adversary.run_standard_evaluation(inputs, labels, bs=inputs.shape[0])
+        return _still_correct(model, adv_inputs, labels)
+
+    return _stage
+
+
+def get_stage(name: str, model: NormalizationWrapper, dataset: str, device, log_path=None) -> Stage:
+    import re
+    if name.startswith("LinfPGD"):
+        matched = re.fullmatch(r"LinfPGD-(\d+)", name)
+        if matched is None:
+            raise ValueError("using 'LinfPGD-X' for pgd stage")
+        return make_pgd_stage(model, dataset, int(matched.group(1)), device)
+    elif name in {"LinfDeepFool", "L2CW"}:
+        return make_foolbox_stage(model, name, device)
+    elif name == "AutoAttack":
+        return make_auto_attack_stage(model, device, log_path)
+    else:
+        raise ValueError(f"not support stage '{name}'")
+
+
+def cascade_robust(model, stages: List[Tuple[str, Stage]], testset, device):
+    """run `stages` in order, every stage only attacks samples that survived all previous stages
+
+    Returns:
+        natural accuracy, and for each stage: samples it attacked, robust accuracy among them(per-stage)
+        and robust accuracy on whole test set after it(cumulative)
+    """
+    total = 0
+    natural = 0
+    attacked = [0] * len(stages)
+    survived = [0] * len(stages)
+
+    for data, labels in testset:
+        data = data.to(device)
+        labels = labels.to(device)
+        total += labels.shape[0]
+
+        robust = _still_correct(model, data, labels)
+        natural += robust.sum().item()
+        for i, (_, stage) in enumerate(stages):
+            data, labels = data[robust], labels[robust]
+            if labels.shape[0] == 0:
+                break
+            attacked[i] += labels.shape[0]
+            robust = stage(data, labels)
+            survived[i] += robust.sum().item()
+
+    result = {"Acc": natural / total}
+    for (name, _), stage_attacked, stage_survived in zip(stages, attacked, survived):
+        result[name] = {
+            "attacked": stage_attacked,
+            "stage Rob": stage_survived / stage_attacked if stage_attacked else 1.,
+            "cumulative Rob": stage_survived / total,
+        }
+        logger.info(f"{name}: attacked {stage_attacked} samples, "
+                    f"per-stage robust: {result[name]['stage Rob']}, cumulative robust: {stage_survived / total}")
+
+    return result
+
+
+def freeze_model_trainable_params(model:torch.nn.Module):
+    for param in model.parameters():
+        param.requires_grad = False
+
+    logger.debug("all parameters are freezed")
+
+
+def exp(model_path, args):
+    set_seed(settings.seed)
+
+    testset = get_test_dataset(args.dataset, batch_size=args.batch_size)
+
+    model = get_model(args.model_type, args.num_classes, args.k).to(settings.device)
+    model.load_state_dict(load_model_state_dict(model_path, map_location=settings.device))
+    logger.debug(f"load from `{model_path}`")
+    model.eval()
+    freeze_model_trainable_params(model)
+
+    mean, std = get_mean_and_std(args.dataset)
+    model = NormalizationWrapper(model, mean, std).to(settings.device)
+    model.eval()
+
+    atk_log_path = os.path.join(settings.log_dir, f"cascade_atk_{os.path.basename(model_path)}.log")
+    stages = [(name, get_stage(name, model, args.dataset, settings.device, atk_log_path)) for name in args.stages]
+
+    start_time = time.perf_counter()
+    result = {model_path: cascade_robust(model, stages, testset, settings.device)}
+    end_time = time.perf_counter()
+    logger.info(f"costing time: {end_time-start_time:.2f} secs")
+
+    logger.info(result)
+    if args.result_file is not None:
+        if not os.path.exists(os.path.dirname(args.result_file)):
+            os.makedirs(os.path.dirname(args.result_file))
+
+        if os.path.exists(args.result_file):
+            with open(args.result_file, "r") as f:
+                exist_data = json.load(f)
+            for key in result.keys():
+                exist_data[key] = result[key]
+            result = exist_data
+
+        with open(args.result_file, "w+") as f:
+            json.dump(result, f)
+
+
+if __name__ == "__main__":
+    from src.cli.utils import get_model
+
+    import argparse
+
+    parser  = argparse.ArgumentParser()
+    parser.add_argument("-m", "--model", type=str, default=None)
+    parser.add_argument("-d", "--dataset", type=str, required=True)
+    parser.add_argument("-n", "--num_classes", type=int, required=True)
+    parser.add_argument("-k", "--k", type=int, default=1)
+    parser.add_argument("--model-type", type=str, required=True)
+    # ordered from cheap to expensive, e.g. `LinfPGD-20 LinfDeepFool AutoAttack`
+    parser.add_argument("-s", "--stages", type=str, nargs="+", default=["LinfPGD-20", "LinfDeepFool", "AutoAttack"])
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--log", type=str, default="cascade_atk.log")
+    parser.add_argument("--result-file", type=str, default=None)
+    args = parser.parse_args()
+    logger.change_log_file(settings.log_dir / args.log)
+
+    make_eps(args.dataset)
+
+    if args.model is None:
+        model_list = [
+
+        ]
+    else:
+        model_list = [args.model]
+
+    for model_path in model_list:
+        exp(model_path, args)
@@ -1,82 +1,12 @@
-from typing import Any, Callable, Dict
-
 import torch
-from torch import Tensor
-import torch.nn as nn
 
 from src import settings
 from src.config import set_seed
-from src.utils import logger, get_mean_and_std, clamp, evaluate_accuracy
-
-class LinfPGDAttack:
-
-    def __init__(self, model: torch.nn.Module, clip_min=0, clip_max=1,
-                 random_init: int = 1, epsilon=8/255, step_size=2/255, num_steps=20,
-                 loss_function: Callable[[Any], Tensor] = nn.CrossEntropyLoss(),
-                 dataset_name: str = settings.dataset_name, device: str = settings.device
-                 ):
-        dataset_mean, dataset_std = get_mean_and_std(dataset_name)
-        mean = torch.tensor(dataset_mean).view(3, 1, 1).to(device)
-        std = torch.tensor(dataset_std).view(3, 1, 1).to(device)
-
-        clip_max = ((clip_max - mean) / std)
-        clip_min = ((clip_min - mean) / std)
-        epsilon = epsilon / std
-        step_size = step_size / std
-
-        self.min = clip_min
-        self.max = clip_max
-        self.model = model
-        self.epsilon = epsilon
-        self.step_size = step_size
-        self.random_init = random_init
-        self.num_steps = num_steps
-        self.loss_function = loss_function
-
-    def random_delta(self, delta: Tensor) -> Tensor:
-        delta.uniform_(-1, 1)
-        delta = delta * self.epsilon
-
-        return delta
-
-    def calc_perturbation(self, x: Tensor, target: Tensor) -> Tensor:
-        delta = torch.zeros_like(x)
-        if self.random_init:
-            delta = self.random_delta(delta)
-        xt = x + delta
-        xt.requires_grad = True
-
-        for it in range(self.num_steps):
-            y_hat = self.model(xt)
-            loss = self.loss_function(y_hat, target)
-
-            self.model.zero_grad()
-            loss.backward()
-
-            grad_sign = xt.grad.detach().sign()
-            xt.data = xt.detach() + self.step_size * grad_sign
-            xt.data = clamp(xt - x, -self.epsilon, self.epsilon) + x
-            xt.data = clamp(xt.detach(), self.min, self.max)
-
-            xt.grad.data.zero_()
-
-        return xt
-
-    def print_parameters(self):
-        params = {
-            "min": self.min,
-            "max": self.max,
-            "epsilon": self.epsilon,
-            "step_size": self.step_size,
-            "num_steps": self.num_steps,
-            "random_init": self.random_init,
-        }
-        params_str = "\n".join([": ".join(map(str, item)) for item in params.items()])
-        logger.info(f"using attack: {type(self).__name__}")
-        logger.info(f"attack parameters: \n{params_str}")
+from src.attack import LinfPGDAttack, test_attack_epsilons
+from src.utils import logger, load_model_state_dict
 
 def pgd_robust(model, testset, params, device):
-    attacker = LinfPGDAttack(model=model, device=device, **params)
+    attacker = LinfPGDAttack(model=model, device=device, early_stop=True, **params)
     attacker.print_parameters()
 
     items = 0
@@ -135,6 +65,10 @@ if __name__ == '__main__':
     parser.add_argument("-k", "--k", type=int, default=1)
     parser.add_argument("--log", type=str, default=None)
     parser.add_argument("--result-file", type=str, default=None)
+    parser.add_argument("--restarts", type=int, default=1)
+    parser.add_argument("--restart-batch-size", type=int, default=None)
+    # e.g. `--epsilons 0.00784 0.01569 0.03137 0.06275` evaluates all of them in one pass
+    parser.add_argument("--epsilons", type=float, nargs="+", default=None)
     args = parser.parse_args()
 
     params = {
@@ -143,6 +77,8 @@ if __name__ == '__main__':
         "step_size": 2/255,
         "num_steps": 20,
         "dataset_name": args.dataset,
+        "restarts": args.restarts,
+        "restart_batch_size": args.restart_batch_size,
     }
     
     if args.model is None:
@@ -164,7 +100,7 @@ if __name__ == '__main__':
     result = dict()
     for model_path in model_list:
         set_seed(settings.seed)
-        model.load_state_dict(torch.load(model_path, map_location=settings.device))
+        model.load_state_dict(load_model_state_dict(model_path, map_location=settings.device))
         logger.debug(f"load from `{model_path}`")
 
         model.to(settings.device)
@@ -174,7 +110,11 @@ if __name__ == '__main__':
         acc = accuracy(model, test_loader, settings.device)
 
         start_time = time.perf_counter()
-        rob = pgd_robust(model, test_loader, params, settings.device)
+        if args.epsilons is None:
+            rob = pgd_robust(model, test_loader, params, settings.device)
+        else:
+            # accuracy-vs-epsilon curve
+            rob = test_attack_epsilons(model, test_loader, LinfPGDAttack, params, args.epsilons, settings.device)
         end_time = time.perf_counter()
         logger.info(f"costing time: {end_time-start_time:.2f} secs")
 
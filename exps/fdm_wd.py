@@ -3,7 +3,7 @@ from src.cli.utils import get_model, get_test_dataset, get_train_dataset
 import torch
 
 from src import settings
-from src.utils import logger
+from src.utils import logger, load_model_state_dict
 from src.trainer import RobustPlusWassersteinTrainer
 
 from src.attack import LinfPGDAttack
@@ -28,7 +28,7 @@ def wd_fdm(model, num_classes, _lambda, lr_estimator, dataset, k, random_init, e
 
     model = get_model(model, num_classes, k)
     if pretrained is not None:
-        model.load_state_dict(torch.load(pretrained, map_location=settings.device))
+        model.load_state_dict(load_model_state_dict(pretrained, map_location=settings.device))
 
     trainer = RobustPlusWassersteinTrainer(
         k=k,
@@ -8,7 +8,7 @@ from torchvision.transforms.transforms import Normalize
 from src import settings
 from src.config import set_seed
 from src.cli.utils import get_model
-from src.utils import (logger, get_mean_and_std,
+from src.utils import (logger, load_model_state_dict, get_mean_and_std,
                         get_cifar_test_dataloader,
                         get_mnist_test_dataloader,
                         get_svhn_test_dataloader,
@@ -130,7 +130,7 @@ def exp(model_path, args):
     testset = get_test_dataset(args.dataset, normalize=False, batch_size=128)
 
     model = get_model(args.model_type, args.num_classes, args.k).to(settings.device)
-    model.load_state_dict(torch.load(model_path, map_location=settings.device))
+    model.load_state_dict(load_model_state_dict(model_path, map_location=settings.device))
     logger.debug(f"load from `{model_path}`")
     model.eval()
     freeze_model_trainable_params(model)
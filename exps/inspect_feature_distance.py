@@ -8,7 +8,7 @@ import contextlib
 
 from torch import Tensor
 from torch.nn import Module
-from src.utils import logger
+from src.utils import logger, load_model_state_dict
 from src.cli.utils import get_train_dataset, get_test_dataset, get_model
 from src.networks import make_blocks, wrn34_10, parseval_retrain_wrn34_10
 from src.config import settings, set_seed
@@ -192,7 +192,7 @@ def exp(k, model_path=None, ds="cifar10", ds_type="train", model_type="wrn34", t
         
         model = get_model(model_type, output_label_num, k).to(DEVICE)
         mp = os.path.join(settings.model_dir, model_name)
-        model.load_state_dict(state_dict = torch.load(mp, map_location=DEVICE))
+        model.load_state_dict(state_dict = load_model_state_dict(mp, map_location=DEVICE))
         model.eval()
         freeze_model_trainable_params(model)
 
@@ -8,7 +8,7 @@ import pickle
 
 from torch import Tensor
 from torch.nn import Module
-from src.utils import logger
+from src.utils import logger, load_model_state_dict
 from src.cli.utils import get_train_dataset, get_test_dataset, get_model
 from src.networks import make_blocks, wrn34_10, parseval_retrain_wrn34_10
 from src.config import settings, set_seed
@@ -138,7 +138,8 @@ def exp(k, model_path, model_type, ds, ds_type, num_classes, estimator):
         set_seed(settings.seed)
 
         model = get_model(model_type, num_classes, k)
-        model.load_state_dict(torch.load(os.path.join(settings.model_dir, model_name), map_location=settings.device))
+        model.load_state_dict(load_model_state_dict(os.path.join(settings.model_dir, model_name),
+                                                    map_location=settings.device))
         model.eval()
         freeze_model_trainable_params(model)
 
@@ -9,7 +9,7 @@ from src import settings
 
 from src.utils import logger
 
-from src.trainer import SpectralNormTransferLearningTrainer
+from src.trainer import SpectralNormTransferLearningTrainer, MultiVariantTLRunner
 
 from src.attack import LinfPGDAttack
 
@@ -40,6 +40,35 @@ def sn_tl(model, num_classes, dataset, k, teacher, power_iter, norm_beta, freeze
 
     trainer.train(f"{settings.model_dir / save_name}")
 
+def multi_sn_tl(model, num_classes, dataset, k, teacher, power_iter, norm_betas, freeze_bn, reuse_statistic, reuse_teacher_statistic):
+    """transform leanring of several `norm_beta` in lockstep, outputs are the same as `sn_tl` of each one"""
+    from .utils import make_term
+    term = make_term(freeze_bn, reuse_statistic, reuse_teacher_statistic)
+    save_names = [f"sntl_{power_iter}_{norm_beta}_{term}_{model}_{dataset}_{k}_{teacher}" for norm_beta in norm_betas]
+    log_files = [f"{settings.log_dir / save_name}.log" for save_name in save_names]
+    train_loader = get_train_dataset(dataset=dataset)
+    test_loader = get_test_dataset(dataset=dataset)
+
+    trainers = []
+    for norm_beta, save_name, log_file in zip(norm_betas, save_names, log_files):
+        logger.change_log_file(log_file)
+        trainers.append(SpectralNormTransferLearningTrainer(
+            k=k,
+            teacher_model_path=str(settings.model_dir / teacher),
+            model=get_model(model=model, num_classes=num_classes, k=k),
+            train_loader=train_loader,
+            test_loader=test_loader,
+            checkpoint_path=f"{settings.checkpoint_dir / save_name}.pth",
+            power_iter=power_iter,
+            norm_beta=norm_beta,
+            freeze_bn=freeze_bn,
+            reuse_statistic=reuse_statistic,
+            reuse_teacher_statistic=reuse_teacher_statistic,
+        ))
+
+    runner = MultiVariantTLRunner(trainers, log_files)
+    runner.train([f"{settings.model_dir / save_name}" for save_name in save_names])
+
 if __name__ == '__main__':
     import argparse
     class FreezeBNAction(argparse.Action):
@@ -66,6 +95,8 @@ if __name__ == '__main__':
     parser.add_argument("-t", "--teacher", type=str)
     parser.add_argument("--power-iter", type=int, default=1)
     parser.add_argument("--norm-beta", type=float, default=1.0)
+    # several values are trained in lockstep by `multi_sn_tl`
+    parser.add_argument("--norm-betas", type=float, nargs="+")
     parser.add_argument("--freeze-bn", action=FreezeBNAction, nargs="*", default=False)
     parser.add_argument("--reuse-statistic", action="store_true")
     parser.add_argument("--reuse-teacher-statistic", action="store_true")
@@ -84,3 +115,16 @@ if __name__ == '__main__':
     #     reuse_statistic=args.reuse_statistic,
     #     reuse_teacher_statistic=args.reuse_teacher_statistic
     # )
+
+    if args.norm_betas:
+        multi_sn_tl(model=args.model,
+            num_classes=args.num_classes,
+            dataset=args.dataset,
+            k=args.k,
+            teacher=args.teacher,
+            power_iter=args.power_iter,
+            norm_betas=args.norm_betas,
+            freeze_bn=args.freeze_bn,
+            reuse_statistic=args.reuse_statistic,
+            reuse_teacher_statistic=args.reuse_teacher_statistic
+        )
@@ -1,8 +1,11 @@
-from typing import Any, Callable, Dict
+from typing import Any, Callable, Dict, List, Optional
+from contextlib import contextmanager
+import copy
 
 import torch
 from torch import Tensor
 import torch.nn as nn
+import torch.nn.functional as F
 
 from . import settings
 from .utils import logger, get_mean_and_std, clamp, evaluate_accuracy
@@ -24,59 +27,230 @@ attack_params = {
 }
 
 
-class LinfPGDAttack:
+@contextmanager
+def attack_context(model: nn.Module):
+    """run attacks against `model` in `eval` mode and restore its training mode afterwards
+
+    attacks only compute gradients w.r.t. inputs by `torch.autograd.grad`, so there is no need
+    to freeze parameters or zero their gradients around the attack
+    """
+    training = model.training
+    model.eval()
+    try:
+        with torch.enable_grad():
+            yield model
+    finally:
+        model.train(training)
+
+
+class CWMarginLoss(nn.Module):
+
+    def __init__(self, kappa: float = float("inf"), reduction: str = "mean"):
+        """margin loss of C&W attack, `max_{j != y} z_j - z_y` clamped to `kappa`, https://arxiv.org/abs/1608.04644
+
+        it is maximized by attacks like cross entropy, and is positive once the sample is misclassified
+        """
+        super().__init__()
+        self.kappa = kappa
+        self.reduction = reduction
+
+    def forward(self, y_hat: Tensor, target: Tensor) -> Tensor:
+        target_mask = F.one_hot(target, num_classes=y_hat.shape[1]).bool()
+        correct_logit = y_hat[target_mask]
+        other_logit = y_hat.masked_fill(target_mask, -float("inf")).max(dim=1)[0]
+        loss = torch.clamp(other_logit - correct_logit, max=self.kappa)
+
+        if self.reduction == "mean":
+            return loss.mean()
+        elif self.reduction == "sum":
+            return loss.sum()
+        return loss
+
+
+class BasePGDAttack:
 
     def __init__(self, model: torch.nn.Module, clip_min=0, clip_max=1,
                  random_init: int = 1, epsilon=8/255, step_size=2/255, num_steps=20,
                  loss_function: Callable[[Any], Tensor] = nn.CrossEntropyLoss(),
-                 dataset_name: str = settings.dataset_name, device: str = settings.device
-                 ):
+                 dataset_name: str = settings.dataset_name, device: str = settings.device,
+                 early_stop: bool = False, restarts: int = 1, restart_batch_size: Optional[int] = None):
+        """
+        Args:
+            loss_function: loss maximized by the attack, e.g. `CWMarginLoss()`
+            early_stop: stop attacking samples once they are misclassified, only samples which
+                        are still classified correctly are forwarded and backpropagated in later steps.
+                        this is meant for evaluation, the model should be in `eval` mode
+            restarts: number of random starts per sample, all starts are stacked into one larger batch
+                      and the worst-case perturbation (first success, otherwise max `loss_function`) is kept
+            restart_batch_size: max number of stacked samples attacked at once, restarts are split into
+                                chunks of this size to fit memory(and batches larger than it into slices).
+                                `None` means all restarts at once
+        """
+        if restarts < 1:
+            raise ValueError(f"`restarts` must be positive, but got {restarts}")
+        if restarts > 1 and not random_init:
+            raise ValueError("`restarts` need `random_init`, otherwise every start is the same")
+
         dataset_mean, dataset_std = get_mean_and_std(dataset_name)
         mean = torch.tensor(dataset_mean).view(3, 1, 1).to(device)
         std = torch.tensor(dataset_std).view(3, 1, 1).to(device)
 
         clip_max = ((clip_max - mean) / std)
         clip_min = ((clip_min - mean) / std)
-        epsilon = epsilon / std
-        step_size = step_size / std
 
         self.min = clip_min
         self.max = clip_max
+        self.std = std
         self.model = model
-        self.epsilon = epsilon
-        self.step_size = step_size
+        self.epsilon, self.step_size = self._normalize_budget(epsilon, step_size)
         self.random_init = random_init
         self.num_steps = num_steps
         self.loss_function = loss_function
+        self.early_stop = early_stop
+        self.restarts = restarts
+        self.restart_batch_size = restart_batch_size
+        # number of per-sample forward and backward passes spent by the attack, trainers may reset it
+        self.gradient_evaluations = 0
+
+    def _normalize_budget(self, epsilon, step_size):
+        """convert `epsilon` and `step_size` given in [0, 1] input space to what `_project` and `_ascent_step` use"""
+        raise NotImplementedError("must overwrite method `_normalize_budget`")
 
     def random_delta(self, delta: Tensor) -> Tensor:
-        delta.uniform_(-1, 1)
-        delta = delta * self.epsilon
+        raise NotImplementedError("must overwrite method `random_delta`")
 
-        return delta
+    def _ascent_step(self, grad: Tensor) -> Tensor:
+        """change of perturbation made by one step along `grad`"""
+        raise NotImplementedError("must overwrite method `_ascent_step`")
+
+    def _project(self, delta: Tensor) -> Tensor:
+        """project batch of perturbations to the epsilon ball"""
+        raise NotImplementedError("must overwrite method `_project`")
+
+    def calc_perturbation(self, x: Tensor, target: Tensor, init_delta: Optional[Tensor] = None) -> Tensor:
+        """
+        Args:
+            init_delta: perturbation to start from(e.g. the one found in last epoch) instead of a random one,
+                        with `restarts`, it is the first start and the others are random
+        """
+        if self.restarts > 1:
+            return self._calc_perturbation_restarts(x, target, init_delta)
+
+        return self._calc_single_perturbation(x, target, init_delta)
+
+    def _init_delta(self, x: Tensor, init_delta: Optional[Tensor]) -> Tensor:
+        if init_delta is not None:
+            return self._project(init_delta.detach())
 
-    def calc_perturbation(self, x: Tensor, target: Tensor) -> Tensor:
         delta = torch.zeros_like(x)
         if self.random_init:
             delta = self.random_delta(delta)
-        xt = x + delta
-        xt.requires_grad = True
+
+        return delta
+
+    def _calc_single_perturbation(self, x: Tensor, target: Tensor, init_delta: Optional[Tensor] = None) -> Tensor:
+        if self.early_stop:
+            return self._calc_perturbation_early_stop(x, target, init_delta)
+
+        x = x.detach()
+        xt = clamp(x + self._init_delta(x, init_delta), self.min, self.max)
 
         for it in range(self.num_steps):
+            xt.requires_grad_(True)
+            self.gradient_evaluations += xt.shape[0]
             y_hat = self.model(xt)
             loss = self.loss_function(y_hat, target)
 
-            self.model.zero_grad()
-            loss.backward()
+            # only compute `d loss / d x`, gradients of parameters are neither computed nor accumulated
+            grad = torch.autograd.grad(loss, xt)[0]
+
+            xt = self._project(xt.detach() + self._ascent_step(grad) - x) + x
+            xt = clamp(xt, self.min, self.max)
 
-            grad_sign = xt.grad.detach().sign()
-            xt.data = xt.detach() + self.step_size * grad_sign
-            xt.data = clamp(xt - x, -self.epsilon, self.epsilon) + x
-            xt.data = clamp(xt.detach(), self.min, self.max)
+        return xt.detach()
 
-            xt.grad.data.zero_()
+    def _calc_perturbation_early_stop(self, x: Tensor, target: Tensor,
+                                      init_delta: Optional[Tensor] = None) -> Tensor:
+        x = x.detach()
+        adv = clamp(x + self._init_delta(x, init_delta), self.min, self.max).detach()
 
-        return xt
+        # indices of samples that have not been fooled yet
+        active = torch.arange(x.shape[0], device=x.device)
+        for it in range(self.num_steps):
+            xt = adv[active].requires_grad_(True)
+            self.gradient_evaluations += xt.shape[0]
+            y_hat = self.model(xt)
+
+            # samples fooled by current perturbation are kept as they are
+            still_correct = y_hat.argmax(dim=1) == target[active]
+            if not still_correct.any():
+                break
+
+            loss = self.loss_function(y_hat[still_correct], target[active][still_correct])
+            grad = torch.autograd.grad(loss, xt)[0]
+
+            active = active[still_correct]
+            x_active = x[active]
+            xt_active = xt.detach()[still_correct] + self._ascent_step(grad[still_correct])
+            xt_active = self._project(xt_active - x_active) + x_active
+            adv[active] = clamp(xt_active, self.min, self.max)
+
+        return adv
+
+    def _calc_perturbation_restarts(self, x: Tensor, target: Tensor, init_delta: Optional[Tensor] = None) -> Tensor:
+        batch_size = x.shape[0]
+        if self.restart_batch_size is not None and self.restart_batch_size < batch_size:
+            # even one start of whole batch does not fit, attack slices of batch one after another
+            return torch.cat([
+                self._calc_perturbation_restarts(
+                    x[i:i + self.restart_batch_size], target[i:i + self.restart_batch_size],
+                    init_delta[i:i + self.restart_batch_size] if init_delta is not None else None)
+                for i in range(0, batch_size, self.restart_batch_size)
+            ])
+
+        if self.restart_batch_size is None:
+            restarts_per_chunk = self.restarts
+        else:
+            restarts_per_chunk = max(1, self.restart_batch_size // batch_size)
+
+        sample_indices = torch.arange(batch_size, device=x.device)
+        best_adv = x.detach().clone()
+        # fooled samples get `inf` score, so the first successful restart is kept
+        best_score = torch.full((batch_size,), -float("inf"), device=x.device)
+
+        for start in range(0, self.restarts, restarts_per_chunk):
+            r = min(restarts_per_chunk, self.restarts - start)
+            stacked_x, stacked_target = x.repeat(r, 1, 1, 1), target.repeat(r)
+            stacked_init_delta = None
+            if init_delta is not None:
+                stacked_init_delta = self.random_delta(torch.zeros_like(stacked_x))
+                if start == 0:
+                    stacked_init_delta[:batch_size] = init_delta
+            adv = self._calc_single_perturbation(stacked_x, stacked_target, stacked_init_delta).detach()
+
+            # score in `eval` mode as well, so BN statistics are neither used nor updated by scoring
+            with attack_context(self.model), torch.no_grad():
+                y_hat = self.model(adv)
+            score = self._sample_loss(y_hat, stacked_target)
+            score[y_hat.argmax(dim=1) != stacked_target] = float("inf")
+
+            chunk_score, chunk_idx = score.view(r, batch_size).max(dim=0)
+            chunk_adv = adv.view(r, *x.shape)[chunk_idx, sample_indices]
+
+            better = chunk_score > best_score
+            best_adv[better] = chunk_adv[better]
+            best_score = torch.max(best_score, chunk_score)
+
+        return best_adv
+
+    def _sample_loss(self, y_hat: Tensor, target: Tensor) -> Tensor:
+        """per-sample `loss_function` used to pick the worst-case restart, cross entropy if it has no `reduction`"""
+        if not hasattr(self.loss_function, "reduction"):
+            return F.cross_entropy(y_hat, target, reduction="none")
+
+        loss_function = copy.copy(self.loss_function)
+        loss_function.reduction = "none"
+        return loss_function(y_hat, target)
 
     def print_parameters(self):
         params = {
@@ -86,6 +260,8 @@ class LinfPGDAttack:
             "step_size": self.step_size,
             "num_steps": self.num_steps,
             "random_init": self.random_init,
+            "early_stop": self.early_stop,
+            "restarts": self.restarts,
         }
         params_str = "\n".join([": ".join(map(str, item))
                                 for item in params.items()])
@@ -93,18 +269,90 @@ class LinfPGDAttack:
         logger.info(f"attack parameters: \n{params_str}")
 
 
-def test_attack(model: nn.Module, test_loader, attacker, params: Dict, device: str = settings.device) -> float:
+class LinfPGDAttack(BasePGDAttack):
+
+    def _normalize_budget(self, epsilon, step_size):
+        return epsilon / self.std, step_size / self.std
+
+    def random_delta(self, delta: Tensor) -> Tensor:
+        delta.uniform_(-1, 1)
+        delta = delta * self.epsilon
+
+        return delta
+
+    def _ascent_step(self, grad: Tensor) -> Tensor:
+        return self.step_size * grad.sign()
+
+    def _project(self, delta: Tensor) -> Tensor:
+        return clamp(delta, -self.epsilon, self.epsilon)
+
+
+class L2PGDAttack(BasePGDAttack):
+    """pgd in l2 ball, `epsilon` and `step_size` are l2 norms in [0, 1] input space
+
+    inputs are normalized by per-channel std, so norms are measured after scaling perturbations back by std.
+    scaling a perturbation keeps its direction in both spaces, so projection is still exact
+    """
+
+    def __init__(self, model: torch.nn.Module, epsilon=0.5, step_size=0.1, **kwargs):
+        super().__init__(model, epsilon=epsilon, step_size=step_size, **kwargs)
+
+    def _normalize_budget(self, epsilon, step_size):
+        return epsilon, step_size
+
+    @staticmethod
+    def _sample_norm(t: Tensor) -> Tensor:
+        """l2 norm of every sample, shaped to broadcast with `t`"""
+        return t.flatten(start_dim=1).norm(dim=1).view(-1, *([1] * (t.dim() - 1))) + 1e-12
+
+    def random_delta(self, delta: Tensor) -> Tensor:
+        delta.normal_()
+        # uniform radius in [0, epsilon] along a random direction
+        radius = torch.rand(delta.shape[0], *([1] * (delta.dim() - 1)), device=delta.device)
+        delta = delta / self._sample_norm(delta) * radius * self.epsilon
+
+        return delta / self.std
+
+    def _ascent_step(self, grad: Tensor) -> Tensor:
+        # gradient w.r.t. unnormalized inputs is `grad / std`, the step is mapped back by `/ std`
+        unnormalized_grad = grad / self.std
+        return self.step_size * unnormalized_grad / self._sample_norm(unnormalized_grad) / self.std
+
+    def _project(self, delta: Tensor) -> Tensor:
+        scale = torch.clamp(self.epsilon / self._sample_norm(delta * self.std), max=1)
+        return delta * scale
+
+
+class LinfFGSMAttack(LinfPGDAttack):
+
+    def __init__(self, model: torch.nn.Module, clip_min=0, clip_max=1, epsilon=8/255, step_size=10/255,
+                 loss_function: Callable[[Any], Tensor] = nn.CrossEntropyLoss(),
+                 dataset_name: str = settings.dataset_name, device: str = settings.device, **kwargs):
+        """single step attack from a random start(FGSM-RS), https://arxiv.org/abs/2001.03994
+
+        the step size is meant to be larger than `epsilon`(1.25 * epsilon by default), the result
+        is still projected to the epsilon ball. `random_init` and `num_steps` are fixed and ignored
+        if given, so params of `LinfPGDAttack` can be reused
+        """
+        kwargs.pop("random_init", None)
+        kwargs.pop("num_steps", None)
+        super().__init__(model, clip_min, clip_max, random_init=1, epsilon=epsilon, step_size=step_size,
+                         num_steps=1, loss_function=loss_function, dataset_name=dataset_name,
+                         device=device, **kwargs)
+
+
+def test_attack(model: nn.Module, test_loader, attacker, params: Dict, device: str = settings.device,
+                early_stop: bool = True) -> float:
     normal_acc = evaluate_accuracy(model, test_loader, device)
     logger.info(f"normal accuracy: {normal_acc}")
     model.eval()
-    _attacker = attacker(model=model, device=device, **params)
+    _attacker = attacker(model=model, device=device, early_stop=early_stop, **params)
     _attacker.print_parameters()
 
     correct = 0
     for inputs, labels in test_loader:
         inputs, labels = inputs.to(device), labels.to(device)
         adv_inputs = _attacker.calc_perturbation(inputs, labels)
-        model.zero_grad()
         with torch.no_grad():
             _, y_hats = model(adv_inputs).max(1)
             match = (y_hats == labels)
@@ -118,10 +366,63 @@ def test_attack(model: nn.Module, test_loader, attacker, params: Dict, device: s
     return adversarial_accuracy
 
 
+def test_attack_epsilons(model: nn.Module, test_loader, attacker, params: Dict, epsilons: List[float],
+                         device: str = settings.device) -> Dict[float, float]:
+    """robust accuracy under every epsilon in `epsilons` with one pass over `test_loader`
+
+    epsilons are attacked in ascending order. linf balls are nested, so a sample fooled under smaller
+    epsilon is also fooled under larger ones and is skipped, and attacks of larger epsilon start from
+    the perturbation found under the previous one(with `restarts` in `params`, it is one of the starts).
+    `epsilon` in `params` is ignored
+
+    Returns:
+        accuracy-vs-epsilon curve, `0` is mapped to natural accuracy
+    """
+    epsilons = sorted(epsilons)
+    model.eval()
+    params = {k: v for k, v in params.items() if k != "epsilon"}
+    attackers = [attacker(model=model, device=device, epsilon=epsilon, early_stop=True, **params)
+                 for epsilon in epsilons]
+    attackers[-1].print_parameters()
+
+    natural_correct = 0
+    correct = [0] * len(epsilons)
+    for inputs, labels in test_loader:
+        inputs, labels = inputs.to(device), labels.to(device)
+        with torch.no_grad():
+            robust = model(inputs).argmax(dim=1) == labels
+        natural_correct += robust.sum().item()
+
+        delta = None
+        for i, _attacker in enumerate(attackers):
+            # samples fooled under smaller epsilon are not attacked any more
+            if delta is not None:
+                delta = delta[robust]
+            inputs, labels = inputs[robust], labels[robust]
+            if inputs.shape[0] == 0:
+                break
+
+            adv_inputs = _attacker.calc_perturbation(inputs, labels, init_delta=delta)
+            delta = adv_inputs - inputs
+            with torch.no_grad():
+                robust = model(adv_inputs).argmax(dim=1) == labels
+            correct[i] += robust.sum().item()
+
+    dataset_size = len(test_loader.dataset)
+    curve = {0: natural_correct / dataset_size}
+    curve.update({epsilon: c / dataset_size for epsilon, c in zip(epsilons, correct)})
+    for epsilon, acc in curve.items():
+        logger.info(f"epsilon: {epsilon:.6f}   adversarial accuracy: {100 * acc:.3f}%")
+
+    model.train()
+
+    return curve
+
+
 if __name__ == '__main__':
     from src.networks import parseval_retrain_wrn34_10, wrn34_10, resnet18
     from .utils import (get_cifar_test_dataloader, get_cifar_train_dataloader, get_mnist_test_dataloader,
-                        get_mnist_test_dataloader_one_channel)
+                        get_mnist_test_dataloader_one_channel, load_model_state_dict)
     import time
     import json
 
@@ -165,7 +466,7 @@ if __name__ == '__main__':
     for model_path in model_list:
         # TODO
         logger.debug(f"load from `{model_path}`")
-        model.load_state_dict(torch.load(
+        model.load_state_dict(load_model_state_dict(
             model_path, map_location=settings.device))
         model.to(settings.device)
         start_time = time.perf_counter()
@@ -12,19 +12,21 @@ from .utils import (DefaultDataset, SupportDatasetList,
                     DefaultModel, SupportModelList,
                     SupportParsevalModelList, SupportNormalModelList,
                     get_test_dataset, get_train_dataset,
-                    get_model)
+                    get_model, get_attack_schedule)
 
 from src import settings
 
-from src.utils import logger
+from src.utils import logger, load_model_state_dict
 
 from src.trainer import (TransferLearningTrainer, LWFTransferLearningTrainer,
                          ParsevalTransferLearningTrainer, RetrainTrainer,
                          ParsevalRetrainTrainer, NormalTrainer,
                          ADVTrainer, RobustPlusSingularRegularizationTrainer,
-                         BNTransferLearningTrainer)
+                         BNTransferLearningTrainer, FreeADVTrainer, FastADVTrainer,
+                         AccumulatedADVTrainer, MultiVariantTLRunner, AdapterTransferLearningTrainer,
+                         SpectralNormTransferLearningTrainer)
 
-from src.attack import LinfPGDAttack
+from src.attack import LinfPGDAttack, LinfFGSMAttack
 
 _BasicOptions = [
     click.option("-m", "--model", type=click.Choice(SupportModelList),
@@ -150,6 +152,98 @@ def ptl(model, num_classes, dataset, beta, k, teacher):
     trainer.train(f"{settings.model_dir / save_name}")
 
 
+@cli.command()
+@click.option("-m", "--model", type=click.Choice(SupportModelList),
+              default=DefaultModel, show_default=True, help="neural network")
+@click.option("-n", "--num_classes", type=int,
+              default=10, show_default=True, help="number of classes")
+@click.option("-d", "--dataset", type=click.Choice(SupportDatasetList),
+              default=DefaultDataset, show_default=True, help="dataset")
+@click.option("-b", "--beta", type=float, multiple=True,
+              help="penalization rate of parseval constrain, repeat to train several parseval variants")
+@click.option("-s", "--norm_beta", type=float, multiple=True,
+              help="spectral norm bound, repeat to train several spectral norm variants")
+@click.option("--power_iter", type=int,
+              default=1, show_default=True, help="power iterations of spectral norm variants")
+@click.option("-k", "--k", type=int, required=True,
+              help="trainable blocks from last")
+@click.option("-t", "--teacher", type=str, required=True,
+              help="filename of teacher model")
+def mptl(model, num_classes, dataset, beta, norm_beta, power_iter, k, teacher):
+    """transform learning of several parseval(`beta`) and spectral norm(`norm_beta`) variants in lockstep
+
+    outputs are saved with `mptl_`(parseval) and `msntl_`(spectral norm) prefixes, so they never
+    overwrite those of `ptl` or single variant runs
+    """
+    if not beta and not norm_beta:
+        raise click.UsageError("at least one `--beta` or `--norm_beta` is required")
+    if beta and model not in SupportParsevalModelList:
+        raise click.BadParameter(f"parseval variants need one of {SupportParsevalModelList}", param_hint="--model")
+
+    save_names = [f"mptl_{model}_{dataset}_{b}_{k}_from_{teacher}" for b in beta] + \
+                 [f"msntl_{power_iter}_{nb}_{model}_{dataset}_{k}_{teacher}" for nb in norm_beta]
+    log_files = [f"{settings.log_dir / save_name}.log" for save_name in save_names]
+    train_loader = get_train_dataset(dataset)
+    test_loader = get_test_dataset(dataset)
+
+    trainers = []
+    for i, (save_name, log_file) in enumerate(zip(save_names, log_files)):
+        logger.change_log_file(log_file)
+        if i < len(beta):
+            trainers.append(ParsevalTransferLearningTrainer(
+                beta=beta[i],
+                k=k,
+                teacher_model_path=str(settings.model_dir / teacher),
+                model=get_model(model, num_classes, k),
+                train_loader=train_loader,
+                test_loader=test_loader,
+                checkpoint_path=f"{settings.checkpoint_dir / save_name}.pth"
+            ))
+        else:
+            trainers.append(SpectralNormTransferLearningTrainer(
+                k=k,
+                teacher_model_path=str(settings.model_dir / teacher),
+                model=get_model(model, num_classes, k),
+                train_loader=train_loader,
+                test_loader=test_loader,
+                power_iter=power_iter,
+                norm_beta=norm_beta[i - len(beta)],
+                checkpoint_path=f"{settings.checkpoint_dir / save_name}.pth"
+            ))
+    runner = MultiVariantTLRunner(trainers, log_files)
+    runner.train([f"{settings.model_dir / save_name}" for save_name in save_names])
+
+
+@cli.command()
+@click.option("-m", "--model", type=click.Choice(SupportModelList),
+              default=DefaultModel, show_default=True, help="neural network")
+@click.option("-n", "--num_classes", type=int,
+              default=10, show_default=True, help="number of classes")
+@click.option("-d", "--dataset", type=click.Choice(SupportDatasetList),
+              default=DefaultDataset, show_default=True, help="dataset")
+@click.option("-r", "--rank", type=int,
+              default=8, show_default=True, help="rank of adapters of convs")
+@click.option("-k", "--k", type=int, required=True,
+              help="trainable blocks from last")
+@click.option("-t", "--teacher", type=str, required=True,
+              help="filename of teacher model")
+def atl(model, num_classes, dataset, rank, k, teacher):
+    """transform learning with low-rank adapters of convs in last k blocks"""
+    save_name = f"atl_{model}_{dataset}_{rank}_{k}_{teacher}"
+    logger.change_log_file(f"{settings.log_dir / save_name}.log")
+
+    trainer = AdapterTransferLearningTrainer(
+        rank=rank,
+        k=k,
+        teacher_model_path=str(settings.model_dir / teacher),
+        model=get_model(model, num_classes, k),
+        train_loader=get_train_dataset(dataset),
+        test_loader=get_test_dataset(dataset),
+        checkpoint_path=f"{settings.checkpoint_dir / save_name}.pth"
+    )
+    trainer.train(f"{settings.model_dir / save_name}")
+
+
 @cli.command()
 @click.option("-m", "--model", type=click.Choice(SupportModelList),
               default=DefaultModel, show_default=True, help="neural network")
@@ -204,7 +298,7 @@ def nr(model, num_classes, dataset, k, state_dict):
     save_name = f"nr_{model}_{dataset}_{k}"
     logger.change_log_file(f"{settings.log_dir / save_name}.log")
     model = get_model(model, num_classes, k)
-    model.load_state_dict(torch.load(str(settings.model_dir / state_dict)))
+    model.load_state_dict(load_model_state_dict(str(settings.model_dir / state_dict)))
     trainer = RetrainTrainer(
         k=k,
         model=model,
@@ -233,7 +327,7 @@ def pr(model, num_classes, dataset, k, beta, state_dict):
     save_name = f"pr_{model}_{dataset}_{k}"
     logger.change_log_file(f"{settings.log_dir / save_name}.log")
     model = get_model(model, num_classes, k)
-    model.load_state_dict(torch.load(str(settings.model_dir / state_dict)))
+    model.load_state_dict(load_model_state_dict(str(settings.model_dir / state_dict)))
     trainer = ParsevalRetrainTrainer(
         beta=beta,
         k=k,
@@ -280,9 +374,22 @@ def nt(model, num_classes, dataset):
               show_default=True, help="step size")
 @click.option("-ns", "--num_steps", type=int, default=7,
               show_default=True, help="num steps")
-def at(model, num_classes, dataset, random_init, epsilon, step_size, num_steps):
+@click.option("-acc", "--accumulate", is_flag=True, show_default=True,
+              help="start pgd from perturbations of last epoch")
+@click.option("-mm", "--memmap", type=str, default=None,
+              help="memory-mapped file of accumulated perturbations")
+@click.option("-as", "--attack_schedule", type=click.Choice(["ramp", "plateau"]), default=None,
+              help="increase attack steps from `start_steps` to `num_steps` during training")
+@click.option("-sts", "--start_steps", type=int, default=2,
+              show_default=True, help="attack steps of first epoch when using attack schedule")
+def at(model, num_classes, dataset, random_init, epsilon, step_size, num_steps, accumulate, memmap,
+       attack_schedule, start_steps):
     """adversarial train"""
     save_name = f"at_{model}_{dataset}"
+    if accumulate:
+        save_name = f"{save_name}_acc{num_steps}"
+    if attack_schedule is not None:
+        save_name = f"{save_name}_{attack_schedule}{start_steps}"
     logger.change_log_file(f"{settings.log_dir / save_name}.log")
     params = {
         "random_init": random_init,
@@ -291,12 +398,97 @@ def at(model, num_classes, dataset, random_init, epsilon, step_size, num_steps):
         "num_steps": num_steps,
         "dataset_name": dataset
     }
-    trainer = ADVTrainer(
+    trainer_kwargs = dict(
+        model=get_model(model, num_classes),
+        train_loader=get_train_dataset(dataset),
+        test_loader=get_test_dataset(dataset),
+        attacker=LinfPGDAttack,
+        params=params,
+        checkpoint_path=f"{settings.checkpoint_dir / save_name}.pth",
+        attack_schedule=get_attack_schedule(attack_schedule, start_steps, num_steps)
+    )
+    if accumulate:
+        trainer = AccumulatedADVTrainer(memmap_path=memmap, **trainer_kwargs)
+    else:
+        trainer = ADVTrainer(**trainer_kwargs)
+    trainer.train(f"{settings.model_dir / save_name}")
+
+
+@cli.command()
+@click.option("-m", "--model", type=click.Choice(SupportModelList),
+              default=DefaultModel, show_default=True, help="neural network")
+@click.option("-n", "--num_classes", type=int,
+              default=10, show_default=True, help="number of classes")
+@click.option("-d", "--dataset", type=click.Choice(SupportDatasetList),
+              default=DefaultDataset, show_default=True, help="dataset")
+@click.option("-e", "--epsilon", type=float, default=8 / 255,
+              show_default=True, help="epsilon")
+@click.option("-ss", "--step_size", type=float, default=10 / 255,
+              show_default=True, help="step size of single step attack")
+@click.option("-pss", "--pgd_step_size", type=float, default=2 / 255,
+              show_default=True, help="step size of pgd attack")
+@click.option("-ns", "--num_steps", type=int, default=7,
+              show_default=True, help="num steps of pgd attack")
+@click.option("-cb", "--check_batches", type=int, default=4,
+              show_default=True, help="number of held-out train batches used by pgd check")
+@click.option("-pe", "--pgd_epochs", type=int, default=1,
+              show_default=True, help="epochs trained with pgd after catastrophic overfitting")
+def fgsmat(model, num_classes, dataset, epsilon, step_size, pgd_step_size, num_steps, check_batches, pgd_epochs):
+    """fast adversarial train with single step attack"""
+    save_name = f"fgsmat_{model}_{dataset}"
+    logger.change_log_file(f"{settings.log_dir / save_name}.log")
+    params = {
+        "epsilon": epsilon,
+        "step_size": step_size,
+        "dataset_name": dataset
+    }
+    pgd_params = {
+        "random_init": 1,
+        "epsilon": epsilon,
+        "step_size": pgd_step_size,
+        "num_steps": num_steps,
+        "dataset_name": dataset
+    }
+    trainer = FastADVTrainer(
+        model=get_model(model, num_classes),
+        train_loader=get_train_dataset(dataset),
+        test_loader=get_test_dataset(dataset),
+        attacker=LinfFGSMAttack,
+        params=params,
+        pgd_params=pgd_params,
+        check_batches=check_batches,
+        pgd_epochs=pgd_epochs,
+        checkpoint_path=f"{settings.checkpoint_dir / save_name}.pth"
+    )
+    trainer.train(f"{settings.model_dir / save_name}")
+
+
+@cli.command()
+@click.option("-m", "--model", type=click.Choice(SupportModelList),
+              default=DefaultModel, show_default=True, help="neural network")
+@click.option("-n", "--num_classes", type=int,
+              default=10, show_default=True, help="number of classes")
+@click.option("-d", "--dataset", type=click.Choice(SupportDatasetList),
+              default=DefaultDataset, show_default=True, help="dataset")
+@click.option("-e", "--epsilon", type=float, default=8 / 255,
+              show_default=True, help="epsilon")
+@click.option("-r", "--replay_times", type=int, default=8,
+              show_default=True, help="times each minibatch is replayed")
+def fat(model, num_classes, dataset, epsilon, replay_times):
+    """free adversarial train"""
+    save_name = f"fat_{model}_{dataset}_{replay_times}"
+    logger.change_log_file(f"{settings.log_dir / save_name}.log")
+    params = {
+        "epsilon": epsilon,
+        "dataset_name": dataset
+    }
+    trainer = FreeADVTrainer(
         model=get_model(model, num_classes),
         train_loader=get_train_dataset(dataset),
         test_loader=get_test_dataset(dataset),
         attacker=LinfPGDAttack,
         params=params,
+        replay_times=replay_times,
         checkpoint_path=f"{settings.checkpoint_dir / save_name}.pth"
     )
     trainer.train(f"{settings.model_dir / save_name}")
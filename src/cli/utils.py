@@ -13,6 +13,10 @@ from src.utils import (get_cifar_test_dataloader, get_cifar_train_dataloader,
                        get_svhn_test_dataloader, get_svhn_train_dataloder,
                        get_gtsrb_test_dataloder, get_gtsrb_train_dataloder)
 
+from src.trainer.attack_schedule import AttackSchedule, LinearRampSchedule, PlateauSchedule
+
+from src import settings
+
 
 SupportNormalModelList = ['res18', 'res34', 'res50', 'wrn34', 'wrn34(4)', 'wrn28', 'wrn28(4)']
 SupportParsevalModelList = ['pres18', 'pwrn34', 'pwrn28', 'pwrn28(4)']
@@ -28,28 +32,29 @@ DefaultDataset = 'mnist'
 def get_model(model: str, num_classes: int, k: Optional[int] = None) -> SupportedAllModuleType:
     if model not in SupportModelList:
         raise ValueError("model not supported")
+    segments = settings.checkpoint_segments
     if model == 'res18':
-        return resnet18(num_classes=num_classes)
+        return resnet18(num_classes=num_classes, checkpoint_segments=segments)
     elif model == "res34":
-        return resnet34(num_classes=num_classes)
+        return resnet34(num_classes=num_classes, checkpoint_segments=segments)
     elif model == "res50":
-        return resnet50(num_classes=num_classes)
+        return resnet50(num_classes=num_classes, checkpoint_segments=segments)
     elif model == 'pres18':
-        return parseval_resnet18(k=k, num_classes=num_classes)
+        return parseval_resnet18(k=k, num_classes=num_classes, checkpoint_segments=segments)
     elif model == 'wrn34':
-        return wrn34_10(num_classes=num_classes)
+        return wrn34_10(num_classes=num_classes, checkpoint_segments=segments)
     elif model == 'wrn34(4)':
-        return wrn34_4(num_classes=num_classes)
+        return wrn34_4(num_classes=num_classes, checkpoint_segments=segments)
     elif model == 'pwrn34':
-        return parseval_retrain_wrn34_10(k=k, num_classes=num_classes)
+        return parseval_retrain_wrn34_10(k=k, num_classes=num_classes, checkpoint_segments=segments)
     elif model == 'wrn28':
-        return wrn28_10(num_classes=num_classes)
+        return wrn28_10(num_classes=num_classes, checkpoint_segments=segments)
     elif model == 'wrn28(4)':
-        return wrn28_4(num_classes=num_classes)
+        return wrn28_4(num_classes=num_classes, checkpoint_segments=segments)
     elif model == 'pwrn28':
-        return parseval_retrain_wrn28_10(k=k, num_classes=num_classes)
+        return parseval_retrain_wrn28_10(k=k, num_classes=num_classes, checkpoint_segments=segments)
     elif model == 'pwrn28(4)':
-        return parseval_retrain_wrn28_4(k=k, num_classes=num_classes)
+        return parseval_retrain_wrn28_4(k=k, num_classes=num_classes, checkpoint_segments=segments)
 
 
 def get_train_dataset(dataset: str) -> DataLoader:
@@ -90,4 +95,15 @@ def get_test_dataset(dataset: str) -> DataLoader:
     elif dataset == "gtsrb":
         return get_gtsrb_test_dataloder()
     else:
-        raise ValueError(f"dataset `{dataset} is not supported`")
\ No newline at end of file
+        raise ValueError(f"dataset `{dataset} is not supported`")
+
+def get_attack_schedule(schedule: Optional[str], start_steps: int, end_steps: int) -> Optional[AttackSchedule]:
+    if schedule is None:
+        return None
+    if schedule == "ramp":
+        # reach full strength at the first lr milestone
+        return LinearRampSchedule(start_steps, end_steps, ramp_epochs=settings.milestones[0])
+    elif schedule == "plateau":
+        return PlateauSchedule(start_steps, end_steps)
+    else:
+        raise ValueError(f"attack schedule `{schedule}` is not supported")
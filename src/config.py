@@ -29,17 +29,59 @@ class Settings(BaseSettings):
     weight_decay: float = 5e-4
 
     batch_size: int = 128
+    # split every batch into micro-batches of this size and accumulate their gradients,
+    # optimizers still step once per batch, `None` trains on whole batches
+    micro_batch_size: Optional[int] = None
     num_worker: int = 4
+    # dataloaders return batches in page-locked memory(only with cuda)
+    pin_memory: bool = False
+    # trainers copy next batch to device while current batch is being trained
+    prefetch_to_device: bool = False
+    # models built by `src.cli` recompute activations of residual block stacks in backward,
+    # number of checkpointed segments per stack, `0` keeps all activations
+    checkpoint_segments: int = 0
 
     start_lr: float = 0.1
     train_epochs: int = 100
     warm_up_epochs: int = 1
 
+    # evaluate on test set every `eval_every` epochs(and at the last epoch), in a separate
+    # cpu process if `async_eval`, results are merged back in later epochs
+    eval_every: int = 1
+    async_eval: bool = False
+    # evaluate a copy of model with BN layers folded into convs, see `src.networks.fold_bn`
+    fold_eval_bn: bool = False
+
     # CE for cross-entropy and MSE for mean-square-error
     criterion: str = "CE"
 
     save_rand_state: bool = True
 
+    # write checkpoints on a background thread, training only blocks when
+    # `checkpoint_queue_size` checkpoints are still waiting to be written
+    async_checkpoint: bool = False
+    checkpoint_queue_size: int = 1
+
+    # transfer learning trainers only save tensors changed relative to teacher model,
+    # loaded by `src.utils.load_model_state_dict`
+    delta_checkpoint: bool = False
+
+    # transfer learning trainers compute inputs of the first trainable block once(frozen blocks run in
+    # eval mode) and train only the last k blocks on them. `feature_cache_views` augmented views of every
+    # sample are stored in memory-mapped files under `feature_cache_dir`, reused by runs with the same
+    # teacher, model, k and train set
+    feature_cache: bool = False
+    feature_cache_views: int = 1
+    feature_cache_half: bool = True
+    feature_cache_dir: PurePath = root_dir / "feature_cache"
+    # frozen blocks of transfer learning trainers keep BN statistics of teacher model, and are run
+    # as a copy with BN layers folded into convs
+    fold_frozen_bn: bool = False
+
+    # split wall time of training steps into phases(data loading, attack, forward, ...),
+    # written to tensorboard and `{save_path}_profile.json`, cuda is synchronized between phases
+    profile_steps: bool = False
+
     @validator("criterion")
     def criterion_must_be_correct(cls, v):
         if v == "CE":
@@ -53,7 +95,14 @@ class Settings(BaseSettings):
     milestones: List[int] = [40, 70, 90]
     decrease_rate: float = 0.2
 
-    # whether use multiple GPUs
+    # once best accuracy(test accuracy, or robustness of adversarial trainers) has not improved by more
+    # than `stop_threshold` for `stop_patience` evaluations, skip to next milestone if `skip_milestones`,
+    # otherwise(or after the last milestone) stop training, `None` always trains `train_epochs`
+    stop_patience: Optional[int] = None
+    stop_threshold: float = 0.
+    skip_milestones: bool = True
+
+    # distributed data parallel training over processes(gloo backend), set by `python -m src.launch`
     parallelism: bool = False
 
     dataset_name: str = "cifar10"
@@ -0,0 +1,53 @@
+"""launch distributed training of a `src.cli` command
+
+run `cli at -m wrn34 ...` with 4 processes on this node:
+
+    python -m src.launch --nproc_per_node 4 at -m wrn34 ...
+
+run on 2 nodes, on each node with its `--node_rank`:
+
+    python -m src.launch --nnodes 2 --node_rank 0 --master_addr 10.0.0.1 --nproc_per_node 4 at -m wrn34 ...
+
+processes join a gloo process group, every process trains on its own shard of train set with
+`settings.batch_size / world size` samples per step, only rank 0 writes logs, checkpoints and models
+"""
+import argparse
+import os
+import sys
+
+import torch.multiprocessing as mp
+
+
+def _run(local_rank: int, args: argparse.Namespace) -> None:
+    rank = args.node_rank * args.nproc_per_node + local_rank
+    os.environ.update({
+        "RANK": str(rank),
+        "LOCAL_RANK": str(local_rank),
+        "WORLD_SIZE": str(args.nnodes * args.nproc_per_node),
+        "MASTER_ADDR": args.master_addr,
+        "MASTER_PORT": str(args.master_port),
+    })
+
+    from src import settings
+    settings.parallelism = True
+
+    # `src.cli.cli` runs the command given by `sys.argv` when it is imported
+    sys.argv = ["cli", *args.command]
+    try:
+        import src.cli.cli
+    except SystemExit as e:
+        if e.code:
+            raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="launch distributed training")
+    parser.add_argument("--nproc_per_node", type=int, default=1)
+    parser.add_argument("--nnodes", type=int, default=1)
+    parser.add_argument("--node_rank", type=int, default=0)
+    parser.add_argument("--master_addr", type=str, default="127.0.0.1")
+    parser.add_argument("--master_port", type=int, default=29500)
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="command and options of `src.cli`")
+    args = parser.parse_args()
+
+    mp.spawn(_run, args=(args,), nprocs=args.nproc_per_node)
@@ -8,6 +8,8 @@ from .parseval_wrn import (parseval_retrain_wrn28_10, parseval_retrain_wrn34_10,
 
 from .resnet import ResNet, resnet18, resnet34, resnet50
 from .parseval_resnet import ParsevalResNet, parseval_resnet18
+from .fold_bn import fold_bn
+from .adapter import LowRankConv2d, add_conv_adapters, merge_conv_adapters, merge_adapter_state_dict
 
 # todo
 # these will be used in utils
@@ -0,0 +1,101 @@
+"""low-rank adapters of frozen convolutions"""
+import math
+from collections import OrderedDict
+from typing import Dict, List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class LowRankConv2d(nn.Module):
+
+    def __init__(self, conv: nn.Conv2d, rank: int):
+        """`conv` with frozen weight and a trainable low-rank residual, i.e. weight of convolution is
+        `weight + (lora_up @ lora_down).view_as(weight)`
+
+        `weight` and `bias` are parameters of `conv`, so keys of state_dict are those of `conv` plus
+        `lora_down` and `lora_up`. `lora_up` starts from zeros, outputs equal those of `conv` before training
+
+        Args:
+            rank: rank of the residual, factors have `rank * (out_channels + in_channels * kernel size)`
+                  parameters instead of `out_channels * in_channels * kernel size`
+        """
+        super().__init__()
+        if conv.padding_mode != "zeros":
+            raise ValueError(f"padding mode `{conv.padding_mode}` is not supported")
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+
+        self.weight = conv.weight
+        self.register_parameter("bias", conv.bias)
+        for p in conv.parameters():
+            p.requires_grad = False
+
+        self.lora_down = nn.Parameter(self.weight.new_empty(rank, self.weight[0].numel()))
+        self.lora_up = nn.Parameter(self.weight.new_zeros(self.weight.shape[0], rank))
+        nn.init.kaiming_uniform_(self.lora_down, a=math.sqrt(5))
+
+    def delta_weight(self) -> torch.Tensor:
+        return (self.lora_up @ self.lora_down).view_as(self.weight)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return F.conv2d(x, self.weight + self.delta_weight(), self.bias, self.stride, self.padding,
+                        self.dilation, self.groups)
+
+    def merge(self) -> nn.Conv2d:
+        """plain conv with the residual merged into its weight"""
+        out_channels, in_channels, *kernel_size = self.weight.shape
+        conv = nn.Conv2d(in_channels * self.groups, out_channels, tuple(kernel_size), stride=self.stride,
+                         padding=self.padding, dilation=self.dilation, groups=self.groups,
+                         bias=self.bias is not None, device=self.weight.device, dtype=self.weight.dtype)
+        with torch.no_grad():
+            conv.weight.copy_(self.weight + self.delta_weight())
+            if self.bias is not None:
+                conv.bias.copy_(self.bias)
+
+        return conv
+
+    def extra_repr(self) -> str:
+        return f"weight={tuple(self.weight.shape)}, rank={self.lora_down.shape[0]}, stride={self.stride}, " \
+               f"padding={self.padding}"
+
+
+def _replace_modules(module: nn.Module, predicate, replace) -> List[nn.Module]:
+    replaced = []
+    for name, child in module.named_children():
+        if predicate(child):
+            new_child = replace(child)
+            setattr(module, name, new_child)
+            replaced.append(new_child)
+        else:
+            replaced.extend(_replace_modules(child, predicate, replace))
+
+    return replaced
+
+
+def add_conv_adapters(module: nn.Module, rank: int) -> List[LowRankConv2d]:
+    """replace every `nn.Conv2d` inside `module` by `LowRankConv2d` of `rank` in place, return the adapters"""
+    return _replace_modules(module, lambda child: type(child) is nn.Conv2d, lambda child: LowRankConv2d(child, rank))
+
+
+def merge_conv_adapters(module: nn.Module) -> None:
+    """replace every `LowRankConv2d` inside `module` by its merged conv in place"""
+    _replace_modules(module, lambda child: isinstance(child, LowRankConv2d), lambda child: child.merge())
+
+
+def merge_adapter_state_dict(state_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    """state_dict of the model with adapters merged, loadable by the model without adapters"""
+    merged = OrderedDict()
+    for key, value in state_dict.items():
+        if key.endswith((".lora_down", ".lora_up")):
+            continue
+        prefix = key[:-len("weight")]
+        if key.endswith(".weight") and f"{prefix}lora_up" in state_dict:
+            delta = state_dict[f"{prefix}lora_up"] @ state_dict[f"{prefix}lora_down"]
+            value = value + delta.view_as(value).to(value.dtype)
+        merged[key] = value
+
+    return merged
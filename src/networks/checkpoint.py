@@ -0,0 +1,33 @@
+"""activation checkpointing of residual block stacks"""
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint_sequential
+
+
+class CheckpointSequential(nn.Sequential):
+
+    def __init__(self, *args: nn.Module, segments: int = 0):
+        """`nn.Sequential` which recomputes activations of its modules in backward
+
+        modules are divided into `segments` segments by `torch.utils.checkpoint.checkpoint_sequential`,
+        only inputs of segments are kept for backward. indexing and keys of state_dict are the same as
+        `nn.Sequential`, so blocks can be hooked and saved models can be loaded with or without checkpointing
+
+        Args:
+            segments: number of checkpointed segments, `0` disables checkpointing, `len(self)` keeps the
+                      input of every module
+
+        Notes:
+            1. checkpointing is only applied when gradients are enabled
+            2. modules of checkpointed segments run again in backward: forward hooks are called again and
+               running statistics of BN layers in training mode are updated twice. BN layers whose
+               statistics must be kept(e.g. frozen BN of transfer learning) have to be in eval mode
+        """
+        super().__init__(*args)
+        self.segments = min(segments, len(self))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.segments <= 0 or not torch.is_grad_enabled():
+            return super().forward(x)
+
+        return checkpoint_sequential(self, self.segments, x, use_reentrant=False)
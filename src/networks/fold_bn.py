@@ -0,0 +1,130 @@
+"""fold BN layers with fixed statistics into adjacent convolutions"""
+import copy
+from typing import Optional
+
+import torch
+import torch.nn as nn
+
+from .wrn import BasicBlock as WRNBasicBlock
+from .parseval_wrn import ParsevalBasicBlock as ParsevalWRNBasicBlock
+from .parseval_resnet import ParsevalBasicBlock as ParsevalResnetBasicBlock
+from .adapter import merge_conv_adapters
+
+
+def _plain_conv(module: nn.Module) -> bool:
+    # convs with pre-hooks(e.g. spectral norm computes weight in a pre-hook) are kept as they are
+    return isinstance(module, nn.Conv2d) and not module._forward_pre_hooks
+
+
+def _foldable(conv: nn.Module, bn: nn.Module) -> bool:
+    return _plain_conv(conv) and isinstance(bn, nn.BatchNorm2d) and bn.running_var is not None and \
+        not bn._forward_pre_hooks
+
+
+@torch.no_grad()
+def _fold_conv_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> None:
+    """change `conv` in place so that `conv(x)` equals `bn(conv(x))` with running statistics"""
+    scale = torch.rsqrt(bn.running_var + bn.eps)
+    shift = -bn.running_mean * scale
+    if bn.affine:
+        scale = scale * bn.weight
+        shift = shift * bn.weight + bn.bias
+    if conv.bias is not None:
+        shift = shift + conv.bias * scale
+
+    conv.weight.mul_(scale.view(-1, 1, 1, 1))
+    conv.bias = nn.Parameter(shift, requires_grad=False)
+
+
+@torch.no_grad()
+def _scale_conv(conv: nn.Conv2d, scale: float) -> None:
+    conv.weight.mul_(scale)
+    if conv.bias is not None:
+        conv.bias.mul_(scale)
+
+
+def _fold_sequential(sequential: nn.Sequential) -> None:
+    for i in range(len(sequential) - 1):
+        if _foldable(sequential[i], sequential[i + 1]):
+            _fold_conv_bn(sequential[i], sequential[i + 1])
+            # indices of layers are kept, e.g. for `ResnetBlocks` and iterating blocks
+            sequential[i + 1] = nn.Identity()
+
+
+def _last_conv(sequential: nn.Sequential) -> Optional[nn.Conv2d]:
+    """conv whose outputs are outputs of `sequential`, i.e. only followed by `nn.Identity`"""
+    for module in reversed(sequential):
+        if not isinstance(module, nn.Identity):
+            return module if _plain_conv(module) else None
+    return None
+
+
+def _fold_wrn_block(block: nn.Module) -> None:
+    """pre-activation block: `bn2` follows `conv1`, `bn1` precedes an activation and is kept"""
+    if _foldable(block.conv1, block.bn2):
+        _fold_conv_bn(block.conv1, block.bn2)
+        block.bn2 = nn.Identity()
+
+    if isinstance(block, ParsevalWRNBasicBlock):
+        if _plain_conv(block.conv2):
+            _scale_conv(block.conv2, block.residual_scale)
+            block.residual_scale = 1.
+        if block.convShortcut is not None and _plain_conv(block.convShortcut):
+            _scale_conv(block.convShortcut, block.shortcut_scale)
+            block.shortcut_scale = 1.
+
+
+def _fold_resnet_block(block: ParsevalResnetBasicBlock) -> None:
+    """post-activation block: BN layers are already folded as parts of `residual_function` and `shortcut`"""
+    conv = _last_conv(block.residual_function)
+    if conv is not None:
+        _scale_conv(conv, block.residual_scale)
+        block.residual_scale = 1.
+    conv = _last_conv(block.shortcut)
+    if conv is not None:
+        _scale_conv(conv, block.shortcut_scale)
+        block.shortcut_scale = 1.
+
+
+def fold_bn(model: nn.Module) -> nn.Module:
+    """copy of `model` in eval mode with BN layers folded into convs, for frozen blocks and evaluation
+
+    low-rank adapters are merged into their convs first. BN layers that directly follow a conv(`conv1` and
+    `bn2` of wrn blocks, conv and BN pairs in `nn.Sequential` of resnet blocks and stems) are replaced by
+    `nn.Identity` and their running statistics are folded into weight and bias of the conv. the 0.5 residual
+    scaling of parseval blocks is folded into the last conv of each branch, only an identity shortcut keeps
+    its scaling
+
+    Notes:
+        1. outputs equal those of `model` in eval mode, the copy must not be trained and is not updated
+           with `model`, parameters of the copy do not require grad
+        2. `bn1` of pre-activation wrn blocks is followed by an activation and shared by both branches,
+           it can not be folded and is kept
+        3. convs and BN layers with forward pre-hooks(e.g. spectral norm) are kept as they are, forward
+           hooks(e.g. feature hooks of trainers) and stored outputs of forward are not copied
+    """
+    # outputs kept by forward(e.g. `_feature_representations` of wrn) are part of a graph and can not be copied
+    memo = {id(value): None for module in model.modules() for value in vars(module).values()
+            if isinstance(value, torch.Tensor) and value.grad_fn is not None}
+    forward_hooks = [(module, module._forward_hooks) for module in model.modules()]
+    for module, _ in forward_hooks:
+        module._forward_hooks = type(module._forward_hooks)()
+    try:
+        folded = copy.deepcopy(model, memo).eval()
+    finally:
+        for module, hooks in forward_hooks:
+            module._forward_hooks = hooks
+    merge_conv_adapters(folded)
+
+    for module in list(folded.modules()):
+        if isinstance(module, nn.Sequential):
+            _fold_sequential(module)
+        elif isinstance(module, (WRNBasicBlock, ParsevalWRNBasicBlock)):
+            _fold_wrn_block(module)
+    for module in folded.modules():
+        if isinstance(module, ParsevalResnetBasicBlock):
+            _fold_resnet_block(module)
+    for p in folded.parameters():
+        p.requires_grad = False
+
+    return folded
@@ -11,6 +11,7 @@
 import torch
 import torch.nn as nn
 from .resnet import BasicBlock
+from .checkpoint import CheckpointSequential
 
 
 class ParsevalBasicBlock(nn.Module):
@@ -39,9 +40,16 @@ class ParsevalBasicBlock(nn.Module):
                 nn.BatchNorm2d(out_channels * BasicBlock.expansion)
             )
 
+        # weights of convex combination of both branches, 1 once folded into convs by `fold_bn`
+        self.residual_scale = 0.5
+        self.shortcut_scale = 0.5
+
     def forward(self, x):
         # convex combination here
-        out = 0.5 * (self.residual_function(x) + self.shortcut(x))
+        out = self.residual_function(x)
+        if self.residual_scale != 1:
+            out = out * self.residual_scale
+        out = torch.add(out, self.shortcut(x), alpha=self.shortcut_scale)
         return nn.ReLU(inplace=True)(out)
 
     def __iter__(self):
@@ -52,14 +60,17 @@ class ParsevalResNet(nn.Module):
     # record current blocks
     current_block: int = 0
 
-    def __init__(self, k: int, num_block, num_classes=100):
+    def __init__(self, k: int, num_block, num_classes=100, checkpoint_segments=0):
         """
         Args:
             k: the last k blocks which will be retrained
+            checkpoint_segments: segments of activation checkpointing of every `conv*_x` layer,
+                                 see `CheckpointSequential`
         """
         super().__init__()
 
         self._k = k
+        self._checkpoint_segments = checkpoint_segments
         self.in_channels = 64
 
         self.conv1 = nn.Sequential(
@@ -107,7 +118,7 @@ class ParsevalResNet(nn.Module):
             layers.append(block(self.in_channels, out_channels, stride))
             self.in_channels = out_channels * block.expansion
 
-        return nn.Sequential(*layers)
+        return CheckpointSequential(*layers, segments=self._checkpoint_segments)
 
     def forward(self, x):
         output = self.conv1(x)
@@ -126,9 +137,9 @@ class ParsevalResNet(nn.Module):
         cls.current_block = 0
 
 
-def parseval_resnet18(k: int, num_classes: int = 100):
+def parseval_resnet18(k: int, num_classes: int = 100, checkpoint_segments: int = 0):
     """
     Args:
         k: the last k blocks which will be retrained
     """
-    return ParsevalResNet(k, [2, 2, 2, 2], num_classes=num_classes)
+    return ParsevalResNet(k, [2, 2, 2, 2], num_classes=num_classes, checkpoint_segments=checkpoint_segments)
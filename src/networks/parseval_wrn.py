@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from .wrn import BasicBlock
+from .checkpoint import CheckpointSequential
 
 
 class ParsevalBasicBlock(nn.Module):
@@ -20,6 +21,9 @@ class ParsevalBasicBlock(nn.Module):
         self.equalInOut = (in_planes == out_planes)
         self.convShortcut = (not self.equalInOut) and nn.Conv2d(in_planes, out_planes, kernel_size=1, stride=stride,
                                padding=0, bias=False) or None
+        # weights of convex combination of both branches, 1 once folded into convs by `fold_bn`
+        self.residual_scale = 0.5
+        self.shortcut_scale = 0.5
 
     def forward(self, x):
         if not self.equalInOut:
@@ -33,10 +37,11 @@ class ParsevalBasicBlock(nn.Module):
 
         # todo
         # convex combination
-        former_out = (x if self.equalInOut else self.convShortcut(x)) * 0.5
-        out = out * 0.5
+        former_out = x if self.equalInOut else self.convShortcut(x)
+        if self.residual_scale != 1:
+            out = out * self.residual_scale
 
-        return torch.add(former_out, out)
+        return torch.add(out, former_out, alpha=self.shortcut_scale)
         # return torch.add(x if self.equalInOut else self.convShortcut(x), out)
 
     def __iter__(self):
@@ -50,16 +55,17 @@ class ParsevalNetworkBlock(nn.Module):
     current_block: int = 0
     total_blocks: int = 0
 
-    def __init__(self, k: int, nb_layers, in_planes, out_planes, stride, dropRate=0.0):
+    def __init__(self, k: int, nb_layers, in_planes, out_planes, stride, dropRate=0.0, checkpoint_segments=0):
         """
         Args:
             k: the last k blocks which will be retrained
+            checkpoint_segments: segments of activation checkpointing, see `CheckpointSequential`
         """
         super(ParsevalNetworkBlock, self).__init__()
-        self.layer = self._make_layer(k, in_planes, out_planes, nb_layers, stride, dropRate)
+        self.layer = self._make_layer(k, in_planes, out_planes, nb_layers, stride, dropRate, checkpoint_segments)
 
     @classmethod
-    def _make_layer(cls, k: int, in_planes, out_planes, nb_layers, stride, dropRate):
+    def _make_layer(cls, k: int, in_planes, out_planes, nb_layers, stride, dropRate, checkpoint_segments=0):
         layers = []
         for i in range(int(nb_layers)):
             cls.current_block += 1
@@ -68,7 +74,7 @@ class ParsevalNetworkBlock(nn.Module):
             else:
                 block = BasicBlock
             layers.append(block(i == 0 and in_planes or out_planes, out_planes, i == 0 and stride or 1, dropRate))
-        return nn.Sequential(*layers)
+        return CheckpointSequential(*layers, segments=checkpoint_segments)
 
     def forward(self, x):
         return self.layer(x)
@@ -83,11 +89,13 @@ class ParsevalNetworkBlock(nn.Module):
 
 
 class ParsevalWideResNet(nn.Module):
-    def __init__(self, k: int, depth, num_classes, widen_factor=1, dropRate=0.0):
+    def __init__(self, k: int, depth, num_classes, widen_factor=1, dropRate=0.0, checkpoint_segments=0):
         """wide resnet for parseval training
 
         Args:
             k: the last k blocks which will be retrained
+            checkpoint_segments: segments of activation checkpointing of every network block,
+                                 see `CheckpointSequential`
         """
         super(ParsevalWideResNet, self).__init__()
         nChannels = [16, 16*widen_factor, 32*widen_factor, 64*widen_factor]
@@ -100,11 +108,11 @@ class ParsevalWideResNet(nn.Module):
         self.conv1 = nn.Conv2d(3, nChannels[0], kernel_size=3, stride=1,
                                padding=1, bias=False)
         # 1st block
-        self.block1 = ParsevalNetworkBlock(k, n, nChannels[0], nChannels[1], 1, dropRate)
+        self.block1 = ParsevalNetworkBlock(k, n, nChannels[0], nChannels[1], 1, dropRate, checkpoint_segments)
         # 2nd block
-        self.block2 = ParsevalNetworkBlock(k, n, nChannels[1], nChannels[2], 2, dropRate)
+        self.block2 = ParsevalNetworkBlock(k, n, nChannels[1], nChannels[2], 2, dropRate, checkpoint_segments)
         # 3rd block
-        self.block3 = ParsevalNetworkBlock(k, n, nChannels[2], nChannels[3], 2, dropRate)
+        self.block3 = ParsevalNetworkBlock(k, n, nChannels[2], nChannels[3], 2, dropRate, checkpoint_segments)
         ParsevalNetworkBlock.reset_current_block()
         # global average pooling and classifier
         self.bn1 = nn.BatchNorm2d(nChannels[3])
@@ -132,20 +140,20 @@ class ParsevalWideResNet(nn.Module):
         return self.fc(out)
 
 
-def parseval_retrain_wrn34_10(k: int, num_classes=10):
+def parseval_retrain_wrn34_10(k: int, num_classes=10, checkpoint_segments: int = 0):
     """
     Args:
         k: the last k blocks which will be retrained
     """
-    return ParsevalWideResNet(k, 34, num_classes, 10, 0)
+    return ParsevalWideResNet(k, 34, num_classes, 10, 0, checkpoint_segments)
 
-def parseval_retrain_wrn28_10(k: int, num_classes=10):
-    return ParsevalWideResNet(k, 28, num_classes, 10, 0)
+def parseval_retrain_wrn28_10(k: int, num_classes=10, checkpoint_segments: int = 0):
+    return ParsevalWideResNet(k, 28, num_classes, 10, 0, checkpoint_segments)
 
 
-def parseval_retrain_wrn28_4(k: int, num_classes=10):
-    return ParsevalWideResNet(k, 28, num_classes, 4, 0)
+def parseval_retrain_wrn28_4(k: int, num_classes=10, checkpoint_segments: int = 0):
+    return ParsevalWideResNet(k, 28, num_classes, 4, 0, checkpoint_segments)
 
 
-def parseval_normal_wrn34_10(num_classes=10):
-    return ParsevalWideResNet(17, 34, num_classes, 10, 0)
+def parseval_normal_wrn34_10(num_classes=10, checkpoint_segments: int = 0):
+    return ParsevalWideResNet(17, 34, num_classes, 10, 0, checkpoint_segments)
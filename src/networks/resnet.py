@@ -11,6 +11,8 @@
 import torch
 import torch.nn as nn
 
+from .checkpoint import CheckpointSequential
+
 
 class BasicBlock(nn.Module):
     """Basic Block for resnet 18 and resnet 34
@@ -84,10 +86,16 @@ class BottleNeck(nn.Module):
 
 class ResNet(nn.Module):
 
-    def __init__(self, block, num_block, num_classes=100):
+    def __init__(self, block, num_block, num_classes=100, checkpoint_segments=0):
+        """
+        Args:
+            checkpoint_segments: recompute activations of every `conv*_x` layer in backward with this
+                                 many segments, `0` keeps all activations, see `CheckpointSequential`
+        """
         super().__init__()
 
         self.in_channels = 64
+        self._checkpoint_segments = checkpoint_segments
 
         self.conv1 = nn.Sequential(
             nn.Conv2d(3, 64, kernel_size=3, padding=1, bias=False),
@@ -128,7 +136,7 @@ class ResNet(nn.Module):
             layers.append(block(self.in_channels, out_channels, stride))
             self.in_channels = out_channels * block.expansion
 
-        return nn.Sequential(*layers)
+        return CheckpointSequential(*layers, segments=self._checkpoint_segments)
 
     def forward(self, x):
         output = self.conv1(x)
@@ -150,31 +158,31 @@ class ResNet(nn.Module):
         raise AttributeError("can not obtain `feature representations` without input!")
 
 
-def resnet18(num_classes: int):
+def resnet18(num_classes: int, checkpoint_segments: int = 0):
     """ return a ResNet 18 object
     """
-    return ResNet(BasicBlock, [2, 2, 2, 2], num_classes=num_classes)
+    return ResNet(BasicBlock, [2, 2, 2, 2], num_classes=num_classes, checkpoint_segments=checkpoint_segments)
 
 
-def resnet34(num_classes: int):
+def resnet34(num_classes: int, checkpoint_segments: int = 0):
     """ return a ResNet 34 object
     """
-    return ResNet(BasicBlock, [3, 4, 6, 3], num_classes=num_classes)
+    return ResNet(BasicBlock, [3, 4, 6, 3], num_classes=num_classes, checkpoint_segments=checkpoint_segments)
 
 
-def resnet50(num_classes: int):
+def resnet50(num_classes: int, checkpoint_segments: int = 0):
     """ return a ResNet 50 object
     """
-    return ResNet(BottleNeck, [3, 4, 6, 3], num_classes=num_classes)
+    return ResNet(BottleNeck, [3, 4, 6, 3], num_classes=num_classes, checkpoint_segments=checkpoint_segments)
 
 
-def resnet101(num_classes: int):
+def resnet101(num_classes: int, checkpoint_segments: int = 0):
     """ return a ResNet 101 object
     """
-    return ResNet(BottleNeck, [3, 4, 23, 3], num_classes=num_classes)
+    return ResNet(BottleNeck, [3, 4, 23, 3], num_classes=num_classes, checkpoint_segments=checkpoint_segments)
 
 
-def resnet152(num_classes: int):
+def resnet152(num_classes: int, checkpoint_segments: int = 0):
     """ return a ResNet 152 object
     """
-    return ResNet(BottleNeck, [3, 8, 36, 3], num_classes=num_classes)
+    return ResNet(BottleNeck, [3, 8, 36, 3], num_classes=num_classes, checkpoint_segments=checkpoint_segments)
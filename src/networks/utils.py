@@ -1,6 +1,7 @@
 from typing import Union, List
 
 import torch
+import torch.nn.functional as F
 
 from .resnet import ResNet
 from .parseval_resnet import ParsevalResNet
@@ -9,6 +10,25 @@ from .parseval_wrn import ParsevalWideResNet
 from src.networks import SupportedWideResnetType, SupportedResnetType, SupportedAllModuleType
 
 
+def _forward_stacks(h: torch.Tensor, stacks: List[torch.nn.Sequential], start: int, end: int) -> torch.Tensor:
+    """run residual blocks `start`, ..., `end - 1` of `stacks`, blocks are numbered from 1 over all stacks
+
+    stacks run as a whole are called directly, so that they keep their own forward(e.g. checkpointing)
+    """
+    first = 1
+    for stack in stacks:
+        last = first + len(stack) - 1
+        low, high = max(start, first), min(end - 1, last)
+        if low == first and high == last:
+            h = stack(h)
+        else:
+            for i in range(low, high + 1):
+                h = stack[i - first](h)
+        first = last + 1
+
+    return h
+
+
 class WRN34Block:
     """divide wrn34 model into 17 blocks,
     details can be found in paper `ADVERSARIALLY ROBUST TRANSFER LEARNING`"""
@@ -39,7 +59,7 @@ class WRN34Block:
 
 class WRNBlocks:
     """
-        Divide WRN into blocks. (WRN D-W: D = 4 + n * 6)
+        Divide WRN into blocks and run ranges of them. (WRN D-W: D = 4 + n * 6)
              [conv 16]
                 |
         [conv160, conv160] * n
@@ -76,12 +96,34 @@ class WRNBlocks:
     def get_total_blocks(self) -> int:
         return self._total_blocks
 
+    def forward_prefix(self, x: torch.Tensor, upto: int) -> torch.Tensor:
+        """input of block `upto`, i.e. `x` passed through first conv layer and blocks before `upto`"""
+        return self._forward_blocks(self._model.conv1(x), 1, upto)
+
+    def forward_suffix(self, h: torch.Tensor, from_: int) -> torch.Tensor:
+        """outputs of model, `h` is input of block `from_`"""
+        return self._forward_blocks(h, from_, self._total_blocks + 1)
+
+    def _forward_blocks(self, h: torch.Tensor, start: int, end: int) -> torch.Tensor:
+        if not 1 <= start <= end <= self._total_blocks + 1:
+            raise ValueError(f"unexpected block range: [{start}, {end})")
+        stacks = [getattr(self._model, f"block{i}").layer for i in range(1, 4)]
+        h = _forward_stacks(h, stacks, start, end)
+        # average pooling is part of 'bn' block, input of 'fc' block is flattened
+        if start <= self._total_blocks - 1 < end:
+            h = F.avg_pool2d(self._model.relu(self._model.bn1(h)), 8).view(-1, self._model.nChannels)
+        if start <= self._total_blocks < end:
+            h = self._model.fc(h)
+
+        return h
+
     def _set_block(self):
         for i in range(1, self._total_blocks + 1):
             setattr(self, f"block{i}", self.get_block(i))
 
 
 class ResnetBlocks:
+    """divide ResNet into residual blocks and 'fc' block, and run ranges of them"""
 
     def __init__(self, model: SupportedAllModuleType) -> None:
         self.model = model
@@ -113,6 +155,27 @@ class ResnetBlocks:
         else:
             raise ValueError(f"unexpected block number: {num}")
 
+    def forward_prefix(self, x: torch.Tensor, upto: int) -> torch.Tensor:
+        """input of block `upto`, i.e. `x` passed through first conv layer and blocks before `upto`"""
+        return self._forward_blocks(self.model.conv1(x), 1, upto)
+
+    def forward_suffix(self, h: torch.Tensor, from_: int) -> torch.Tensor:
+        """outputs of model, `h` is input of block `from_`"""
+        return self._forward_blocks(h, from_, self._total_blocks + 1)
+
+    def _forward_blocks(self, h: torch.Tensor, start: int, end: int) -> torch.Tensor:
+        if not 1 <= start <= end <= self._total_blocks + 1:
+            raise ValueError(f"unexpected block range: [{start}, {end})")
+        stacks = [getattr(self.model, f"conv{i}_x") for i in range(2, 6)]
+        h = _forward_stacks(h, stacks, start, end)
+        # average pooling follows the last residual block, input of 'fc' block is flattened
+        if start <= self._total_blocks - 1 < end:
+            h = self.model.avg_pool(h).view(h.size(0), -1)
+        if start <= self._total_blocks < end:
+            h = self.model.fc(h)
+
+        return h
+
     def _set_block_attr(self):
         for i in range(1, self._total_blocks+1):
             setattr(self, f"block{i}", self.get_block(i))
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from .checkpoint import CheckpointSequential
+
 
 class BasicBlock(nn.Module):
     def __init__(self, in_planes, out_planes, stride, dropRate=0.0):
@@ -35,19 +37,24 @@ class BasicBlock(nn.Module):
         )
 
 class NetworkBlock(nn.Module):
-    def __init__(self, nb_layers, in_planes, out_planes, block, stride, dropRate=0.0):
+    def __init__(self, nb_layers, in_planes, out_planes, block, stride, dropRate=0.0, checkpoint_segments=0):
         super(NetworkBlock, self).__init__()
-        self.layer = self._make_layer(block, in_planes, out_planes, nb_layers, stride, dropRate)
-    def _make_layer(self, block, in_planes, out_planes, nb_layers, stride, dropRate):
+        self.layer = self._make_layer(block, in_planes, out_planes, nb_layers, stride, dropRate, checkpoint_segments)
+    def _make_layer(self, block, in_planes, out_planes, nb_layers, stride, dropRate, checkpoint_segments=0):
         layers = []
         for i in range(int(nb_layers)):
             layers.append(block(i == 0 and in_planes or out_planes, out_planes, i == 0 and stride or 1, dropRate))
-        return nn.Sequential(*layers)
+        return CheckpointSequential(*layers, segments=checkpoint_segments)
     def forward(self, x):
         return self.layer(x)
 
 class WideResNet(nn.Module):
-    def __init__(self, depth, num_classes, widen_factor=1, dropRate=0.0):
+    def __init__(self, depth, num_classes, widen_factor=1, dropRate=0.0, checkpoint_segments=0):
+        """
+        Args:
+            checkpoint_segments: recompute activations of every network block in backward with this many
+                                 segments, `0` keeps all activations, see `CheckpointSequential`
+        """
         super(WideResNet, self).__init__()
         nChannels = [16, 16*widen_factor, 32*widen_factor, 64*widen_factor]
         assert((depth - 4) % 6 == 0)
@@ -57,11 +64,11 @@ class WideResNet(nn.Module):
         self.conv1 = nn.Conv2d(3, nChannels[0], kernel_size=3, stride=1,
                                padding=1, bias=False)
         # 1st block
-        self.block1 = NetworkBlock(n, nChannels[0], nChannels[1], block, 1, dropRate)
+        self.block1 = NetworkBlock(n, nChannels[0], nChannels[1], block, 1, dropRate, checkpoint_segments)
         # 2nd block
-        self.block2 = NetworkBlock(n, nChannels[1], nChannels[2], block, 2, dropRate)
+        self.block2 = NetworkBlock(n, nChannels[1], nChannels[2], block, 2, dropRate, checkpoint_segments)
         # 3rd block
-        self.block3 = NetworkBlock(n, nChannels[2], nChannels[3], block, 2, dropRate)
+        self.block3 = NetworkBlock(n, nChannels[2], nChannels[3], block, 2, dropRate, checkpoint_segments)
         # global average pooling and classifier
         self.bn1 = nn.BatchNorm2d(nChannels[3])
         self.relu = nn.LeakyReLU(negative_slope=0.1)
@@ -98,14 +105,14 @@ class WideResNet(nn.Module):
         raise AttributeError("can not obtain `feature representations` without input!")
 
 
-def wrn34_10(num_classes=10):
-    return WideResNet(34, num_classes, 10, 0)
+def wrn34_10(num_classes=10, checkpoint_segments: int = 0):
+    return WideResNet(34, num_classes, 10, 0, checkpoint_segments)
 
-def wrn28_10(num_classes=10):
-    return WideResNet(28, num_classes, 10, 0)
+def wrn28_10(num_classes=10, checkpoint_segments: int = 0):
+    return WideResNet(28, num_classes, 10, 0, checkpoint_segments)
 
-def wrn34_4(num_classes: int):
-    return WideResNet(34, num_classes, 4, 0)
+def wrn34_4(num_classes: int, checkpoint_segments: int = 0):
+    return WideResNet(34, num_classes, 4, 0, checkpoint_segments)
 
-def wrn28_4(num_classes: int):
-    return WideResNet(28, num_classes, 4, 0)
\ No newline at end of file
+def wrn28_4(num_classes: int, checkpoint_segments: int = 0):
+    return WideResNet(28, num_classes, 4, 0, checkpoint_segments)
\ No newline at end of file
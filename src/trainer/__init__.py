@@ -1,9 +1,12 @@
 from .base_trainer import BaseTrainer
-from .adv_trainer import ADVTrainer
+from .attack_schedule import AttackSchedule, LinearRampSchedule, PlateauSchedule
+from .stopping_policy import PlateauStopping
+from .adv_trainer import ADVTrainer, AccumulatedADVTrainer, FastADVTrainer, FreeADVTrainer
 from .normal_trainer import NormalTrainer
 from .transfer_learning_trainer import (TransferLearningTrainer, ParsevalTransferLearningTrainer,
                                         LWFTransferLearningTrainer, SpectralNormTransferLearningTrainer,
-                                        BNTransferLearningTrainer)
+                                        BNTransferLearningTrainer, AdapterTransferLearningTrainer,
+                                        MultiVariantTLRunner)
 from .retrain_trainer import RetrainTrainer
 from .robust_plus_regularization_trainer import (RobustPlusAllRegularizationTrainer,
                                                  RobustPlusSingularRegularizationTrainer,
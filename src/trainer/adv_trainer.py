@@ -1,18 +1,32 @@
 from typing import Dict
 import time
+import math
+import os
 
 import torch
 from torch.utils.data import DataLoader
 
 from .base_trainer import BaseTrainer
+from .attack_schedule import AttackSchedule
+from src import settings
+from src.attack import attack_context, LinfPGDAttack
 from src.networks import SupportedAllModuleType
-from src.utils import logger
+from src.utils import (logger, clamp, get_indexed_dataloader, split_held_out_dataloader, PerturbationStore,
+                       MetricsAccumulator, get_checkpoint_writer, AsyncEvaluator)
 
 
 class BaseADVTrainer(BaseTrainer):
     def __init__(self, model: SupportedAllModuleType, train_loader: DataLoader,
                  test_loader: DataLoader, attacker, params: Dict,
-                 checkpoint_path: str = None):
+                 checkpoint_path: str = None, attack_schedule: AttackSchedule = None):
+        """
+        Args:
+            attack_schedule: adjust strength of attacker before every epoch, `None` keeps it fixed
+        """
+        # state of schedule is loaded along with checkpoint
+        self.attack_schedule = attack_schedule
+        # average train loss of last epoch, passed to `attack_schedule`
+        self._last_loss = None
         super().__init__(model, train_loader, test_loader, checkpoint_path)
         self.attacker = self._init_attacker(attacker, params)
 
@@ -28,56 +42,121 @@ class BaseADVTrainer(BaseTrainer):
         logger.info(f"start lr: {self.current_lr}")
         logger.info(f"best robustness: {best_robustness}")
 
+        evaluator = AsyncEvaluator(self.model, self._test_loader, settings.fold_eval_bn) \
+            if settings.async_eval else None
+
         for ep in range(start_epoch, self._train_epochs + 1):
+            if self._stopping.finished(ep):
+                break
 
-            self._adjust_lr(ep)
+            self._adjust_lr(self._stopping.lr_epoch(ep))
+            if self.attack_schedule is not None:
+                self.attack_schedule(self.attacker, ep, self._last_loss)
 
             # show current learning rate
             logger.debug(f"lr: {self.current_lr}")
 
-            training_acc, running_loss = 0, .0
+            self._metrics = MetricsAccumulator()
             start_time = time.perf_counter()
+            self.attacker.gradient_evaluations = 0
 
-            for index, data in enumerate(self._train_loader):
-                batch_running_loss, batch_training_acc = self.step_batch(data[0], data[1])
+            for index, data in enumerate(self._train_batches(ep)):
+                # index-returning loaders also pass sample indices to `step_batch`
+                batch_running_loss, batch_training_acc = self._accumulate_step_batch(self.step_batch, *data)
 
-                training_acc += batch_training_acc
-                running_loss += batch_running_loss
+                self._metrics.update(loss=batch_running_loss, train_acc=batch_training_acc)
 
-                # warm up learning rate
-                if ep <= self._warm_up_epochs:
-                    self.warm_up_scheduler.step()
+                self._step_warm_up(ep)
 
                 if index % batch_number == batch_number - 1:
                     end_time = time.perf_counter()
 
-                    acc = self.test()
-                    average_train_loss = (running_loss / batch_number)
-                    average_train_accuracy = training_acc / batch_number
+                    # `None` if not evaluated in this epoch, or evaluated asynchronously
+                    acc = None
+                    if ep % settings.eval_every == 0 or self._stopping.lr_epoch(ep) >= self._train_epochs:
+                        if evaluator is not None:
+                            evaluator.submit(ep, self._model_state_dict())
+                        else:
+                            with self._profiler.phase("eval"):
+                                acc = self.test()
+                    epoch_metrics = self._metrics.averages()
+                    average_train_loss = epoch_metrics["loss"]
+                    average_train_accuracy = epoch_metrics["train_acc"]
                     epoch_cost_time = end_time - start_time
 
                     logger.info(
                         f"epoch: {ep}   loss: {average_train_loss:.6f}   train accuracy: {average_train_accuracy}   "
                         f"test accuracy: {acc}   time: {epoch_cost_time:.2f}s")
-
+                    # attack compute spent in this epoch, trainers without tensorboard only log it
+                    logger.info(f"attack steps: {self.attacker.num_steps}   "
+                                f"attack gradient evaluations: {self.attacker.gradient_evaluations}")
+                    if hasattr(self, "summary_writer"):
+                        self.summary_writer.add_scalar("attack steps", self.attacker.num_steps, ep)
+                        self.summary_writer.add_scalar("attack gradient evaluations",
+                                                       self.attacker.gradient_evaluations, ep)
+                    self._last_loss = average_train_loss
+
+                    if acc is not None:
+                        self._record_test_accuracy(save_path, ep, acc, best_robustness)
+                    self._stopping.update(ep, average_train_accuracy)
                     if best_robustness < average_train_accuracy:
                         best_robustness = average_train_accuracy
                         logger.info(f"better robustness: {best_robustness}")
                         logger.info(f"corresponding accuracy on test set: {acc}")
                         self._save_model(f"{save_path}-best_robust")
 
+            if evaluator is not None:
+                for eval_ep, eval_acc, eval_state_dict in evaluator.poll():
+                    self._record_test_accuracy(save_path, eval_ep, eval_acc, best_robustness, eval_state_dict)
+
+            self._on_epoch_end(ep)
+            self._profiler.end_epoch(ep, getattr(self, "summary_writer", None))
             self._save_checkpoint(ep, best_robustness)
 
+        if evaluator is not None:
+            for eval_ep, eval_acc, eval_state_dict in evaluator.poll(block=True):
+                self._record_test_accuracy(save_path, eval_ep, eval_acc, best_robustness, eval_state_dict)
+            evaluator.close()
+
+        get_checkpoint_writer().wait()
+        self._profiler.dump(f"{save_path}_profile.json")
         logger.info("finished training")
         logger.info(f"best robustness on test set: {best_robustness}")
 
         self._save_last_model(f"{save_path}-last") # imTyrant added it for saving last model.
 
+    def _record_test_accuracy(self, save_path, ep, acc, best_acc, state_dict=None):
+        """robust trainers stop and keep best model by robustness, test accuracy is only written"""
+        self._write_test_accuracy(ep, acc, state_dict is not None)
+        return best_acc
+
+    def _checkpoint_state(self):
+        return {
+            **super()._checkpoint_state(),
+            "attack_schedule": self.attack_schedule.state_dict() if self.attack_schedule is not None else None,
+            "last_loss": self._last_loss
+        }
+
+    def _load_checkpoint_state(self, checkpoint):
+        super()._load_checkpoint_state(checkpoint)
+        if self.attack_schedule is not None and checkpoint.get("attack_schedule") is not None:
+            self.attack_schedule.load_state_dict(checkpoint["attack_schedule"])
+        self._last_loss = checkpoint.get("last_loss")
+
+    def _step_warm_up(self, ep):
+        """warm up learning rate, called after every batch of epoch `ep`"""
+        if ep <= self._warm_up_epochs:
+            self.warm_up_scheduler.step()
+
+    def _on_epoch_end(self, ep):
+        """called after each epoch is finished and before the checkpoint is saved"""
+        pass
+
 class ADVTrainer(BaseADVTrainer):
     def __init__(self, model: SupportedAllModuleType, train_loader: DataLoader,
                  test_loader: DataLoader, attacker, params: Dict,
-                 checkpoint_path: str = None):
-        super().__init__(model, train_loader, test_loader, attacker, params, checkpoint_path)
+                 checkpoint_path: str = None, attack_schedule: AttackSchedule = None):
+        super().__init__(model, train_loader, test_loader, attacker, params, checkpoint_path, attack_schedule)
 
     def _init_attacker(self, attacker, params):
         attacker = attacker(self.model, **params)
@@ -86,44 +165,291 @@ class ADVTrainer(BaseADVTrainer):
         return attacker
 
     def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor):
-        inputs, labels = inputs.to(self._device), labels.to(self._device)
+        with self._profiler.phase("h2d"):
+            inputs, labels = inputs.to(self._device), labels.to(self._device)
+
+        with self._profiler.phase("attack"):
+            adv_inputs = self._gen_adv(inputs, labels)
 
-        self._freeze_all_layers()
-        adv_inputs = self._gen_adv(inputs, labels)
-        self._unfreeze_all_layers()
-        
-        outputs = self.model(adv_inputs)
-        loss = self.criterion(outputs, labels)
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        with self._profiler.phase("forward"):
+            outputs = self._train_forward(adv_inputs)
+            loss = self.criterion(outputs, labels)
+        self._zero_grad()
+        with self._profiler.phase("backward"):
+            (loss * self._micro_batch_weight).backward()
+        with self._profiler.phase("optimizer"):
+            self._step_optimizer()
 
-        batch_training_acc = (outputs.argmax(dim=1) == labels).float().mean().item()
-        batch_running_loss = loss.item()
+        batch_training_acc = (outputs.argmax(dim=1) == labels).float().mean()
+        batch_running_loss = loss.detach()
 
         return batch_running_loss, batch_training_acc
 
     def _gen_adv(self, inputs: torch.Tensor, labels: torch.Tensor):
-        self.model.eval()
-
-        adv_inputs = self.attacker.calc_perturbation(inputs, labels)
+        # parameters are untouched by the attack, only gradients w.r.t. inputs are computed
+        with attack_context(self.model):
+            adv_inputs = self.attacker.calc_perturbation(inputs, labels)
         adv_inputs = adv_inputs.to(self._device)
 
-        self.model.train()
+        return adv_inputs
+
+
+class AccumulatedADVTrainer(ADVTrainer):
+    def __init__(self, model: SupportedAllModuleType, train_loader: DataLoader,
+                 test_loader: DataLoader, attacker, params: Dict,
+                 memmap_path: str = None, checkpoint_path: str = None, attack_schedule: AttackSchedule = None):
+        """adversarial training with perturbations accumulated across epochs
+
+        perturbation of every training sample is kept in a `PerturbationStore` indexed by sample index,
+        pgd of next epoch starts from it instead of a random one, so fewer `num_steps` are needed for
+        the same strength. samples seen for the first time start from random perturbation as usual
+
+        Notes:
+            1. train loader is rebuilt by `get_indexed_dataloader` to get sample indices
+            2. perturbations are saved along with checkpoint to `{checkpoint_path}.delta`
+            3. perturbations are stored in coordinates of augmented inputs, they are only
+               approximately aligned when random crop or flip is used
+
+        Args:
+            memmap_path: keep perturbations in memory-mapped file instead of a float16 tensor in host memory
+        """
+        sample_shape = tuple(train_loader.dataset[0][0].shape)
+        self._perturbation_store = PerturbationStore(len(train_loader.dataset), sample_shape, memmap_path)
+        super().__init__(model, train_loader, test_loader, attacker, params, checkpoint_path, attack_schedule)
+
+    def _init_dataloader(self, train_loader, test_loader) -> None:
+        super()._init_dataloader(get_indexed_dataloader(train_loader), test_loader)
+
+    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor, indices: torch.Tensor = None):
+        with self._profiler.phase("h2d"):
+            inputs, labels = inputs.to(self._device), labels.to(self._device)
+
+        with self._profiler.phase("attack"):
+            adv_inputs = self._gen_adv(inputs, labels, indices)
+
+        with self._profiler.phase("forward"):
+            outputs = self._train_forward(adv_inputs)
+            loss = self.criterion(outputs, labels)
+        self._zero_grad()
+        with self._profiler.phase("backward"):
+            (loss * self._micro_batch_weight).backward()
+        with self._profiler.phase("optimizer"):
+            self._step_optimizer()
+
+        batch_training_acc = (outputs.argmax(dim=1) == labels).float().mean()
+        batch_running_loss = loss.detach()
+
+        return batch_running_loss, batch_training_acc
+
+    def _gen_adv(self, inputs: torch.Tensor, labels: torch.Tensor, indices: torch.Tensor = None):
+        if indices is None:
+            return super()._gen_adv(inputs, labels)
+
+        delta, initialized = self._perturbation_store.get(indices, self._device)
+        random_delta = self.attacker.random_delta(torch.zeros_like(inputs))
+        init_delta = torch.where(initialized.view(-1, *([1] * (inputs.dim() - 1))), delta, random_delta)
+
+        with attack_context(self.model):
+            adv_inputs = self.attacker.calc_perturbation(inputs, labels, init_delta=init_delta)
+        adv_inputs = adv_inputs.to(self._device)
+        self._perturbation_store.set(indices, adv_inputs - inputs)
 
         return adv_inputs
-    
-    def _unfreeze_all_layers(self):
-        for p in self.model.parameters():
-            p.requires_grad = True
 
-        # logger.debug(f"all parameters of model are unfreezed")
+    def _save_checkpoint(self, current_epoch, best_acc):
+        super()._save_checkpoint(current_epoch, best_acc)
+        self._perturbation_store.save(f"{self._checkpoint_path}.delta")
+
+    def _load_from_checkpoint(self, checkpoint_path: str) -> None:
+        super()._load_from_checkpoint(checkpoint_path)
+        if os.path.exists(f"{checkpoint_path}.delta"):
+            self._perturbation_store.load(f"{checkpoint_path}.delta")
+            logger.info(f"loaded perturbations from '{checkpoint_path}.delta'")
 
-    def _freeze_all_layers(self):
-        for p in self.model.parameters():
-            p.requires_grad = False
 
-        # logger.debug(f"all parameters of model are freezed")
+class FastADVTrainer(ADVTrainer):
+    def __init__(self, model: SupportedAllModuleType, train_loader: DataLoader,
+                 test_loader: DataLoader, attacker, params: Dict, pgd_params: Dict,
+                 check_batches: int = 4, check_steps: int = 10, overfit_threshold: float = 0.2,
+                 pgd_epochs: int = 1, check_loader: DataLoader = None, checkpoint_path: str = None):
+        """adversarial training with single step attack(e.g. `LinfFGSMAttack`), https://arxiv.org/abs/2001.03994
+
+        after every epoch, robust accuracy against a cheap PGD attack is evaluated on the first
+        `check_batches` batches of a held-out slice. once it drops more than `overfit_threshold` below
+        the best one seen(catastrophic overfitting), the following `pgd_epochs` epochs are trained
+        with `LinfPGDAttack` built from `pgd_params`, then single step attack is used again
+
+        Notes:
+            1. test data is never used by the check, if `check_loader` is not given, a fixed slice of
+               `check_batches` batches is split off the training set and is not trained on
+            2. remaining pgd epochs and best check accuracy are saved along with checkpoint
+
+        Args:
+            params: parameters of single step `attacker`
+            pgd_params: parameters of `LinfPGDAttack`, used for both pgd epochs and the check.
+                        `num_steps` of the check is replaced with `check_steps`
+            check_loader: held-out data of the check
+        """
+        self._pgd_params = pgd_params
+        self._check_loader = check_loader
+        self._check_batches = check_batches
+        self._check_steps = check_steps
+        self._overfit_threshold = overfit_threshold
+        self._pgd_epochs = pgd_epochs
+        # number of remaining epochs trained with pgd attack
+        self._remaining_pgd_epochs = 0
+        self._best_check_acc = 0.
+        super().__init__(model, train_loader, test_loader, attacker, params, checkpoint_path)
+
+    def _init_dataloader(self, train_loader, test_loader) -> None:
+        if self._check_loader is None:
+            train_loader, self._check_loader = split_held_out_dataloader(
+                train_loader, self._check_batches * train_loader.batch_size)
+        super()._init_dataloader(train_loader, test_loader)
+
+    def _init_attacker(self, attacker, params):
+        self._single_step_attacker = super()._init_attacker(attacker, params)
+        self._pgd_attacker = super()._init_attacker(LinfPGDAttack, self._pgd_params)
+        check_params = {**self._pgd_params, "num_steps": self._check_steps}
+        self._check_attacker = LinfPGDAttack(self.model, early_stop=True, **check_params)
+
+        # a resumed run may be in pgd epochs
+        return self._pgd_attacker if self._remaining_pgd_epochs > 0 else self._single_step_attacker
+
+    def _checkpoint_state(self):
+        return {
+            **super()._checkpoint_state(),
+            "remaining_pgd_epochs": self._remaining_pgd_epochs,
+            "best_check_acc": self._best_check_acc
+        }
+
+    def _load_checkpoint_state(self, checkpoint):
+        super()._load_checkpoint_state(checkpoint)
+        self._remaining_pgd_epochs = checkpoint.get("remaining_pgd_epochs", 0)
+        self._best_check_acc = checkpoint.get("best_check_acc", 0.)
+
+    def _on_epoch_end(self, ep):
+        check_acc = self._robustness_check()
+        logger.info(f"pgd-{self._check_steps} accuracy on {self._check_batches} held-out batches: {check_acc}")
+        if hasattr(self, "summary_writer"):
+            self.summary_writer.add_scalar("pgd check accuracy", check_acc, ep)
+
+        if self._remaining_pgd_epochs > 0:
+            self._remaining_pgd_epochs -= 1
+        elif self._best_check_acc - check_acc > self._overfit_threshold:
+            logger.warning(f"catastrophic overfitting detected at epoch {ep}, "
+                           f"switch to pgd attack for {self._pgd_epochs} epochs")
+            self._remaining_pgd_epochs = self._pgd_epochs
+        self._best_check_acc = max(self._best_check_acc, check_acc)
+
+        self.attacker = self._pgd_attacker if self._remaining_pgd_epochs > 0 else self._single_step_attacker
+        logger.debug(f"attack of next epoch: {type(self.attacker).__name__}")
+
+    def _robustness_check(self) -> float:
+        correct, total = torch.zeros((), device=self._device), 0
+        for index, (inputs, labels) in enumerate(self._check_loader):
+            if index >= self._check_batches:
+                break
+            inputs, labels = inputs.to(self._device), labels.to(self._device)
+            with attack_context(self.model):
+                adv_inputs = self._check_attacker.calc_perturbation(inputs, labels)
+                with torch.no_grad():
+                    correct += (self.model(adv_inputs).argmax(dim=1) == labels).sum()
+            total += labels.shape[0]
+
+        return correct.item() / total
+
+    def print_parameters(self) -> None:
+        super().print_parameters()
+        logger.info(f"pgd check: {self._check_batches} batches, {self._check_steps} steps, "
+                    f"overfit threshold: {self._overfit_threshold}, pgd epochs: {self._pgd_epochs}")
+
+
+class FreeADVTrainer(BaseADVTrainer):
+    def __init__(self, model: SupportedAllModuleType, train_loader: DataLoader,
+                 test_loader: DataLoader, attacker, params: Dict,
+                 replay_times: int = 8, checkpoint_path: str = None):
+        """adversarial training for free, https://arxiv.org/abs/1904.12843
+
+        every minibatch is replayed `replay_times` times, each replay uses one backward pass to update
+        both the model weights and the perturbation, which is kept across minibatches.
+
+        Notes:
+            1. `settings.train_epochs`, `settings.warm_up_epochs` and `settings.milestones` are counted in
+               replayed passes, so the trainer runs `ceil(train_epochs / replay_times)` epochs and the cost
+               of whole training is close to natural training. learning rate is warmed up per replay over
+               `warm_up_epochs * len(train_loader)` replays
+            2. only `epsilon` and the clip range of attacker are used, the step size of perturbation is `epsilon`
+            3. every replay steps the optimizer, so batches are not split by `settings.micro_batch_size`
+
+        Args:
+            replay_times: number of times each minibatch is replayed(`m` in the paper)
+        """
+        self._replay_times = replay_times
+        self._delta = None
+        # whether current epoch contains warm-up replays, see `_step_warm_up`
+        self._warming_up = False
+        super().__init__(model, train_loader, test_loader, attacker, params, checkpoint_path)
+
+    def _init_attacker(self, attacker, params):
+        attacker = attacker(self.model, **params)
+        attacker.print_parameters()
+
+        return attacker
+
+    def _init_hyperparameters(self):
+        super()._init_hyperparameters()
+        self._train_epochs = math.ceil(self._train_epochs / self._replay_times)
+        self._init_stopping_policy([math.ceil(milestone / self._replay_times) for milestone in settings.milestones])
+
+    def _adjust_lr(self, ep):
+        # map epoch to the first replayed pass it contains
+        super()._adjust_lr((ep - 1) * self._replay_times + 1)
+        self._warming_up = (ep - 1) * self._replay_times < self._warm_up_epochs
+
+    def _step_warm_up(self, ep):
+        # warm-up is stepped per replay in `step_batch`
+        pass
+
+    def _accumulate_step_batch(self, step_batch, *args, optimizers=None):
+        return step_batch(*args)
+
+    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor):
+        with self._profiler.phase("h2d"):
+            inputs, labels = inputs.to(self._device), labels.to(self._device)
+        batch_size = inputs.shape[0]
+
+        if self._delta is None or self._delta.shape[0] < batch_size:
+            self._delta = torch.zeros_like(inputs)
+
+        running_loss, training_acc = torch.zeros((), device=self._device), torch.zeros((), device=self._device)
+        for _ in range(self._replay_times):
+            delta = self._delta[:batch_size].clone().requires_grad_(True)
+            adv_inputs = clamp(inputs + delta, self.attacker.min, self.attacker.max)
+
+            with self._profiler.phase("forward"):
+                outputs = self._train_forward(adv_inputs)
+                loss = self.criterion(outputs, labels)
+            self.optimizer.zero_grad()
+            # gradients of weights and perturbation come from the same backward pass
+            with self._profiler.phase("backward"):
+                loss.backward()
+            with self._profiler.phase("optimizer"):
+                self.optimizer.step()
+            if self._warming_up and self.warm_up_scheduler.last_epoch < self.warm_up_scheduler.total_iters:
+                self.warm_up_scheduler.step()
+
+            self._delta[:batch_size] = clamp(delta.detach() + self.attacker.epsilon * delta.grad.sign(),
+                                             -self.attacker.epsilon, self.attacker.epsilon)
+
+            training_acc += (outputs.argmax(dim=1) == labels).float().mean()
+            running_loss += loss.detach()
+
+        return running_loss / self._replay_times, training_acc / self._replay_times
+
+    def print_parameters(self) -> None:
+        super().print_parameters()
+        logger.info(f"replay times: {self._replay_times}")
 
 
 # fixme
@@ -0,0 +1,102 @@
+"""schedules of attack strength used by adversarial trainers"""
+from typing import Dict, Optional
+
+from src.utils import logger
+
+
+class AttackSchedule:
+
+    def __init__(self, start_steps: int, end_steps: int):
+        """adjust `num_steps` of attacker before every epoch
+
+        `step_size` is enlarged with fewer steps to keep `num_steps * step_size` unchanged,
+        so that the epsilon ball can still be reached
+
+        Args:
+            start_steps: number of steps of the first epoch
+            end_steps: max number of steps, usually `num_steps` of the attacker
+        """
+        self.start_steps = start_steps
+        self.end_steps = end_steps
+        self._base_step_size = None
+
+    def num_steps(self, ep: int, last_loss: Optional[float]) -> int:
+        raise NotImplementedError("must overwrite method `num_steps`")
+
+    def __call__(self, attacker, ep: int, last_loss: Optional[float] = None) -> None:
+        """called at the beginning of epoch `ep`, `last_loss` is the average train loss of last epoch"""
+        if self._base_step_size is None:
+            self._base_step_size = attacker.step_size
+
+        num_steps = self.num_steps(ep, last_loss)
+        attacker.num_steps = num_steps
+        attacker.step_size = self._base_step_size * self.end_steps / num_steps
+        logger.debug(f"attack steps of epoch {ep}: {num_steps}")
+
+    def state_dict(self) -> Dict:
+        return {"base_step_size": self._base_step_size}
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        self._base_step_size = state_dict["base_step_size"]
+
+
+class LinearRampSchedule(AttackSchedule):
+
+    def __init__(self, start_steps: int, end_steps: int, ramp_epochs: int):
+        """increase steps linearly from `start_steps` to `end_steps` in the first `ramp_epochs` epochs"""
+        super().__init__(start_steps, end_steps)
+        self.ramp_epochs = ramp_epochs
+
+    def num_steps(self, ep: int, last_loss: Optional[float]) -> int:
+        if ep >= self.ramp_epochs:
+            return self.end_steps
+        progress = (ep - 1) / max(self.ramp_epochs - 1, 1)
+        return round(self.start_steps + progress * (self.end_steps - self.start_steps))
+
+
+class PlateauSchedule(AttackSchedule):
+
+    def __init__(self, start_steps: int, end_steps: int, patience: int = 2,
+                 increment: int = 1, threshold: float = 1e-2):
+        """add `increment` steps once train loss has not decreased by `threshold`(relative) for `patience` epochs"""
+        super().__init__(start_steps, end_steps)
+        self.patience = patience
+        self.increment = increment
+        self.threshold = threshold
+
+        self._current_steps = start_steps
+        self._best_loss = float("inf")
+        self._bad_epochs = 0
+
+    def num_steps(self, ep: int, last_loss: Optional[float]) -> int:
+        if last_loss is None:
+            return self._current_steps
+
+        if last_loss < self._best_loss * (1 - self.threshold):
+            self._best_loss = last_loss
+            self._bad_epochs = 0
+        else:
+            self._bad_epochs += 1
+
+        if self._bad_epochs >= self.patience and self._current_steps < self.end_steps:
+            self._current_steps = min(self._current_steps + self.increment, self.end_steps)
+            # loss of stronger attack is not comparable with former ones
+            self._best_loss = float("inf")
+            self._bad_epochs = 0
+
+        return self._current_steps
+
+    def state_dict(self) -> Dict:
+        return {
+            **super().state_dict(),
+            "current_steps": self._current_steps,
+            "best_loss": self._best_loss,
+            "bad_epochs": self._bad_epochs,
+        }
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        super().load_state_dict(state_dict)
+        self._current_steps = state_dict["current_steps"]
+        self._best_loss = state_dict["best_loss"]
+        self._bad_epochs = state_dict["bad_epochs"]
+        logger.info(f"loaded attack schedule state: {self._current_steps} steps")
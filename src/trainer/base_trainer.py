@@ -1,16 +1,23 @@
 import os
+import math
+import contextlib
 import time
 import json
-from typing import Tuple
+from typing import Callable, Dict, Iterable, Tuple
 
 import torch
 from torch import optim
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
 from src import settings
-from src.utils import WarmUpLR, evaluate_accuracy, logger
-from src.networks import SupportedAllModuleType
+from src.utils import WarmUpLR, evaluate_accuracy, logger, MetricsAccumulator, get_checkpoint_writer, StepProfiler, \
+    DevicePrefetcher, AsyncEvaluator
+from src.utils import (init_distributed, is_distributed, is_main_process, get_local_rank, get_distributed_dataloader,
+                       distribute_module)
+from src.networks import SupportedAllModuleType, fold_bn
+from .stopping_policy import PlateauStopping
 
 
 class BaseTrainer:
@@ -46,21 +53,25 @@ class BaseTrainer:
         logger.info(f"start lr: {self.current_lr}")
         logger.info(f"best accuracy: {best_acc}")
 
+        evaluator = AsyncEvaluator(self.model, self._test_loader, settings.fold_eval_bn) \
+            if settings.async_eval else None
+
         for ep in range(start_epoch, self._train_epochs + 1):
+            if self._stopping.finished(ep):
+                break
 
-            self._adjust_lr(ep)
+            self._adjust_lr(self._stopping.lr_epoch(ep))
 
             # show current learning rate
             logger.debug(f"lr: {self.current_lr}")
 
-            training_acc, running_loss = 0, .0
+            self._metrics = MetricsAccumulator()
             start_time = time.perf_counter()
 
-            for index, data in enumerate(self._train_loader):
-                batch_running_loss, batch_training_acc = self.step_batch(data[0], data[1])
+            for index, data in enumerate(self._train_batches(ep)):
+                batch_running_loss, batch_training_acc = self._accumulate_step_batch(self.step_batch, data[0], data[1])
 
-                training_acc += batch_training_acc
-                running_loss += batch_running_loss
+                self._metrics.update(loss=batch_running_loss, train_acc=batch_training_acc)
 
                 # warm up learning rate
                 if ep <= self._warm_up_epochs:
@@ -69,29 +80,48 @@ class BaseTrainer:
                 if index % batch_number == batch_number - 1:
                     end_time = time.perf_counter()
 
-                    acc = self.test()
-                    average_train_loss = (running_loss / batch_number)
-                    average_train_accuracy = training_acc / batch_number
+                    # `None` if not evaluated in this epoch, or evaluated asynchronously
+                    acc = None
+                    if ep % settings.eval_every == 0 or self._stopping.lr_epoch(ep) >= self._train_epochs:
+                        if evaluator is not None:
+                            evaluator.submit(ep, self._model_state_dict())
+                        else:
+                            with self._profiler.phase("eval"):
+                                acc = self.test()
+                    epoch_metrics = self._metrics.averages()
+                    average_train_loss = epoch_metrics["loss"]
+                    average_train_accuracy = epoch_metrics["train_acc"]
                     epoch_cost_time = end_time - start_time
 
-                    # write loss, time, test_acc, train_acc to tensorboard
+                    # write loss, time, train_acc to tensorboard
                     if hasattr(self, "summary_writer"):
                         self.summary_writer: SummaryWriter
                         self.summary_writer.add_scalar("train loss", average_train_loss, ep)
                         self.summary_writer.add_scalar("train accuracy", average_train_accuracy, ep)
-                        self.summary_writer.add_scalar("test accuracy", acc, ep)
                         self.summary_writer.add_scalar("time per epoch", epoch_cost_time, ep)
 
                     logger.info(
                         f"epoch: {ep}   loss: {average_train_loss:.6f}   train accuracy: {average_train_accuracy}   "
                         f"test accuracy: {acc}   time: {epoch_cost_time:.2f}s")
 
-                    if best_acc < acc:
-                        best_acc = acc
-                        self._save_best_model(save_path, ep, acc)
+                    if acc is not None:
+                        best_acc = self._record_test_accuracy(save_path, ep, acc, best_acc)
+
+            if evaluator is not None:
+                # results of earlier epochs, weights of the evaluated epoch are saved if it is the best
+                for eval_ep, eval_acc, eval_state_dict in evaluator.poll():
+                    best_acc = self._record_test_accuracy(save_path, eval_ep, eval_acc, best_acc, eval_state_dict)
 
+            self._profiler.end_epoch(ep, getattr(self, "summary_writer", None))
             self._save_checkpoint(ep, best_acc)
 
+        if evaluator is not None:
+            for eval_ep, eval_acc, eval_state_dict in evaluator.poll(block=True):
+                best_acc = self._record_test_accuracy(save_path, eval_ep, eval_acc, best_acc, eval_state_dict)
+            evaluator.close()
+
+        get_checkpoint_writer().wait()
+        self._profiler.dump(f"{save_path}_profile.json")
         logger.info("finished training")
         logger.info(f"best accuracy on test set: {best_acc}")
 
@@ -99,13 +129,108 @@ class BaseTrainer:
         # imTyrant changed the '_save_model' to '_save_last_model'
         self._save_last_model(f"{save_path}-last")
 
-    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor) -> Tuple[float, float]:
+    def _train_batches(self, ep):
+        """batches of train loader in epoch `ep`, copied to device one batch ahead if `settings.prefetch_to_device`"""
+        if is_distributed():
+            # reshuffle shards every epoch
+            self._train_loader.sampler.set_epoch(ep)
+
+        train_loader = self._train_loader
+        if settings.prefetch_to_device:
+            train_loader = DevicePrefetcher(train_loader, self._device)
+
+        return self._profiler.iterate(train_loader)
+
+    def _accumulate_step_batch(self, step_batch: Callable, *args, optimizers: Iterable[optim.Optimizer] = None):
+        """run `step_batch` on micro-batches of `settings.micro_batch_size` and step optimizers once
+
+        `step_batch` scales its loss by the share of the micro-batch in the batch(`self._micro_batch_weight`)
+        before `backward`, so losses averaged over samples give the gradients of the whole batch. regularizers
+        summed over samples must be divided by `self._micro_batch_weight`. tensors returned by `step_batch`
+        are combined with the same weights. `self._zero_grad` and `self._step_optimizer` of `optimizers` are
+        skipped in `step_batch`, they are called once around the micro-batches here
+
+        Args:
+            step_batch: step function, tensor arguments with batch dimension are split
+            optimizers: optimizers that step once per batch, default `self.optimizer`
+        """
+        batch_size = args[1].shape[0]
+        micro_batch_size = settings.micro_batch_size
+        if not micro_batch_size or micro_batch_size >= batch_size:
+            return step_batch(*args)
+
+        optimizers = list(optimizers) if optimizers is not None else [self.optimizer]
+        for optimizer in optimizers:
+            optimizer.zero_grad()
+
+        micro_batches = list(zip(*[arg.split(micro_batch_size) if isinstance(arg, torch.Tensor) and arg.dim() > 0
+                                   and arg.shape[0] == batch_size else [arg] * math.ceil(batch_size / micro_batch_size)
+                                   for arg in args]))
+        results = None
+        self._accumulated_optimizers = optimizers
+        try:
+            for i, micro_args in enumerate(micro_batches):
+                self._micro_batch_weight = micro_args[1].shape[0] / batch_size
+                # in distributed training, gradients are averaged over ranks once, in backward of the last micro-batch
+                sync = not is_distributed() or i == len(micro_batches) - 1
+                with contextlib.nullcontext() if sync else self._distributed_model().no_sync():
+                    micro_results = step_batch(*micro_args)
+
+                if not isinstance(micro_results, tuple):
+                    micro_results = (micro_results,)
+                weighted = [self._micro_batch_weight * result for result in micro_results]
+                results = weighted if results is None else [a + b for a, b in zip(results, weighted)]
+        finally:
+            self._micro_batch_weight = 1.
+            self._accumulated_optimizers = []
+
+        for optimizer in optimizers:
+            optimizer.step()
+
+        return tuple(results) if len(results) > 1 else results[0]
+
+    def _forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        """outputs of model on a train batch"""
+        return self.model(inputs)
+
+    def _train_forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        """`self._forward` in `step_batch`, run by `DistributedDataParallel` in distributed training so that
+        gradients are averaged over ranks in backward"""
+        if not is_distributed():
+            return self._forward(inputs)
+        return self._distributed_model()(inputs)
+
+    def _distributed_model(self) -> DistributedDataParallel:
+        """`DistributedDataParallel` of `self._forward`, built on first use, after subclasses have frozen
+        layers or changed the model(e.g. added adapters or spectral norm)"""
+        if self._distributed_forward is None:
+            self._distributed_forward = distribute_module(self.model, self._device, self._forward)
+        return self._distributed_forward
+
+    def _zero_grad(self, optimizer: optim.Optimizer = None) -> None:
+        """`zero_grad` of `optimizer`(default `self.optimizer`) in `step_batch`, unless its gradients are accumulated"""
+        optimizer = optimizer if optimizer is not None else self.optimizer
+        if all(optimizer is not accumulated for accumulated in self._accumulated_optimizers):
+            optimizer.zero_grad()
+
+    def _step_optimizer(self, optimizer: optim.Optimizer = None) -> None:
+        """`step` of `optimizer`(default `self.optimizer`) in `step_batch`, unless its gradients are accumulated"""
+        optimizer = optimizer if optimizer is not None else self.optimizer
+        if all(optimizer is not accumulated for accumulated in self._accumulated_optimizers):
+            optimizer.step()
+
+    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         raise NotImplementedError("must overwrite method `step_epoch`")
 
     def test(self):
-        return evaluate_accuracy(self.model, self._test_loader, self._device)
+        # modes of `self.model` are kept if a folded copy is evaluated
+        model = fold_bn(self.model) if settings.fold_eval_bn else self.model
+        return evaluate_accuracy(model, self._test_loader, self._device)
 
     def _init_dataloader(self, train_loader, test_loader) -> None:
+        if is_distributed():
+            # every rank evaluates the whole test set
+            train_loader = get_distributed_dataloader(train_loader)
         self._test_loader = test_loader
         self._train_loader = train_loader
 
@@ -129,7 +254,25 @@ class BaseTrainer:
         self._batch_size = settings.batch_size
         self._train_epochs = settings.train_epochs
         self._warm_up_epochs = settings.warm_up_epochs
+        # share of current micro-batch in its batch and optimizers stepped once per batch,
+        # see `_accumulate_step_batch`
+        self._micro_batch_weight = 1.
+        self._accumulated_optimizers = []
+        # see `_distributed_model`
+        self._distributed_forward = None
+        if settings.parallelism:
+            init_distributed()
         self._device = torch.device(settings.device if torch.cuda.is_available() else "cpu")
+        if is_distributed() and self._device.type == "cuda":
+            # one device per process
+            self._device = torch.device("cuda", get_local_rank())
+        self._profiler = StepProfiler(self._device, enabled=settings.profile_steps)
+        self._init_stopping_policy(settings.milestones)
+
+    def _init_stopping_policy(self, milestones):
+        """`milestones` are lr milestones in epochs of training loop"""
+        self._stopping = PlateauStopping(settings.stop_patience, milestones, self._train_epochs,
+                                         threshold=settings.stop_threshold, skip_milestones=settings.skip_milestones)
 
     def _init_criterion(self):
         self.criterion = getattr(torch.nn, settings.criterion)()
@@ -148,17 +291,42 @@ class BaseTrainer:
 
         logger.info(f"training parameters: \n{params_str}")
 
-    def _save_best_model(self, save_path, current_epochs, accuracy):
-        """save best model with current info"""
+    def _record_test_accuracy(self, save_path, ep, acc, best_acc, state_dict=None):
+        """write test accuracy of epoch `ep` and save best model, return best accuracy
+
+        `state_dict` is weights of epoch `ep` if it is evaluated asynchronously, `None` for current model
+        """
+        self._write_test_accuracy(ep, acc, state_dict is not None)
+        self._stopping.update(ep, acc)
+
+        if best_acc < acc:
+            best_acc = acc
+            self._save_best_model(save_path, ep, acc, state_dict)
+
+        return best_acc
+
+    def _write_test_accuracy(self, ep, acc, asynchronous=False):
+        if asynchronous:
+            logger.info(f"epoch: {ep}   test accuracy: {acc}   (evaluated asynchronously)")
+        if hasattr(self, "summary_writer"):
+            self.summary_writer.add_scalar("test accuracy", acc, ep)
+
+    def _save_best_model(self, save_path, current_epochs, accuracy, state_dict=None):
+        """save best model with current info, `state_dict` is saved instead of current model if given"""
         info = {
             "current_epochs": current_epochs,
             "total_epochs": self._train_epochs,
             "best_accuracy": accuracy
         }
+        if not is_main_process():
+            return
         suffix = save_path.split("/")[-1]
         with open(os.path.join(os.path.dirname(save_path), f"{suffix}_info.json"), "w", encoding="utf8") as f:
             json.dump(info, f)
-        self._save_model(f"{save_path}-best")
+        if state_dict is None:
+            self._save_model(f"{save_path}-best")
+        else:
+            torch.save(state_dict, f"{save_path}-best")
 
     # Added by imTyrant.
     # Used for saving the latest model. I added it for 'SpectralNormTransferLearningTrainer'.
@@ -166,7 +334,16 @@ class BaseTrainer:
         self._save_model(save_path)
 
     def _save_model(self, save_path: str):
-        torch.save(self.model.state_dict(), save_path)
+        if not is_main_process():
+            return
+        torch.save(self._model_state_dict(), save_path)
+
+    def _model_state_dict(self):
+        """model weights written to checkpoints and saved models"""
+        return self.model.state_dict()
+
+    def _load_model_state_dict(self, state_dict) -> None:
+        self.model.load_state_dict(state_dict)
 
     def _adjust_lr(self, ep):
         if ep > self._warm_up_epochs:
@@ -185,31 +362,48 @@ class BaseTrainer:
         return self.optimizer.param_groups[0].get('lr')
 
     def _save_checkpoint(self, current_epoch, best_acc):
-        model_weights = self.model.state_dict()
+        model_weights = self._model_state_dict()
         optimizer = self.optimizer.state_dict()
 
-        torch.save({
+        # state is copied to cpu here and serialized in background
+        get_checkpoint_writer().save({
             "model_weights": model_weights,
             "optimizer": optimizer,
             "current_epoch": current_epoch,
-            "best_acc": best_acc
+            "best_acc": best_acc,
+            "stopping": self._stopping.state_dict(),
+            **self._checkpoint_state()
         }, f"{self._checkpoint_path}")
 
         # Added by imTyrant
         # For saving 'numpy' and 'torch' random state.
         if hasattr(settings, "save_rand_state") and settings.save_rand_state:
             from src.utils import RandStateSnapshooter
-            RandStateSnapshooter.lazy_take(f"{self._checkpoint_path}.rand")
+            from src.utils.checkpoint_writer import pickle_dump
+            get_checkpoint_writer().save(RandStateSnapshooter.take_snapshot(),
+                                         f"{self._checkpoint_path}.rand", pickle_dump)
             logger.debug(f"random state is saved to '{self._checkpoint_path}.rand'")
 
+    def _checkpoint_state(self) -> Dict:
+        """other training state written to checkpoints, e.g. state of attack schedules"""
+        return {}
+
+    def _load_checkpoint_state(self, checkpoint: Dict) -> None:
+        """restore state of `_checkpoint_state` from `checkpoint`, keys may be missing in older checkpoints"""
+        pass
+
     # fixme
     def _load_from_checkpoint(self, checkpoint_path: str) -> None:
         logger.warning("trainer that needed reset blocks may not support load from checkpoint!")
         checkpoint = torch.load(checkpoint_path)
-        self.model.load_state_dict(checkpoint.get("model_weights"))
+        self._load_model_state_dict(checkpoint.get("model_weights"))
         self.optimizer.load_state_dict(checkpoint.get("optimizer"))
         start_epoch = checkpoint.get("current_epoch") + 1
         best_acc = checkpoint.get("best_acc")
+        # checkpoints written before stopping policy was added have no state
+        if checkpoint.get("stopping") is not None:
+            self._stopping.load_state_dict(checkpoint["stopping"])
+        self._load_checkpoint_state(checkpoint)
 
         self.start_epoch = start_epoch
         self.best_acc = best_acc
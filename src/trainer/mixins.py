@@ -1,11 +1,18 @@
 from src import settings
-from src.utils import logger
+from src.utils import logger, is_main_process
 
 import os
 
 from torch.utils.tensorboard import SummaryWriter
 
 
+class _NullSummaryWriter:
+    """stands in for `SummaryWriter` on other ranks than rank 0, all methods are no-op"""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
 class InitializeTensorboardMixin:
     """provide some useful function in tensorboard"""
 
@@ -18,6 +25,8 @@ class InitializeTensorboardMixin:
             log_dir: specify log_dir of SummaryWriter, if the value if None,
                      it will be specified as `{settings.tensorboard_log_dir}/{filename of checkpoint path}`
         """
+        if not is_main_process():
+            return _NullSummaryWriter()
         if not log_dir:
             checkpoint_name = os.path.splitext(self._checkpoint_path.split("/")[-1])[0]
             log_dir = settings.tensorboard_log_dir / checkpoint_name
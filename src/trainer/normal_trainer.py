@@ -12,16 +12,20 @@ class NormalTrainer(BaseTrainer):
                  test_loader: DataLoader, checkpoint_path: str = None):
         super().__init__(model, train_loader, test_loader, checkpoint_path)
 
-    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor) -> Tuple[float, float]:
-        inputs, labels = inputs.to(self._device), labels.to(self._device)
-        self.optimizer.zero_grad()
-
-        outputs = self.model(inputs)
-        loss = self.criterion(outputs, labels)
-        loss.backward()
-        self.optimizer.step()
-
-        batch_training_acc = (outputs.argmax(dim=1) == labels).float().mean().item()
-        batch_running_loss = loss.item()
+    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        with self._profiler.phase("h2d"):
+            inputs, labels = inputs.to(self._device), labels.to(self._device)
+        self._zero_grad()
+
+        with self._profiler.phase("forward"):
+            outputs = self._train_forward(inputs)
+            loss = self.criterion(outputs, labels)
+        with self._profiler.phase("backward"):
+            (loss * self._micro_batch_weight).backward()
+        with self._profiler.phase("optimizer"):
+            self._step_optimizer()
+
+        batch_training_acc = (outputs.argmax(dim=1) == labels).float().mean()
+        batch_running_loss = loss.detach()
 
         return batch_running_loss, batch_training_acc
@@ -35,20 +35,25 @@ class ParsevalRetrainTrainer(RetrainTrainer, ParsevalConstrainMixin):
         logger.debug(f"beta: {beta}")
         self._beta = beta
 
-    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor) -> Tuple[float, float]:
-        inputs, labels = inputs.to(self._device), labels.to(self._device)
-        self.optimizer.zero_grad()
+    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        with self._profiler.phase("h2d"):
+            inputs, labels = inputs.to(self._device), labels.to(self._device)
+        self._zero_grad()
 
-        outputs = self.model(inputs)
+        with self._profiler.phase("forward"):
+            outputs = self._train_forward(inputs)
 
-        constrain_term = self.sum_layers_constrain()
+        with self._profiler.phase("regularizer"):
+            constrain_term = self.sum_layers_constrain()
         # logger.debug(f"batch constrain: {constrain_term}")
         loss = self.criterion(outputs, labels) + (self._beta / 2) * constrain_term
-        loss.backward()
-        self.optimizer.step()
+        with self._profiler.phase("backward"):
+            (loss * self._micro_batch_weight).backward()
+        with self._profiler.phase("optimizer"):
+            self._step_optimizer()
 
-        batch_training_acc = (outputs.argmax(dim=1) == labels).float().mean().item()
-        batch_running_loss = loss.item()
+        batch_training_acc = (outputs.argmax(dim=1) == labels).float().mean()
+        batch_running_loss = loss.detach()
 
         return batch_running_loss, batch_training_acc
 
@@ -24,22 +24,29 @@ class RobustPlusAllRegularizationTrainer(ADVTrainer, InitializeTensorboardMixin)
         self.summary_writer = self.init_writer()
 
     def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor):
-        inputs, labels = inputs.to(self._device), labels.to(self._device)
-
-        adv_inputs = self._gen_adv(inputs, labels)
-        adv_outputs = self.model(adv_inputs)
-        clean_outputs = self.model(inputs)
-
-        regularization_term = self._calculate_regularization()
+        with self._profiler.phase("h2d"):
+            inputs, labels = inputs.to(self._device), labels.to(self._device)
+
+        with self._profiler.phase("attack"):
+            adv_inputs = self._gen_adv(inputs, labels)
+        with self._profiler.phase("forward"):
+            adv_outputs = self._train_forward(adv_inputs)
+            clean_outputs = self._train_forward(inputs)
+
+        with self._profiler.phase("regularizer"):
+            # summed over samples of whole batch when micro-batching
+            regularization_term = self._calculate_regularization() / self._micro_batch_weight
         l_term = self.criterion(adv_outputs, labels)
         loss = l_term + self._lambda * regularization_term
 
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self._zero_grad()
+        with self._profiler.phase("backward"):
+            (loss * self._micro_batch_weight).backward()
+        with self._profiler.phase("optimizer"):
+            self._step_optimizer()
 
-        batch_training_acc = (clean_outputs.argmax(dim=1) == labels).float().mean().item()
-        batch_running_loss = loss.item()
+        batch_training_acc = (clean_outputs.argmax(dim=1) == labels).float().mean()
+        batch_running_loss = loss.detach()
 
         return batch_running_loss, batch_training_acc
 
@@ -8,7 +8,7 @@ import numpy as np
 
 from ..adv_trainer import ADVTrainer
 from ..mixins import InitializeTensorboardMixin
-from src.utils import logger
+from src.utils import logger, MetricsAccumulator, get_checkpoint_writer
 from src.networks import SupportedAllModuleType, make_blocks
 
 class RobustPlusFeatureMatchingTrainer(ADVTrainer, InitializeTensorboardMixin):
@@ -24,15 +24,15 @@ class RobustPlusFeatureMatchingTrainer(ADVTrainer, InitializeTensorboardMixin):
         self.summary_writer = self.init_writer()
 
     def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor):
-        inputs, labels = inputs.to(self._device), labels.to(self._device)
+        with self._profiler.phase("h2d"):
+            inputs, labels = inputs.to(self._device), labels.to(self._device)
 
-        # here we freeze parameters for speedup
-        self._freeze_trainable_parameters()
-        adv_inputs = self._gen_adv(inputs.detach().clone(), labels)
-        self._unfreeze_trainable_parameters()
+        with self._profiler.phase("attack"):
+            adv_inputs = self._gen_adv(inputs.detach().clone(), labels)
 
-        adv_outputs = self.model(adv_inputs)
-        clean_outputs = self.model(inputs)
+        with self._profiler.phase("forward"):
+            adv_outputs = self._train_forward(adv_inputs)
+            clean_outputs = self._train_forward(inputs)
 
         r_adv = self._hooked_features_list[0] #type:torch.Tensor
         r_clean = self._hooked_features_list[1] #type:torch.Tensor
@@ -40,7 +40,8 @@ class RobustPlusFeatureMatchingTrainer(ADVTrainer, InitializeTensorboardMixin):
         # The regularization term is
         #           || E(f_k(x)) - E(f_k(x') ||^2_2.
         # The idea is from feature matching.
-        regularization_term = (r_adv.mean(dim=0) - r_clean.mean(dim=0)).flatten().norm(p=2) ** 2 
+        with self._profiler.phase("regularizer"):
+            regularization_term = (r_adv.mean(dim=0) - r_clean.mean(dim=0)).flatten().norm(p=2) ** 2 
 
         self._hooked_features_list.clear()
 
@@ -48,16 +49,17 @@ class RobustPlusFeatureMatchingTrainer(ADVTrainer, InitializeTensorboardMixin):
 
         loss = l_term + regularization_term * self._lambda
 
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self._zero_grad()
+        with self._profiler.phase("backward"):
+            (loss * self._micro_batch_weight).backward()
+        with self._profiler.phase("optimizer"):
+            self._step_optimizer()
 
-        batch_training_acc = (clean_outputs.argmax(dim=1) == labels).float().mean().item()
-        batch_robust_acc = (adv_outputs.argmax(dim=1) == labels).float().mean().item()
-        self._robust_acc += batch_robust_acc
-        batch_running_loss = loss.item()
+        batch_training_acc = (clean_outputs.argmax(dim=1) == labels).float().mean()
+        batch_robust_acc = (adv_outputs.argmax(dim=1) == labels).float().mean()
+        batch_running_loss = loss.detach()
 
-        return batch_running_loss, batch_training_acc, regularization_term.item(), l_term.item()
+        return batch_running_loss, batch_training_acc, regularization_term.detach(), l_term.detach(), batch_robust_acc
 
     def train(self, save_path):
         batch_number = len(self._train_loader)
@@ -69,25 +71,25 @@ class RobustPlusFeatureMatchingTrainer(ADVTrainer, InitializeTensorboardMixin):
         logger.info(f"best robustness: {best_robustness}")
 
         for ep in range(start_epoch, self._train_epochs + 1):
-            self._adjust_lr(ep)
+            if self._stopping.finished(ep):
+                break
+            self._adjust_lr(self._stopping.lr_epoch(ep))
 
             # show current learning rate
             logger.debug(f"lr: {self.current_lr}")
 
-            training_acc, running_loss = 0, .0
-            reg_loss, ce_loss = 0., 0.
-            # record current robustness
-            self._robust_acc = 0
+            # record losses, accuracy and robustness
+            self._metrics = MetricsAccumulator()
 
             start_time = time.perf_counter()
 
-            for index, data in enumerate(self._train_loader):
-                batch_running_loss, batch_training_acc, batch_reg_loss, batch_ce_loss = self.step_batch(data[0], data[1])
+            for index, data in enumerate(self._train_batches(ep)):
+                # robust accuracy is weighted by micro-batch size like loss and accuracy
+                batch_running_loss, batch_training_acc, batch_reg_loss, batch_ce_loss, batch_robust_acc = \
+                    self._accumulate_step_batch(self.step_batch, data[0], data[1])
 
-                training_acc += batch_training_acc
-                running_loss += batch_running_loss
-                reg_loss += batch_reg_loss
-                ce_loss += batch_ce_loss
+                self._metrics.update(loss=batch_running_loss, train_acc=batch_training_acc,
+                                     reg_loss=batch_reg_loss, ce_loss=batch_ce_loss, robust_acc=batch_robust_acc)
 
                 # warm up learning rate
                 if ep <= self._warm_up_epochs:
@@ -96,17 +98,19 @@ class RobustPlusFeatureMatchingTrainer(ADVTrainer, InitializeTensorboardMixin):
                 if index % batch_number == batch_number - 1:
                     end_time = time.perf_counter()
 
-                    acc = self.test()
-                    average_train_loss = (running_loss / batch_number)
-                    average_train_accuracy = training_acc / batch_number
-                    average_robust_accuracy = self._robust_acc / batch_number
+                    with self._profiler.phase("eval"):
+                        acc = self.test()
+                    epoch_metrics = self._metrics.averages()
+                    average_train_loss = epoch_metrics["loss"]
+                    average_train_accuracy = epoch_metrics["train_acc"]
+                    average_robust_accuracy = epoch_metrics["robust_acc"]
                     epoch_cost_time = end_time - start_time
 
                     # write loss, time, test_acc, train_acc to tensorboard
                     if hasattr(self, "summary_writer"):
                         self.summary_writer.add_scalar("train loss", average_train_loss, ep)
-                        self.summary_writer.add_scalar("reg loss", reg_loss / batch_number, ep)
-                        self.summary_writer.add_scalar("CE loss", ce_loss / batch_number, ep)
+                        self.summary_writer.add_scalar("reg loss", epoch_metrics["reg_loss"], ep)
+                        self.summary_writer.add_scalar("CE loss", epoch_metrics["ce_loss"], ep)
                         self.summary_writer.add_scalar("train accuracy", average_train_accuracy, ep)
                         self.summary_writer.add_scalar("test accuracy", acc, ep)
                         self.summary_writer.add_scalar("time per epoch", epoch_cost_time, ep)
@@ -117,14 +121,18 @@ class RobustPlusFeatureMatchingTrainer(ADVTrainer, InitializeTensorboardMixin):
                         f"test accuracy: {acc}   robust accuracy: {average_robust_accuracy}   "
                         f"time: {epoch_cost_time:.2f}s")
 
+                    self._stopping.update(ep, average_robust_accuracy)
                     if best_robustness < average_robust_accuracy:
                         best_robustness = average_robust_accuracy
                         logger.info(f"better robustness: {best_robustness}")
                         logger.info(f"corresponding accuracy on test set: {acc}")
                         self._save_model(f"{save_path}-best_robust")
 
+            self._profiler.end_epoch(ep, getattr(self, "summary_writer", None))
             self._save_checkpoint(ep, best_robustness)
 
+        get_checkpoint_writer().wait()
+        self._profiler.dump(f"{save_path}_profile.json")
         logger.info("finished training")
         logger.info(f"best robustness on test set: {best_robustness}")
 
@@ -154,11 +162,3 @@ class RobustPlusFeatureMatchingTrainer(ADVTrainer, InitializeTensorboardMixin):
     def _get_layer_inputs(self, layer, inputs, outputs):
         if self.model.training:
             self._hooked_features_list.append(inputs[0].clone())
-    
-    def _freeze_trainable_parameters(self):
-        for p in self.model.parameters():
-            p.requires_grad = False
-    
-    def _unfreeze_trainable_parameters(self):
-        for p in self.model.parameters():
-            p.requires_grad = True
@@ -8,7 +8,7 @@ import numpy as np
 
 from ..adv_trainer import ADVTrainer
 from ..mixins import InitializeTensorboardMixin
-from src.utils import logger
+from src.utils import logger, MetricsAccumulator, get_checkpoint_writer
 from src.networks import SupportedAllModuleType, make_blocks
 from src.utils.spectral_norm import spectral_norm, remove_spectral_norm
 
@@ -40,24 +40,27 @@ class RobustPlusSpectrumNormTrainer(ADVTrainer, InitializeTensorboardMixin):
         self.summary_writer = self.init_writer()
 
     def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor):
-        inputs, labels = inputs.to(self._device), labels.to(self._device)
+        with self._profiler.phase("h2d"):
+            inputs, labels = inputs.to(self._device), labels.to(self._device)
 
-        self._freeze_all_layers()
-        adv_inputs = self._gen_adv(inputs, labels)
-        self._unfreeze_all_layers()
+        with self._profiler.phase("attack"):
+            adv_inputs = self._gen_adv(inputs, labels)
 
-        adv_outputs = self.model(adv_inputs) #type:torch.Tensor
+        with self._profiler.phase("forward"):
+            adv_outputs = self._train_forward(adv_inputs) #type:torch.Tensor
 
         loss = self.criterion(adv_outputs, labels) #type:torch.Tensor
 
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self._zero_grad()
+        with self._profiler.phase("backward"):
+            (loss * self._micro_batch_weight).backward()
+        with self._profiler.phase("optimizer"):
+            self._step_optimizer()
 
-        self._robust_acc += (adv_outputs.argmax(dim=1) == labels).float().mean().item()
-        batch_running_loss = loss.item()
+        batch_robust_acc = (adv_outputs.argmax(dim=1) == labels).float().mean()
+        batch_running_loss = loss.detach()
 
-        return batch_running_loss
+        return batch_running_loss, batch_robust_acc
 
     def train(self, save_path):
         batch_number = len(self._train_loader)
@@ -69,21 +72,23 @@ class RobustPlusSpectrumNormTrainer(ADVTrainer, InitializeTensorboardMixin):
         logger.info(f"best robustness: {best_robustness}")
 
         for ep in range(start_epoch, self._train_epochs + 1):
-            self._adjust_lr(ep)
+            if self._stopping.finished(ep):
+                break
+            self._adjust_lr(self._stopping.lr_epoch(ep))
 
             # show current learning rate
             logger.debug(f"lr: {self.current_lr}")
 
-            running_loss = 0.0
-            # record current robustness
-            self._robust_acc = 0
+            # record loss and robustness
+            self._metrics = MetricsAccumulator()
 
             start_time = time.perf_counter()
 
-            for index, data in enumerate(self._train_loader):
-                batch_running_loss = self.step_batch(data[0], data[1])
+            for index, data in enumerate(self._train_batches(ep)):
+                # robust accuracy is weighted by micro-batch size like loss
+                batch_running_loss, batch_robust_acc = self._accumulate_step_batch(self.step_batch, data[0], data[1])
 
-                running_loss += batch_running_loss
+                self._metrics.update(loss=batch_running_loss, robust_acc=batch_robust_acc)
 
                 # warm up learning rate
                 if ep <= self._warm_up_epochs:
@@ -92,9 +97,11 @@ class RobustPlusSpectrumNormTrainer(ADVTrainer, InitializeTensorboardMixin):
                 if index % batch_number == batch_number - 1:
                     end_time = time.perf_counter()
 
-                    acc = self.test()
-                    average_train_loss = (running_loss / batch_number)
-                    average_robust_accuracy = self._robust_acc / batch_number
+                    with self._profiler.phase("eval"):
+                        acc = self.test()
+                    epoch_metrics = self._metrics.averages()
+                    average_train_loss = epoch_metrics["loss"]
+                    average_robust_accuracy = epoch_metrics["robust_acc"]
                     epoch_cost_time = end_time - start_time
 
                     # write loss, time, test_acc, train_acc to tensorboard
@@ -109,14 +116,18 @@ class RobustPlusSpectrumNormTrainer(ADVTrainer, InitializeTensorboardMixin):
                         f"test accuracy: {acc}   robust accuracy: {average_robust_accuracy}   "
                         f"time: {epoch_cost_time:.2f}s")
 
+                    self._stopping.update(ep, average_robust_accuracy)
                     if best_robustness < average_robust_accuracy:
                         best_robustness = average_robust_accuracy
                         logger.info(f"better robustness: {best_robustness}")
                         logger.info(f"corresponding accuracy on test set: {acc}")
                         self._save_model(f"{save_path}-best_robust")
 
+            self._profiler.end_epoch(ep, getattr(self, "summary_writer", None))
             self._save_checkpoint(ep, best_robustness)
 
+        get_checkpoint_writer().wait()
+        self._profiler.dump(f"{save_path}_profile.json")
         logger.info("finished training")
         logger.info(f"best robustness on test set: {best_robustness}")
 
@@ -135,15 +146,6 @@ class RobustPlusSpectrumNormTrainer(ADVTrainer, InitializeTensorboardMixin):
                 setattr(self.model, name, remove_spectral_norm(module))
                 logger.debug(f"recover '{name}' to normal version")
 
-    def _unfreeze_all_layers(self):
-        for p in self.model.parameters():
-            p.requires_grad = True
-
-    # freez model for speedup
-    def _freeze_all_layers(self):
-        for p in self.model.parameters():
-            p.requires_grad = False
-    
     # overload checkpointing stuffs
     def _save_checkpoint(self, current_epoch, best_acc):
         return super()._save_checkpoint(current_epoch, best_acc)
@@ -8,7 +8,7 @@ import numpy as np
 
 from ..adv_trainer import ADVTrainer
 from ..mixins import InitializeTensorboardMixin
-from src.utils import logger
+from src.utils import logger, MetricsAccumulator, get_checkpoint_writer
 from src.networks import SupportedAllModuleType, make_blocks
 
 
@@ -25,23 +25,25 @@ class RobustPlusSingularRegularizationTrainer(ADVTrainer, InitializeTensorboardM
         self.summary_writer = self.init_writer()
 
     def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor):
-        inputs, labels = inputs.to(self._device), labels.to(self._device)
-
-        self._freeze_all_layers()
-        adv_inputs = self._gen_adv(inputs, labels)
-        self._unfreeze_all_layers()
-        adv_outputs = self.model(adv_inputs)
-        clean_outputs = self.model(inputs)
-
-        r_adv = self._hooked_features_list[0]
-        r_clean = self._hooked_features_list[1]
-        flatten_deviation = (r_adv - r_clean).view(r_adv.shape[0], -1)
-        # divide sqrt(d)
-        regularization_term = self._lambda * torch.norm(
-            flatten_deviation,
-            dim=1,
-            p=2
-        ).sum() / np.sqrt(flatten_deviation.shape[1])
+        with self._profiler.phase("h2d"):
+            inputs, labels = inputs.to(self._device), labels.to(self._device)
+
+        with self._profiler.phase("attack"):
+            adv_inputs = self._gen_adv(inputs, labels)
+        with self._profiler.phase("forward"):
+            adv_outputs = self._train_forward(adv_inputs)
+            clean_outputs = self._train_forward(inputs)
+
+        with self._profiler.phase("regularizer"):
+            r_adv = self._hooked_features_list[0]
+            r_clean = self._hooked_features_list[1]
+            flatten_deviation = (r_adv - r_clean).view(r_adv.shape[0], -1)
+            # divide sqrt(d), summed over samples of whole batch when micro-batching
+            regularization_term = self._lambda * torch.norm(
+                flatten_deviation,
+                dim=1,
+                p=2
+            ).sum() / np.sqrt(flatten_deviation.shape[1]) / self._micro_batch_weight
         # logger.debug(f"d_loss: {regularization_term}")
 
         self._hooked_features_list.clear()
@@ -51,22 +53,23 @@ class RobustPlusSingularRegularizationTrainer(ADVTrainer, InitializeTensorboardM
 
         loss = l_term + regularization_term
 
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        self._zero_grad()
+        with self._profiler.phase("backward"):
+            (loss * self._micro_batch_weight).backward()
+        with self._profiler.phase("optimizer"):
+            self._step_optimizer()
 
-        batch_training_acc = (clean_outputs.argmax(dim=1) == labels).float().mean().item()
-        batch_robust_acc = (adv_outputs.argmax(dim=1) == labels).float().mean().item()
-        self._robust_acc += batch_robust_acc
-        batch_running_loss = loss.item()
+        batch_training_acc = (clean_outputs.argmax(dim=1) == labels).float().mean()
+        batch_robust_acc = (adv_outputs.argmax(dim=1) == labels).float().mean()
+        batch_running_loss = loss.detach()
 
         adv_feature_l2_norm = torch.norm(
-            r_adv.view(r_adv.shape[0], -1),
+            r_adv.detach().view(r_adv.shape[0], -1),
             dim=1,
             p=2
-        ).mean().item()
+        ).mean()
 
-        return batch_running_loss, batch_training_acc, adv_feature_l2_norm
+        return batch_running_loss, batch_training_acc, adv_feature_l2_norm, batch_robust_acc
 
     def train(self, save_path):
         batch_number = len(self._train_loader)
@@ -78,24 +81,25 @@ class RobustPlusSingularRegularizationTrainer(ADVTrainer, InitializeTensorboardM
         logger.info(f"best robustness: {best_robustness}")
 
         for ep in range(start_epoch, self._train_epochs + 1):
-            self._adjust_lr(ep)
+            if self._stopping.finished(ep):
+                break
+            self._adjust_lr(self._stopping.lr_epoch(ep))
 
             # show current learning rate
             logger.debug(f"lr: {self.current_lr}")
 
-            training_acc, running_loss = 0, .0
-            adv_feature_l2_norm = .0
-            # record current robustness
-            self._robust_acc = 0
+            # record loss, accuracy, robustness and feature norm
+            self._metrics = MetricsAccumulator()
 
             start_time = time.perf_counter()
 
-            for index, data in enumerate(self._train_loader):
-                batch_running_loss, batch_training_acc, batch_adv_feature_l2_norm = self.step_batch(data[0], data[1])
+            for index, data in enumerate(self._train_batches(ep)):
+                # robust accuracy is weighted by micro-batch size like loss and accuracy
+                batch_running_loss, batch_training_acc, batch_adv_feature_l2_norm, batch_robust_acc = \
+                    self._accumulate_step_batch(self.step_batch, data[0], data[1])
 
-                training_acc += batch_training_acc
-                running_loss += batch_running_loss
-                adv_feature_l2_norm += batch_adv_feature_l2_norm
+                self._metrics.update(loss=batch_running_loss, train_acc=batch_training_acc,
+                                     adv_feature_l2_norm=batch_adv_feature_l2_norm, robust_acc=batch_robust_acc)
 
                 # warm up learning rate
                 if ep <= self._warm_up_epochs:
@@ -104,11 +108,13 @@ class RobustPlusSingularRegularizationTrainer(ADVTrainer, InitializeTensorboardM
                 if index % batch_number == batch_number - 1:
                     end_time = time.perf_counter()
 
-                    acc = self.test()
-                    average_train_loss = (running_loss / batch_number)
-                    average_train_accuracy = training_acc / batch_number
-                    average_robust_accuracy = self._robust_acc / batch_number
-                    average_adv_feature_l2_norm = adv_feature_l2_norm / batch_number
+                    with self._profiler.phase("eval"):
+                        acc = self.test()
+                    epoch_metrics = self._metrics.averages()
+                    average_train_loss = epoch_metrics["loss"]
+                    average_train_accuracy = epoch_metrics["train_acc"]
+                    average_robust_accuracy = epoch_metrics["robust_acc"]
+                    average_adv_feature_l2_norm = epoch_metrics["adv_feature_l2_norm"]
                     epoch_cost_time = end_time - start_time
 
                     # write loss, time, test_acc, train_acc to tensorboard
@@ -127,14 +133,18 @@ class RobustPlusSingularRegularizationTrainer(ADVTrainer, InitializeTensorboardM
 
                     logger.info(average_adv_feature_l2_norm)
 
+                    self._stopping.update(ep, average_robust_accuracy)
                     if best_robustness < average_robust_accuracy:
                         best_robustness = average_robust_accuracy
                         logger.info(f"better robustness: {best_robustness}")
                         logger.info(f"corresponding accuracy on test set: {acc}")
                         self._save_model(f"{save_path}-best_robust")
 
+            self._profiler.end_epoch(ep, getattr(self, "summary_writer", None))
             self._save_checkpoint(ep, best_robustness)
 
+        get_checkpoint_writer().wait()
+        self._profiler.dump(f"{save_path}_profile.json")
         logger.info("finished training")
         logger.info(f"best robustness on test set: {best_robustness}")
 
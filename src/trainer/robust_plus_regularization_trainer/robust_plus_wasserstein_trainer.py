@@ -1,8 +1,9 @@
-from typing import Dict, Tuple, overload
+from typing import Dict, Optional, Tuple, overload
 import time
 
 import torch
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
 from torch.nn.modules.module import Module
 from torch.utils.data import DataLoader
 
@@ -12,7 +13,8 @@ import math
 from ..adv_trainer import ADVTrainer
 from ..mixins import InitializeTensorboardMixin
 from src import settings
-from src.utils import logger
+from src.utils import (logger, MetricsAccumulator, get_checkpoint_writer, is_distributed, is_main_process,
+                       distribute_module)
 from src.networks import SupportedAllModuleType, make_blocks
 from src.utils.spectral_norm import spectral_norm, remove_spectral_norm
 
@@ -53,7 +55,9 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
 
         # we use a dict to store intermediate features since DataParallel cannot guarantee 
         # synchronization for features.
-        self._features:Dict[int, torch.Tensor] = {}
+        # keys are device indices of replicas(`None` on cpu), in distributed training every
+        # process has one replica and gathers its own features
+        self._features:Dict[Optional[int], torch.Tensor] = {}
 
         self._register_forward_hook_to_k_block(k)
 
@@ -61,7 +65,12 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
 
         self.summary_writer = self.init_writer()
 
-        if torch.cuda.device_count() <= 1:
+        if is_distributed():
+            # gradients are averaged over processes instead of replicas in one process, the model is run by
+            # `DistributedDataParallel` of `_train_forward`, so only the estimator is wrapped here
+            self._is_parallelism = False
+            self._estimator = distribute_module(self._estimator, self._device)
+        elif torch.cuda.device_count() <= 1:
             self._is_parallelism = False
             logger.warning("only one gpu is detected, CUDA may be out of memory!")
         else:
@@ -80,44 +89,46 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
 
 
     def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor, iter:int):
-        inputs = inputs.to(self._device, non_blocking=True)
-        labels = labels.to(self._device)
+        with self._profiler.phase("h2d"):
+            inputs = inputs.to(self._device, non_blocking=True)
+            labels = labels.to(self._device)
 
-        self._freeze_all_layers()
-        adv_inputs = self._gen_adv(inputs, labels)
-        self._unfreeze_all_layers()
+        with self._profiler.phase("attack"):
+            adv_inputs = self._gen_adv(inputs, labels)
 
         # cat for speedup
         batch_size = inputs.shape[0]
         big_batch = torch.cat([adv_inputs, inputs], dim=0)
-        with torch.no_grad():
-            self.model(big_batch)
+        with self._profiler.phase("regularizer"):
+            with torch.no_grad():
+                self.model(big_batch)
 
-        ## update estimator ##
-        # gather all intermediate features to first card (settings.device)
-        features = torch.cat([self._features[i].to(settings.device) for i in range(torch.cuda.device_count())], dim=0)
-        # logger.debug(features)
+            ## update estimator ##
+            # gather all intermediate features to first card (settings.device)
+            features = self._gather_features()
+            # logger.debug(features)
 
-        # Wasserstein Distance Estimation
-        we = self._estimator(features)
-        adv_we, clean_we = we[:batch_size], we[batch_size:]
-        
-        # Wasserstein Distance
-        loss_E = - (torch.mean(clean_we) - torch.mean(adv_we)) * self._lambda
-        # JS Divergence
+            # Wasserstein Distance Estimation
+            we = self._estimator(features)
+            adv_we, clean_we = we[:batch_size], we[batch_size:]
+
+            # Wasserstein Distance
+            loss_E = - (torch.mean(clean_we) - torch.mean(adv_we)) * self._lambda
+            # JS Divergence
 
-        self._optimE.zero_grad()
-        loss_E.backward()
-        self._optimE.step()
+            self._optimE.zero_grad()
+            loss_E.backward()
+            self._optimE.step()
 
 
         """update model"""
-        logits = self.model(big_batch) # type: torch.Tensor
-        clean_logits = logits[batch_size:]
-        adv_logits = logits[:batch_size]
-        features = torch.cat([self._features[i].to(settings.device) for i in range(torch.cuda.device_count())], dim=0)
-        critic = self._estimator(features)
-        adv_critic, clean_critic = critic[:batch_size], critic[batch_size:]
+        with self._profiler.phase("forward"):
+            logits = self._train_forward(big_batch) # type: torch.Tensor
+            clean_logits = logits[batch_size:]
+            adv_logits = logits[:batch_size]
+            features = self._gather_features()
+            critic = self._estimator(features)
+            adv_critic, clean_critic = critic[:batch_size], critic[batch_size:]
 
         # l2 distance
         _feature_distacne = (clean_logits - adv_logits).view(batch_size, -1)
@@ -125,24 +136,26 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
             _feature_distacne,
             p=2,
             dim=1
-        ).sum() / math.sqrt(_feature_distacne.shape[1]) # type: torch.Tensor
+        ).sum() / math.sqrt(_feature_distacne.shape[1]) / self._micro_batch_weight # type: torch.Tensor
         # Wasserstein Distance
         loss_C =  (torch.mean(clean_critic) - torch.mean(adv_critic))
         loss_CE = self.criterion(adv_logits, labels)
         loss_M = loss_CE + loss_C  * self._lambda #type:torch.Tensor
 
-        self.optimizer.zero_grad()
-        loss_M.backward()
-        self.optimizer.step()
+        self._zero_grad()
+        with self._profiler.phase("backward"):
+            (loss_M * self._micro_batch_weight).backward()
+        with self._profiler.phase("optimizer"):
+            self._step_optimizer()
 
-        batch_robust_acc = adv_logits.argmax(dim=1).eq(labels).sum().item()
-        self._robust_acc += batch_robust_acc
+        batch_robust_acc = adv_logits.argmax(dim=1).eq(labels).sum()
+        self._metrics.update(robust_acc=batch_robust_acc)
 
             # print("E loss", loss_E, "M loss", loss_M, "critic", torch.mean(critic), "acc", batch_robust_acc)
 
         self._features.clear()
 
-        return loss_M.item(), loss_E.item(), loss_C.item(), loss_L2.item(),  batch_robust_acc
+        return loss_M.detach(), loss_E.detach(), loss_C.detach(), loss_L2.detach(), batch_robust_acc / batch_size
     
     def train(self, save_path):
         batch_number = len(self._train_loader)
@@ -154,30 +167,29 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
         logger.info(f"best robustness: {best_robustness}")
 
         for ep in range(start_epoch, self._train_epochs + 1):
-            self._adjust_lr(ep)
+            if self._stopping.finished(ep):
+                break
+            self._adjust_lr(self._stopping.lr_epoch(ep))
 
             # show current learning rate
             logger.debug(f"lr: {self.current_lr}")
 
-            training_acc, running_loss = 0, .0
-            estimator_loss, critic_loss = 0., 0.
-            l2_distance = 0.0
-            # record current robustness
-            self._robust_acc = 0
-
-            dataset_items = 0
+            # record losses, accuracy and robustness
+            self._metrics = MetricsAccumulator()
 
             start_time = time.perf_counter()
 
-            for index, data in enumerate(self._train_loader):
-                dataset_items += data[1].shape[0]
-                batch_running_loss, batch_estimator_loss, batch_critic_loss, batch_l2_distance, batch_training_acc = self.step_batch(data[0], data[1], index)
+            for index, data in enumerate(self._train_batches(ep)):
+                # only model optimizer is accumulated, estimator steps on every micro-batch since its
+                # gradients are mixed with those of model loss until its next `zero_grad`
+                batch_running_loss, batch_estimator_loss, batch_critic_loss, batch_l2_distance, batch_training_acc = \
+                    self._accumulate_step_batch(self.step_batch, data[0], data[1], index)
 
-                training_acc += batch_training_acc
-                running_loss += batch_running_loss
-                estimator_loss += batch_estimator_loss
-                critic_loss += batch_critic_loss
-                l2_distance += batch_l2_distance
+                # number of samples, summed over all ranks in distributed training
+                self._metrics.update(loss=batch_running_loss, train_acc=batch_training_acc * data[1].shape[0],
+                                     items=data[1].shape[0],
+                                     estimator_loss=batch_estimator_loss, critic_loss=batch_critic_loss,
+                                     l2_distance=batch_l2_distance)
 
                 # warm up learning rate
                 if ep <= self._warm_up_epochs:
@@ -186,15 +198,18 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
                 if index % batch_number == batch_number - 1:
                     end_time = time.perf_counter()
 
-                    acc = self.test()
+                    with self._profiler.phase("eval"):
+                        acc = self.test()
+                    epoch_totals = self._metrics.totals()
+                    epoch_metrics = self._metrics.averages()
 
-                    average_train_accuracy = training_acc / dataset_items
-                    average_robust_accuracy = self._robust_acc / dataset_items
+                    average_train_accuracy = epoch_totals["train_acc"] / epoch_totals["items"]
+                    average_robust_accuracy = epoch_totals["robust_acc"] / epoch_totals["items"]
 
-                    average_train_loss = (running_loss / batch_number)
-                    average_estimator_loss = estimator_loss / batch_number
-                    average_critic_loss = critic_loss / batch_number
-                    average_l2_distance = l2_distance / batch_number
+                    average_train_loss = epoch_metrics["loss"]
+                    average_estimator_loss = epoch_metrics["estimator_loss"]
+                    average_critic_loss = epoch_metrics["critic_loss"]
+                    average_l2_distance = epoch_metrics["l2_distance"]
 
                     epoch_cost_time = end_time - start_time
 
@@ -216,6 +231,7 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
                         f"test accuracy: {acc}   robust accuracy: {average_robust_accuracy}   "
                         f"time: {epoch_cost_time:.2f}s")
 
+                    self._stopping.update(ep, average_robust_accuracy)
                     if best_robustness < average_robust_accuracy:
                         best_robustness = average_robust_accuracy
                         logger.info(f"better robustness: {best_robustness}")
@@ -223,12 +239,15 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
                         self._save_model(f"{save_path}-best_robust")
 
                     # adjust lambda
-                    if critic_loss / (running_loss - critic_loss * self._lambda)  > 1:
+                    if epoch_totals["critic_loss"] / (epoch_totals["loss"] - epoch_totals["critic_loss"] * self._lambda)  > 1:
                         self._lambda *= 0.5
                         logger.info(f"lambda change to {self._lambda}")
 
+            self._profiler.end_epoch(ep, getattr(self, "summary_writer", None))
             self._save_checkpoint(ep, best_robustness)
 
+        get_checkpoint_writer().wait()
+        self._profiler.dump(f"{save_path}_profile.json")
         logger.info("finished training")
         logger.info(f"best robustness on test set: {best_robustness}")
 
@@ -236,6 +255,11 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
 
         self._remove_hook() # remove the hook
 
+    def _gather_features(self) -> torch.Tensor:
+        """concatenate hooked features of all replicas in order of devices(batch order of DataParallel)"""
+        return torch.cat([self._features[i].to(self._device)
+                          for i in sorted(self._features, key=lambda i: -1 if i is None else i)], dim=0)
+
     def _prepare_estimator(self, lr_estimator:float)->_Estimator:
         # first, we get an input for calculating dimension of features
         image, _ = next(iter(self._train_loader))
@@ -244,8 +268,9 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
         with torch.no_grad():
             self.model(image)
         
-        assert 0 in self._features
-        dim = torch.prod(torch.tensor(self._features[0].shape[1:]))
+        assert self._features
+        dim = torch.prod(torch.tensor(self._gather_features().shape[1:]))
+        self._features.clear()
 
         self._estimator = _Estimator(dim).to(self._device)
         self._optimE = torch.optim.RMSprop(self._estimator.parameters(), lr=lr_estimator)
@@ -274,38 +299,38 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
             self._hook_handle.remove()
         logger.debug("hook is removed")
 
-    # freeze model parameters for speedup
-    def _unfreeze_all_layers(self):
-        for p in self.model.parameters():
-            p.requires_grad = True
+    @property
+    def _estimator_module(self) -> _Estimator:
+        """estimator without its `DataParallel` or `DistributedDataParallel` wrapper"""
+        if isinstance(self._estimator, (nn.DataParallel, DistributedDataParallel)):
+            return self._estimator.module
+        return self._estimator
 
-    def _freeze_all_layers(self):
-        for p in self.model.parameters():
-            p.requires_grad = False
-    
     # stuffs for checkpoint
     def _save_checkpoint(self, current_epoch, best_acc):
         if self._is_parallelism:
             model_weights = self.model.module.state_dict()
-            estimator_weight = self._estimator.module.state_dict()
         else:
             model_weights = self.model.state_dict()
-            estimator_weight = self._estimator.state_dict()
+        estimator_weight = self._estimator_module.state_dict()
         optimizer = self.optimizer.state_dict()
 
-        torch.save({
+        get_checkpoint_writer().save({
             "model_weights": model_weights,
             "optimizer": optimizer,
             "current_epoch": current_epoch,
             "best_acc": best_acc,
-            "estimator_weights": estimator_weight
+            "estimator_weights": estimator_weight,
+            "stopping": self._stopping.state_dict()
         }, f"{self._checkpoint_path}")
 
         # Added by imTyrant
         # For saving 'numpy' and 'torch' random state.
         if hasattr(settings, "save_rand_state") and settings.save_rand_state:
             from src.utils import RandStateSnapshooter
-            RandStateSnapshooter.lazy_take(f"{self._checkpoint_path}.rand")
+            from src.utils.checkpoint_writer import pickle_dump
+            get_checkpoint_writer().save(RandStateSnapshooter.take_snapshot(),
+                                         f"{self._checkpoint_path}.rand", pickle_dump)
             logger.debug(f"random state is saved to '{self._checkpoint_path}.rand'")
     
     def _load_from_checkpoint(self, checkpoint_path: str) -> None:
@@ -323,10 +348,11 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
 
             if self._is_parallelism:
                 self.model.module.load_state_dict(checkpoint.get("model_weights"))
-                self._estimator.module.load_state_dict(checkpoint.get("estimator_weights"))
             else:
                 self.model.load_state_dict(checkpoint.get("model_weights"))
-                self._estimator.load_state_dict(checkpoint.get("estimator"))
+            self._estimator_module.load_state_dict(checkpoint.get("estimator_weights"))
+            if checkpoint.get("stopping") is not None:
+                self._stopping.load_state_dict(checkpoint["stopping"])
 
             self.start_epoch = start_epoch
             self.best_acc = best_acc
@@ -345,6 +371,8 @@ class RobustPlusWassersteinTrainer(ADVTrainer, InitializeTensorboardMixin):
 
 
     def _save_model(self, save_path: str):
+        if not is_main_process():
+            return
         if self._is_parallelism:
             torch.save(self.model.module.state_dict(), save_path)
         else:
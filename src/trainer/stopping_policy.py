@@ -0,0 +1,90 @@
+"""stop or shorten training once the watched accuracy stops improving"""
+from typing import Dict, List, Optional
+
+from src.utils import logger
+
+
+class PlateauStopping:
+
+    def __init__(self, patience: Optional[int], milestones: List[int], train_epochs: int,
+                 threshold: float = 0., skip_milestones: bool = True):
+        """watch accuracy of evaluated epochs(test accuracy or robustness), once it has not improved on the
+        best one by more than `threshold` for `patience` evaluations:
+
+            1. if `skip_milestones` and a lr milestone is ahead, jump to it, the rest of the lr stage and the
+               same number of epochs at the end of training are skipped
+            2. otherwise stop training
+
+        Args:
+            patience: number of evaluations without improvement, `None` disables the policy
+            milestones: lr milestones in epochs of the training loop
+            train_epochs: number of epochs of the training loop
+
+        Notes:
+            trainers adjust lr with `lr_epoch(ep)` and end training once `finished(ep)`, the state is
+            saved in checkpoints by `state_dict`
+        """
+        self.enabled = patience is not None
+        self.patience = patience
+        self.milestones = sorted(milestones)
+        self.train_epochs = train_epochs
+        self.threshold = threshold
+        self.skip_milestones = skip_milestones
+
+        self._best_acc = float("-inf")
+        self._bad_evaluations = 0
+        self._skipped_epochs = 0
+        self._stopped_epoch: Optional[int] = None
+
+    def lr_epoch(self, ep: int) -> int:
+        """epoch of lr schedule that epoch `ep` of training loop trains with"""
+        return ep + self._skipped_epochs
+
+    def finished(self, ep: int) -> bool:
+        """whether training should end before epoch `ep`"""
+        if not self.enabled:
+            return False
+        return self._stopped_epoch is not None or self.lr_epoch(ep) > self.train_epochs
+
+    def update(self, ep: int, acc: float) -> None:
+        """record accuracy of evaluated epoch `ep`, decisions take effect from the next epoch"""
+        if not self.enabled or self._stopped_epoch is not None:
+            return
+
+        if acc > self._best_acc + self.threshold:
+            self._best_acc = acc
+            self._bad_evaluations = 0
+            return
+
+        self._bad_evaluations += 1
+        if self._bad_evaluations < self.patience:
+            return
+        self._bad_evaluations = 0
+
+        lr_epoch = self.lr_epoch(ep)
+        next_milestones = [milestone for milestone in self.milestones if milestone > lr_epoch]
+        if self.skip_milestones and next_milestones and next_milestones[0] < self.train_epochs:
+            # the next epoch is the first one after the milestone
+            self._skipped_epochs += next_milestones[0] - lr_epoch
+            logger.info(f"accuracy has not improved for {self.patience} evaluations, "
+                        f"skip to lr milestone {next_milestones[0]} after epoch {ep}")
+        else:
+            self._stopped_epoch = ep
+            logger.info(f"accuracy has not improved for {self.patience} evaluations, stop training after epoch {ep}")
+
+    def state_dict(self) -> Dict:
+        return {
+            "best_acc": self._best_acc,
+            "bad_evaluations": self._bad_evaluations,
+            "skipped_epochs": self._skipped_epochs,
+            "stopped_epoch": self._stopped_epoch,
+        }
+
+    def load_state_dict(self, state_dict: Dict) -> None:
+        self._best_acc = state_dict["best_acc"]
+        self._bad_evaluations = state_dict["bad_evaluations"]
+        self._skipped_epochs = state_dict["skipped_epochs"]
+        self._stopped_epoch = state_dict["stopped_epoch"]
+        if self._skipped_epochs or self._stopped_epoch is not None:
+            logger.info(f"loaded stopping state: {self._skipped_epochs} epochs skipped, "
+                        f"stopped after epoch: {self._stopped_epoch}")
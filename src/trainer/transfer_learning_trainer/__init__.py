@@ -4,4 +4,6 @@ from .mixins import ReshapeTeacherFCLayerMixin
 from .lwf_tl_trainer import LWFTransferLearningTrainer
 from .sn_tl_trainer import SpectralNormTransferLearningTrainer
 from .bn_tl_trainer import BNTransferLearningTrainer
+from .adapter_tl_trainer import AdapterTransferLearningTrainer
 
+from .multi_variant_runner import MultiVariantTLRunner
@@ -0,0 +1,74 @@
+import torch
+from torch.utils.data import DataLoader
+
+import os
+
+from .tl_trainer import TransferLearningTrainer
+from src.networks import SupportedAllModuleType, add_conv_adapters, merge_adapter_state_dict
+from src.utils import logger, rebuild_state_dict, is_main_process
+
+
+class AdapterTransferLearningTrainer(TransferLearningTrainer):
+
+    def __init__(self, rank: int, k: int, teacher_model_path: str,
+                 model: SupportedAllModuleType, train_loader: DataLoader,
+                 test_loader: DataLoader, checkpoint_path: str = None):
+        """we obey following ideas in `adapter transfer learning trainer`
+
+        Ideas:
+            1. follow ideas in `transfer learning trainer`
+            2. keep conv weights of last `k` blocks frozen, replace convs by `LowRankConv2d` whose
+               low-rank residual factors of `rank` are trained
+            3. BN layers and fully connect layer of last `k` blocks are trained as usual
+
+        Notes:
+            1. optimizer only holds factors, BN layers and fully connect layer, checkpoints keep
+               factors(and only changed tensors if `settings.delta_checkpoint`) to resume training
+            2. saved models(`-best` and `-last`) have factors merged into conv weights, they are loaded
+               by models without adapters
+        """
+        # `BaseTrainer` loads checkpoints before adapters are added, see `_load_from_checkpoint`
+        self._adapters_initialized = False
+        super().__init__(k, teacher_model_path, model, train_loader, test_loader, checkpoint_path)
+
+        self._rank = rank
+        total_blocks = self._blocks.get_total_blocks()
+        adapters = []
+        for i in range(total_blocks, total_blocks - k, -1):
+            adapters.extend(add_conv_adapters(getattr(self._blocks, f"block{i}"), rank))
+        logger.debug(f"add adapters of rank {rank} to {len(adapters)} convs of last {k} blocks")
+        self._adapters_initialized = True
+
+        # factors are new parameters and conv weights are frozen now
+        self._init_optimizer()
+        self._init_scheduler()
+        logger.debug("trainable layers")
+        for name, param in self.model.named_parameters():
+            if param.requires_grad:
+                logger.debug(f"name: {name}, size: {param.size()}")
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            self._load_from_checkpoint(checkpoint_path)
+
+    def _load_from_checkpoint(self, checkpoint_path: str) -> None:
+        if self._adapters_initialized:
+            super()._load_from_checkpoint(checkpoint_path)
+            return
+
+        # model has no adapters yet, merged weights are loaded so that frozen blocks are those of checkpoint
+        # (e.g. for feature cache), the whole checkpoint is loaded once adapters are added
+        state_dict = rebuild_state_dict(torch.load(checkpoint_path).get("model_weights"), map_location=self._device)
+        self.model.load_state_dict(merge_adapter_state_dict(state_dict))
+        self.start_epoch = 1
+        self.best_acc = 0
+
+    def _save_model(self, save_path: str):
+        if not is_main_process():
+            return
+        torch.save(self._delta_state_dict(merge_adapter_state_dict(self.model.state_dict())), save_path)
+
+    def _save_best_model(self, save_path, current_epochs, accuracy, state_dict=None):
+        if state_dict is not None:
+            # weights of an asynchronously evaluated epoch
+            state_dict = self._delta_state_dict(merge_adapter_state_dict(rebuild_state_dict(state_dict)))
+        super()._save_best_model(save_path, current_epochs, accuracy, state_dict)
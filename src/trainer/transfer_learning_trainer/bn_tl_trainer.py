@@ -62,7 +62,7 @@ class BNTransferLearningTrainer(TransferLearningTrainer):
             if isinstance(module, torch.nn.BatchNorm2d) and module.training:
                 logger.debug(f"{name}")
 
-    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor) -> Tuple[float, float]:
+    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         if self._freeze_bn and self._reuse_statistic:
             self.freeze_bn_layer(verbose=False, freezing_range=self._freeze_bn,
                                  reuse_statistic=self._reuse_statistic)
@@ -28,11 +28,13 @@ import time
 import os
 import json
 
-from src.networks import SupportedAllModuleType
-from src.utils import evaluate_accuracy
+from src.networks import SupportedAllModuleType, fold_bn
+from src.utils import evaluate_accuracy, MetricsAccumulator, get_checkpoint_writer, load_model_state_dict, \
+    StepProfiler
 from .mixins import ReshapeTeacherFCLayerMixin
 from ..mixins import InitializeTensorboardMixin
 from ..retrain_trainer import ResetBlockMixin, FreezeModelMixin
+from ..stopping_policy import PlateauStopping
 from src.networks import make_blocks
 from src.utils import logger
 from src import settings
@@ -65,7 +67,7 @@ class LWFTransferLearningTrainer(ReshapeTeacherFCLayerMixin, ResetBlockMixin,
 
         # load state_dict from robust teacher model
         # this process must above `_init_dataloader` method
-        teacher_state_dict = torch.load(teacher_model_path, map_location=self._device)
+        teacher_state_dict = load_model_state_dict(teacher_model_path, map_location=self._device)
         self.reshape_teacher_fc_layer(teacher_state_dict)
         logger.info(f"load from teacher model: \n {teacher_model_path}")
         self.model.load_state_dict(teacher_state_dict)
@@ -94,25 +96,30 @@ class LWFTransferLearningTrainer(ReshapeTeacherFCLayerMixin, ResetBlockMixin,
         logger.info("initialize finished")
         self.print_parameters()
 
-    def step_batch(self, inputs: Tuple[Tensor, Tensor], labels: torch.Tensor, optimizer) -> Tuple[float, float]:
-        inputs, robust_feature_representations = inputs[0].to(self._device), inputs[1].to(self._device)
-        labels = labels.to(self._device)
+    def step_batch(self, inputs: Tuple[Tensor, Tensor], labels: torch.Tensor, optimizer) -> Tuple[Tensor, Tensor]:
+        with self._profiler.phase("h2d"):
+            inputs, robust_feature_representations = inputs[0].to(self._device), inputs[1].to(self._device)
+            labels = labels.to(self._device)
 
         optimizer.zero_grad()
 
-        outputs = self.model(inputs)
-        running_feature_representations = self.model.get_feature_representations()
+        with self._profiler.phase("forward"):
+            outputs = self.model(inputs)
+            running_feature_representations = self.model.get_feature_representations()
 
-        feature_representations_distance = self._lambda * \
-               torch.mean(torch.norm(robust_feature_representations - running_feature_representations, p=1, dim=1))
+        with self._profiler.phase("regularizer"):
+            feature_representations_distance = self._lambda * \
+                   torch.mean(torch.norm(robust_feature_representations - running_feature_representations, p=1, dim=1))
 
         loss = self.criterion(outputs, labels) + feature_representations_distance
 
-        loss.backward()
-        optimizer.step()
+        with self._profiler.phase("backward"):
+            loss.backward()
+        with self._profiler.phase("optimizer"):
+            optimizer.step()
 
-        batch_training_acc = (outputs.argmax(dim=1) == labels).float().mean().item()
-        batch_running_loss = loss.item()
+        batch_training_acc = (outputs.argmax(dim=1) == labels).float().mean()
+        batch_running_loss = loss.detach()
 
         return batch_running_loss, batch_training_acc
 
@@ -155,6 +162,8 @@ class LWFTransferLearningTrainer(ReshapeTeacherFCLayerMixin, ResetBlockMixin,
 
         only_fc_unfreezed_flag = False
         for ep in range(start_epoch, self._train_epochs + 1):
+            if self._stopping.finished(ep):
+                break
 
             if ep < self._warm_start_epochs:
                 if not only_fc_unfreezed_flag:
@@ -173,21 +182,22 @@ class LWFTransferLearningTrainer(ReshapeTeacherFCLayerMixin, ResetBlockMixin,
             # show current learning rate
             logger.debug(f"lr: {self._lr}")
 
-            training_acc, running_loss = 0, .0
+            self._metrics = MetricsAccumulator()
             start_time = time.perf_counter()
 
-            for index, data in enumerate(self._train_loader):
+            for index, data in enumerate(self._profiler.iterate(self._train_loader)):
                 batch_running_loss, batch_training_acc = self.step_batch(data[0], data[1], optimizer)
 
-                training_acc += batch_training_acc
-                running_loss += batch_running_loss
+                self._metrics.update(loss=batch_running_loss, train_acc=batch_training_acc)
 
                 if index % batch_number == batch_number - 1:
                     end_time = time.perf_counter()
 
-                    acc = self.test()
-                    average_train_loss = (running_loss / batch_number)
-                    average_train_accuracy = training_acc / batch_number
+                    with self._profiler.phase("eval"):
+                        acc = self.test()
+                    epoch_metrics = self._metrics.averages()
+                    average_train_loss = epoch_metrics["loss"]
+                    average_train_accuracy = epoch_metrics["train_acc"]
                     epoch_cost_time = end_time - start_time
 
                     # write loss, time, test_acc, train_acc to tensorboard
@@ -202,34 +212,42 @@ class LWFTransferLearningTrainer(ReshapeTeacherFCLayerMixin, ResetBlockMixin,
                         f"epoch: {ep}   loss: {average_train_loss:.6f}   train accuracy: {average_train_accuracy}   "
                         f"test accuracy: {acc}   time: {epoch_cost_time:.2f}s")
 
+                    self._stopping.update(ep, acc)
                     if best_acc < acc:
                         best_acc = acc
                         self._save_best_model(save_path, ep, acc)
 
+            self._profiler.end_epoch(ep, getattr(self, "summary_writer", None))
             self._save_checkpoint(ep, best_acc)
 
+        get_checkpoint_writer().wait()
+        self._profiler.dump(f"{save_path}_profile.json")
         logger.info("finished training")
         logger.info(f"best accuracy on test set: {best_acc}")
 
     def test(self):
-        return evaluate_accuracy(self.model, self._test_loader, self._device)
+        model = fold_bn(self.model) if settings.fold_eval_bn else self.model
+        return evaluate_accuracy(model, self._test_loader, self._device)
 
     def _save_checkpoint(self, current_epoch, best_acc):
         model_weights = self.model.state_dict()
 
-        torch.save({
+        get_checkpoint_writer().save({
             "model_weights": model_weights,
             "fc_optimizer": self.fc_optimizer.state_dict(),
             "all_optimizer": self.all_optimizer.state_dict(),
             "current_epoch": current_epoch,
-            "best_acc": best_acc
+            "best_acc": best_acc,
+            "stopping": self._stopping.state_dict()
         }, f"{self._checkpoint_path}")
 
         # Added by imTyrant
         # For saving 'numpy' and 'torch' random state.
         if hasattr(settings, "save_rand_state") and settings.save_rand_state:
             from src.utils import RandStateSnapshooter
-            RandStateSnapshooter.lazy_take(f"{self._checkpoint_path}.rand")
+            from src.utils.checkpoint_writer import pickle_dump
+            get_checkpoint_writer().save(RandStateSnapshooter.take_snapshot(),
+                                         f"{self._checkpoint_path}.rand", pickle_dump)
             logger.debug(f"random state is saved to '{self._checkpoint_path}.rand'")
 
     def _save_best_model(self, save_path, current_epochs, accuracy):
@@ -251,6 +269,8 @@ class LWFTransferLearningTrainer(ReshapeTeacherFCLayerMixin, ResetBlockMixin,
         self.all_optimizer.load_state_dict(checkpoint.get("all_optimizer"))
         start_epoch = checkpoint.get("current_epoch") + 1
         best_acc = checkpoint.get("best_acc")
+        if checkpoint.get("stopping") is not None:
+            self._stopping.load_state_dict(checkpoint["stopping"])
 
         self.start_epoch = start_epoch
         self.best_acc = best_acc
@@ -275,6 +295,10 @@ class LWFTransferLearningTrainer(ReshapeTeacherFCLayerMixin, ResetBlockMixin,
         self._train_epochs = _TRAIN_EPOCHS
         self._warm_start_epochs = _WARM_START_EPOCHS
         self._device = torch.device(settings.device if torch.cuda.is_available() else "cpu")
+        self._profiler = StepProfiler(self._device, enabled=settings.profile_steps)
+        # lr is constant, plateau stops training
+        self._stopping = PlateauStopping(settings.stop_patience, [], self._train_epochs,
+                                         threshold=settings.stop_threshold)
 
     def _init_criterion(self):
         self.criterion = getattr(torch.nn, settings.criterion)()
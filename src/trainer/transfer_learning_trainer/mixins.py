@@ -1,10 +1,17 @@
 import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Dataset, Subset
 
-from typing import Union
+from typing import Dict, Union
 from collections import OrderedDict
+import hashlib
+import json
+import os
 
-from src.utils import logger
-from src.networks import SupportedWideResnetType
+from src import settings
+from src.utils import (logger, file_digest, build_feature_store, feature_store_exists, FeatureDataset,
+                       is_main_process, is_distributed, get_distributed_dataloader, load_model_state_dict)
+from src.networks import SupportedWideResnetType, SupportedAllModuleType, WRNBlocks, ResnetBlocks
 
 
 class ReshapeTeacherFCLayerMixin:
@@ -23,3 +30,81 @@ class ReshapeTeacherFCLayerMixin:
         if state_dict.get("fc.bias") is not None:
             state_dict["fc.bias"] = torch.rand_like(self.model.fc.bias)
             logger.debug(f"reshaped fully connect bias: {state_dict['fc.bias'].shape}\n{state_dict['fc.bias']}")
+
+
+def dataset_cache_key(dataset: Dataset) -> Dict:
+    """what features of `dataset` depend on besides the model: class, split and transforms(with normalization)
+
+    `Subset` is keyed by its indices and the dataset it is taken from
+    """
+    if isinstance(dataset, Subset):
+        return {
+            "subset": hashlib.sha256(json.dumps(list(map(int, dataset.indices))).encode()).hexdigest(),
+            "of": dataset_cache_key(dataset.dataset)
+        }
+
+    return {
+        "class": type(dataset).__name__,
+        # torchvision datasets mark the split by `train`(e.g. CIFAR10) or `split`(e.g. SVHN)
+        "split": str(getattr(dataset, "split", getattr(dataset, "train", None))),
+        "root": str(getattr(dataset, "root", None)),
+        "transform": repr(getattr(dataset, "transform", None)),
+        "target_transform": repr(getattr(dataset, "target_transform", None)),
+    }
+
+
+class FeatureCacheMixin:
+    """train the last k blocks on stored inputs of the first trainable block, see `settings.feature_cache`"""
+    _device: Union[str, torch.device]
+    _teacher_model_path: str
+    _train_loader: DataLoader
+    model: SupportedAllModuleType
+    _blocks: Union[WRNBlocks, ResnetBlocks]
+
+    def init_feature_cache(self, k: int, train_loader: DataLoader) -> None:
+        """extract inputs of the first trainable block of `train_loader` once and replace train loader
+        by a loader of them
+
+        frozen blocks run in eval mode, so features do not depend on batches and running statistics
+        of frozen BN layers are kept as those of teacher model
+        """
+        start_block = self._blocks.get_total_blocks() - k + 1
+        dataset = train_loader.dataset
+        key = json.dumps({
+            "teacher": file_digest(self._teacher_model_path),
+            "model": type(self.model).__name__,
+            "k": k,
+            "dataset": dataset_cache_key(dataset),
+            "num_samples": len(dataset),
+            "views": settings.feature_cache_views,
+            "half": settings.feature_cache_half,
+        }, sort_keys=True)
+        path = str(settings.feature_cache_dir / hashlib.sha256(key.encode()).hexdigest()[:16])
+
+        if is_main_process() and not feature_store_exists(path):
+            logger.info(f"extract features of block{start_block} inputs: {key}")
+            os.makedirs(settings.feature_cache_dir, exist_ok=True)
+            # store is keyed by teacher model, so features are extracted by weights of teacher model instead of
+            # weights of `self.model`, which may not be loaded yet(e.g. subclasses load checkpoints later)
+            model_state_dict = {name: value.clone() for name, value in self.model.state_dict().items()}
+            teacher_state_dict = load_model_state_dict(self._teacher_model_path, map_location=self._device)
+            self.model.load_state_dict({name: value for name, value in teacher_state_dict.items()
+                                        if not name.startswith("fc.")}, strict=False)
+            training = self.model.training
+            self.model.eval()
+            try:
+                build_feature_store(path, lambda x: self._blocks.forward_prefix(x, upto=start_block), dataset,
+                                    views=settings.feature_cache_views, half=settings.feature_cache_half,
+                                    batch_size=train_loader.batch_size, num_workers=train_loader.num_workers,
+                                    device=self._device)
+            finally:
+                self.model.train(training)
+                self.model.load_state_dict(model_state_dict)
+        if is_distributed():
+            # other ranks wait for rank 0 to write features
+            dist.barrier()
+        logger.info(f"train on cached features: {path}")
+
+        feature_loader = DataLoader(FeatureDataset(path), batch_size=train_loader.batch_size, shuffle=True,
+                                    num_workers=train_loader.num_workers, pin_memory=train_loader.pin_memory)
+        self._train_loader = get_distributed_dataloader(feature_loader) if is_distributed() else feature_loader
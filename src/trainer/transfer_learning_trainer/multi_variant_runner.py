@@ -0,0 +1,208 @@
+import time
+from typing import List, Optional, Sequence
+
+import torch
+from torch.nn import Module
+
+from src import settings
+from src.utils import logger, MetricsAccumulator, AsyncEvaluator, get_checkpoint_writer
+from .tl_trainer import TransferLearningTrainer
+
+
+class MultiVariantTLRunner:
+
+    def __init__(self, variants: Sequence[TransferLearningTrainer], log_files: Optional[Sequence[str]] = None):
+        """train several transfer learning trainers of the same teacher and `k` in lockstep, e.g.
+        `ParsevalTransferLearningTrainer` with different `beta` or `SpectralNormTransferLearningTrainer`
+        with different `norm_beta`
+
+        every batch is loaded once and passed through the frozen blocks once(by the first variant), each
+        variant trains its last `k` blocks on the shared features. checkpoints, saved models, tensorboard
+        logs and log files are written per variant, the same as running them one by one
+
+        Args:
+            variants: trainers built with the same teacher, model, `k` and train loader, each with its own
+                      checkpoint path
+            log_files: log file of every variant, logs of an epoch are written to the file of its variant
+
+        Notes:
+            1. frozen BN layers in train mode update running statistics once per batch, they are copied
+               from the first variant to the others before evaluation, so every variant ends with the
+               statistics of a separate run on the same batches
+            2. a variant stops on its own stopping policy, the rest keep training
+            3. `time per epoch` is the time of the shared epoch
+        """
+        if not variants:
+            raise ValueError("at least one variant is required")
+        if log_files is not None and len(log_files) != len(variants):
+            raise ValueError(f"expect {len(variants)} log files, got {len(log_files)}")
+        self._variants = list(variants)
+        self._log_files = list(log_files) if log_files is not None else None
+        self._lead = self._variants[0]
+        # batches of train loader are already features if `settings.feature_cache` is set
+        self._cached_features = self._lead._cached_features
+
+        self._check_variants()
+
+    def _check_variants(self) -> None:
+        lead = self._lead
+        lead_modes = [m.training for m in self._prefix_modules(lead)]
+        for variant in self._variants[1:]:
+            if variant._teacher_model_path != lead._teacher_model_path:
+                raise ValueError(f"variants have different teacher models: "
+                                 f"{lead._teacher_model_path}, {variant._teacher_model_path}")
+            if type(variant.model) is not type(lead.model) or \
+                    variant._first_trainable_block != lead._first_trainable_block:
+                raise ValueError("variants must train the same blocks of the same model")
+            if variant._cached_features != self._cached_features:
+                raise ValueError("either all or none of variants train on cached features")
+            if [m.training for m in self._prefix_modules(variant)] != lead_modes:
+                raise ValueError("frozen blocks of variants must be in the same train/eval mode")
+
+    @staticmethod
+    def _prefix_modules(variant: TransferLearningTrainer) -> List[Module]:
+        """modules of `variant` that are not part of its trainable blocks"""
+        blocks = variant._blocks
+        trainable = {id(m) for i in range(variant._first_trainable_block, blocks.get_total_blocks() + 1)
+                     for m in blocks.get_block(i).modules()}
+        return [m for m in variant.model.modules() if id(m) not in trainable]
+
+    def train(self, save_paths: Sequence[str]) -> None:
+        if len(save_paths) != len(self._variants):
+            raise ValueError(f"expect {len(self._variants)} save paths, got {len(save_paths)}")
+
+        best_accs = [variant.best_acc for variant in self._variants]
+        for i, variant in enumerate(self._variants):
+            self._use_log_file(i)
+            logger.info(f"starting epoch: {variant.start_epoch}")
+            logger.info(f"start lr: {variant.current_lr}")
+            logger.info(f"best accuracy: {variant.best_acc}")
+
+        evaluators = [AsyncEvaluator(variant.model, variant._test_loader, settings.fold_eval_bn)
+                      if settings.async_eval else None for variant in self._variants]
+
+        # variants train on features of the first trainable block, see `TransferLearningTrainer._forward`
+        for variant in self._variants:
+            variant._cached_features = True
+        try:
+            for ep in range(min(variant.start_epoch for variant in self._variants), self._lead._train_epochs + 1):
+                if all(variant._stopping.finished(ep) for variant in self._variants):
+                    break
+                # variants resumed from a later epoch join once training reaches it
+                active = [i for i, variant in enumerate(self._variants)
+                          if variant.start_epoch <= ep and not variant._stopping.finished(ep)]
+                if not active:
+                    continue
+                self._train_epoch(ep, active, save_paths, best_accs, evaluators)
+        finally:
+            for variant in self._variants:
+                variant._cached_features = self._cached_features
+
+        for i, evaluator in enumerate(evaluators):
+            if evaluator is not None:
+                self._use_log_file(i)
+                for eval_ep, eval_acc, eval_state_dict in evaluator.poll(block=True):
+                    best_accs[i] = self._variants[i]._record_test_accuracy(
+                        save_paths[i], eval_ep, eval_acc, best_accs[i], eval_state_dict)
+                evaluator.close()
+
+        get_checkpoint_writer().wait()
+        for i, variant in enumerate(self._variants):
+            self._use_log_file(i)
+            variant._profiler.dump(f"{save_paths[i]}_profile.json")
+            logger.info("finished training")
+            logger.info(f"best accuracy on test set: {best_accs[i]}")
+            variant._save_last_model(f"{save_paths[i]}-last")
+
+    def _train_epoch(self, ep: int, active: List[int], save_paths: Sequence[str], best_accs: List[float],
+                     evaluators: List[Optional[AsyncEvaluator]]) -> None:
+        variants = [self._variants[i] for i in active]
+        for variant in variants:
+            variant._adjust_lr(variant._stopping.lr_epoch(ep))
+            logger.debug(f"lr: {variant.current_lr}")
+            variant._metrics = MetricsAccumulator()
+        start_time = time.perf_counter()
+
+        # shuffles shards in distributed training
+        train_batches = self._lead._train_batches(ep)
+
+        for inputs, labels in train_batches:
+            with self._lead._profiler.phase("h2d"):
+                inputs, labels = inputs.to(self._lead._device), labels.to(self._lead._device)
+            if not self._cached_features:
+                with self._lead._profiler.phase("forward"):
+                    inputs = self._forward_prefix(inputs)
+
+            for variant in variants:
+                batch_running_loss, batch_training_acc = variant._accumulate_step_batch(
+                    variant.step_batch, inputs, labels)
+                variant._metrics.update(loss=batch_running_loss, train_acc=batch_training_acc)
+                # warm up learning rate
+                if ep <= variant._warm_up_epochs:
+                    variant.warm_up_scheduler.step()
+        end_time = time.perf_counter()
+
+        if not self._cached_features:
+            self._share_prefix_buffers()
+
+        for i, variant in zip(active, variants):
+            self._use_log_file(i)
+            acc = None
+            if ep % settings.eval_every == 0 or variant._stopping.lr_epoch(ep) >= variant._train_epochs:
+                if evaluators[i] is not None:
+                    evaluators[i].submit(ep, variant._model_state_dict())
+                else:
+                    with variant._profiler.phase("eval"):
+                        acc = self._test(variant)
+            epoch_metrics = variant._metrics.averages()
+            average_train_loss = epoch_metrics["loss"]
+            average_train_accuracy = epoch_metrics["train_acc"]
+            epoch_cost_time = end_time - start_time
+
+            variant.summary_writer.add_scalar("train loss", average_train_loss, ep)
+            variant.summary_writer.add_scalar("train accuracy", average_train_accuracy, ep)
+            variant.summary_writer.add_scalar("time per epoch", epoch_cost_time, ep)
+
+            logger.info(
+                f"epoch: {ep}   loss: {average_train_loss:.6f}   train accuracy: {average_train_accuracy}   "
+                f"test accuracy: {acc}   time: {epoch_cost_time:.2f}s")
+
+            if acc is not None:
+                best_accs[i] = variant._record_test_accuracy(save_paths[i], ep, acc, best_accs[i])
+            if evaluators[i] is not None:
+                for eval_ep, eval_acc, eval_state_dict in evaluators[i].poll():
+                    best_accs[i] = variant._record_test_accuracy(save_paths[i], eval_ep, eval_acc, best_accs[i],
+                                                                 eval_state_dict)
+
+            variant._profiler.end_epoch(ep, variant.summary_writer)
+            variant._save_checkpoint(ep, best_accs[i])
+
+    def _forward_prefix(self, inputs: torch.Tensor) -> torch.Tensor:
+        """inputs of the first trainable block, computed on the same micro-batches as `step_batch` so
+        that frozen BN layers in train mode see the same batches as in a separate run"""
+        micro_batch_size = settings.micro_batch_size or inputs.shape[0]
+        return torch.cat([self._lead._forward_prefix(micro_inputs) for micro_inputs in inputs.split(micro_batch_size)])
+
+    def _share_prefix_buffers(self) -> None:
+        """copy buffers(running statistics of BN) of frozen blocks of the first variant to the others"""
+        lead_buffers = [b for m in self._prefix_modules(self._lead) for b in m.buffers(recurse=False)]
+        with torch.no_grad():
+            for variant in self._variants[1:]:
+                buffers = [b for m in self._prefix_modules(variant) for b in m.buffers(recurse=False)]
+                for buffer, lead_buffer in zip(buffers, lead_buffers):
+                    buffer.copy_(lead_buffer)
+
+    @staticmethod
+    def _test(variant: TransferLearningTrainer) -> float:
+        """test accuracy of `variant`, train/eval modes of its modules are kept, e.g. BN layers frozen with
+        teacher statistics that trainers otherwise set again in their next `step_batch`"""
+        modes = [(m, m.training) for m in variant.model.modules()]
+        try:
+            return variant.test()
+        finally:
+            for module, training in modes:
+                module.training = training
+
+    def _use_log_file(self, i: int) -> None:
+        if self._log_files is not None:
+            logger.change_log_file(self._log_files[i])
@@ -70,7 +70,7 @@ class SpectralNormTransferLearningTrainer(TransferLearningTrainer):
                 logger.debug(f"{name}")
 
 
-    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor) -> Tuple[float, float]:
+    def step_batch(self, inputs: torch.Tensor, labels: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         # If we want to reuse statistic of batch norm layer, we have to refreeze them, since 
         # after model validation, model goes back to 'eval' mode.
         if self._freeze_bn and self._reuse_statistic:
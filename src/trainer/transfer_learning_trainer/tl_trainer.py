@@ -3,17 +3,18 @@ from torch.utils.data import DataLoader
 
 import os
 
-from .mixins import ReshapeTeacherFCLayerMixin
+from src import settings
+from .mixins import ReshapeTeacherFCLayerMixin, FeatureCacheMixin
 from ..mixins import InitializeTensorboardMixin
 from ..normal_trainer import NormalTrainer
 from ..retrain_trainer import ResetBlockMixin, FreezeModelMixin
-from src.networks import make_blocks
+from src.networks import make_blocks, fold_bn
 from src.networks import SupportedAllModuleType
-from src.utils import logger
+from src.utils import logger, make_delta_state_dict, rebuild_state_dict, load_model_state_dict, file_digest
 
 
 class TransferLearningTrainer(NormalTrainer, ResetBlockMixin, FreezeModelMixin,
-                              ReshapeTeacherFCLayerMixin, InitializeTensorboardMixin):
+                              ReshapeTeacherFCLayerMixin, FeatureCacheMixin, InitializeTensorboardMixin):
 
     def __init__(self, k: int, teacher_model_path: str,
                  model: SupportedAllModuleType, train_loader: DataLoader,
@@ -26,11 +27,20 @@ class TransferLearningTrainer(NormalTrainer, ResetBlockMixin, FreezeModelMixin,
             3. set `requires_grad = False` for all parameters in model
             4. set `requires_grad = True` for parameters in last `k` blocks
             5. reset parameters of last `k` blocks
+
+        Notes:
+            1. if `settings.delta_checkpoint` is set, checkpoints and saved models only keep tensors that
+               differ from teacher model, use `src.utils.load_model_state_dict` to load them
+            2. if `settings.feature_cache` is set, only last `k` blocks are trained on cached features
+            3. if `settings.fold_frozen_bn` is set, frozen blocks are run in eval mode with BN folded into convs
         """
+        self._teacher_model_path = teacher_model_path
+        # cpu state_dict and digest of teacher file, loaded when first delta is saved
+        self._teacher_reference = None
         super().__init__(model, train_loader, test_loader, checkpoint_path)
 
         if not checkpoint_path or not os.path.exists(checkpoint_path):
-            teacher_state_dict = torch.load(teacher_model_path, map_location=self._device)
+            teacher_state_dict = load_model_state_dict(teacher_model_path, map_location=self._device)
             self.reshape_teacher_fc_layer(teacher_state_dict)
             logger.info(f"load from teacher model: \n {teacher_model_path}")
             self.model.load_state_dict(teacher_state_dict)
@@ -51,8 +61,62 @@ class TransferLearningTrainer(NormalTrainer, ResetBlockMixin, FreezeModelMixin,
             if param.requires_grad:
                 logger.debug(f"name: {name}, size: {param.size()}")
 
+        self._first_trainable_block = self._blocks.get_total_blocks() - k + 1
+        # copy of frozen blocks with BN folded into convs, built from loaded weights, see `_prefix_blocks`
+        self._folded_blocks = None
+        # train batches are inputs of the first trainable block
+        self._cached_features = settings.feature_cache
+        if self._cached_features:
+            self.init_feature_cache(k, train_loader)
+
         self.summary_writer = self.init_writer()
 
+    def _forward(self, inputs: torch.Tensor) -> torch.Tensor:
+        """only the last `k` blocks are run with autograd"""
+        if not self._cached_features:
+            inputs = self._forward_prefix(inputs)
+        return self._blocks.forward_suffix(inputs, from_=self._first_trainable_block)
+
+    def _forward_prefix(self, inputs: torch.Tensor) -> torch.Tensor:
+        """inputs of the first trainable block"""
+        # frozen blocks build no graph, their activations are freed right away
+        with torch.no_grad():
+            return self._prefix_blocks.forward_prefix(inputs, upto=self._first_trainable_block)
+
+    @property
+    def _prefix_blocks(self):
+        """blocks that run frozen blocks in training, a copy with BN folded into convs if `settings.fold_frozen_bn`
+
+        frozen BN layers of `self.model` are then never run in training and keep statistics of teacher model.
+        the copy is built on first use and rebuilt after weights are loaded, since subclasses may load
+        checkpoints after `__init__` of this class
+        """
+        if not settings.fold_frozen_bn:
+            return self._blocks
+        if self._folded_blocks is None:
+            self._folded_blocks = make_blocks(fold_bn(self.model))
+        return self._folded_blocks
+
+    def _model_state_dict(self):
+        return self._delta_state_dict(super()._model_state_dict())
+
+    def _delta_state_dict(self, state_dict):
+        """`state_dict` relative to teacher model if `settings.delta_checkpoint`"""
+        if not settings.delta_checkpoint:
+            return state_dict
+
+        if self._teacher_reference is None:
+            self._teacher_reference = (load_model_state_dict(self._teacher_model_path, map_location="cpu"),
+                                       file_digest(self._teacher_model_path))
+        teacher_state_dict, teacher_digest = self._teacher_reference
+
+        return make_delta_state_dict(state_dict, teacher_state_dict, self._teacher_model_path, teacher_digest)
+
+    def _load_model_state_dict(self, state_dict) -> None:
+        super()._load_model_state_dict(rebuild_state_dict(state_dict, map_location=self._device))
+        # folded copy of frozen blocks is stale
+        self._folded_blocks = None
+
 
 if __name__ == '__main__':
     from src.networks import wrn34_10
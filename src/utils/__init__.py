@@ -3,6 +3,8 @@ from .data_utils import (
     get_cifar_test_dataloader,
     get_cifar_train_dataloader,
     get_subset_cifar_train_dataloader,
+    get_indexed_dataloader,
+    split_held_out_dataloader,
     get_mnist_test_dataloader,
     get_mnist_train_dataloader,
     get_mnist_train_dataloader_one_channel,
@@ -13,9 +15,27 @@ from .data_utils import (
     get_gtsrb_train_dataloder,
     clamp,
     evaluate_accuracy,
-    WarmUpLR
+    WarmUpLR,
+    DevicePrefetcher
 )
 
 from .logging_utils import logger
 
-from .rand_state_snapshot import RandStateSnapshooter
\ No newline at end of file
+from .rand_state_snapshot import RandStateSnapshooter
+
+from .perturbation_store import PerturbationStore
+
+from .metrics import MetricsAccumulator
+
+from .checkpoint_writer import CheckpointWriter, get_checkpoint_writer
+
+from .delta_checkpoint import make_delta_state_dict, rebuild_state_dict, load_model_state_dict, file_digest
+
+from .step_profiler import StepProfiler
+
+from .async_evaluator import AsyncEvaluator
+
+from .feature_store import build_feature_store, feature_store_exists, FeatureDataset
+
+from .distributed import (init_distributed, is_distributed, get_rank, get_local_rank, get_world_size,
+                          is_main_process, get_distributed_dataloader, distribute_module)
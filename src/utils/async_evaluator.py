@@ -0,0 +1,82 @@
+"""evaluate snapshots of model weights in a separate process"""
+from typing import Dict, List, Tuple
+import atexit
+import copy
+import queue
+
+import torch
+import torch.multiprocessing as mp
+from torch.nn import Module
+from torch.utils.data import DataLoader
+
+from .checkpoint_writer import _snapshot
+from .data_utils import evaluate_accuracy
+from .delta_checkpoint import rebuild_state_dict
+from .logging_utils import logger
+
+
+def _evaluate_worker(model: Module, test_loader: DataLoader, tasks, results, fold: bool = False) -> None:
+    if fold:
+        from src.networks import fold_bn
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        ep, state_dict = task
+        model.load_state_dict(rebuild_state_dict(state_dict, map_location="cpu"))
+        results.put((ep, evaluate_accuracy(fold_bn(model) if fold else model, test_loader, "cpu")))
+
+
+class AsyncEvaluator:
+
+    def __init__(self, model: Module, test_loader: DataLoader, fold: bool = False):
+        """evaluate accuracy of weight snapshots on cpu in a spawned process
+
+        Args:
+            model: copied to cpu and sent to the worker once, must be picklable(e.g. without hooks
+                   bound to a trainer)
+            test_loader: iterated by the worker, its own loader workers are started in the worker
+            fold: evaluate a copy of every snapshot with BN layers folded into convs, see
+                  `src.networks.fold_bn`
+
+        Notes:
+            snapshots are kept until their result is returned by `poll`, so the weights of an evaluated
+            epoch can still be saved after training has moved on
+        """
+        context = mp.get_context("spawn")
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._pending: Dict[int, Dict[str, torch.Tensor]] = {}
+        # not a daemon, daemonic processes can not start dataloader workers
+        self._process = context.Process(target=_evaluate_worker, name="async-evaluator",
+                                        args=(copy.deepcopy(model).cpu(), test_loader, self._tasks, self._results, fold))
+        self._process.start()
+        atexit.register(self.close)
+        logger.info("started asynchronous evaluation process")
+
+    def submit(self, ep: int, state_dict: Dict[str, torch.Tensor]) -> None:
+        """evaluate cpu snapshot of `state_dict`, plain or delta state_dict"""
+        snapshot = _snapshot(state_dict)
+        self._pending[ep] = snapshot
+        self._tasks.put((ep, snapshot))
+
+    def poll(self, block: bool = False) -> List[Tuple[int, float, Dict[str, torch.Tensor]]]:
+        """return `(epoch, accuracy, state_dict)` of finished evaluations, wait for all pending ones if `block`"""
+        finished = []
+        while self._pending:
+            try:
+                ep, acc = self._results.get(timeout=1) if block else self._results.get_nowait()
+            except queue.Empty:
+                if not block:
+                    break
+                if not self._process.is_alive():
+                    raise RuntimeError(f"evaluation process exited with code {self._process.exitcode}")
+                continue
+            finished.append((ep, acc, self._pending.pop(ep)))
+
+        return finished
+
+    def close(self) -> None:
+        if self._process.is_alive():
+            self._tasks.put(None)
+            self._process.join()
@@ -0,0 +1,108 @@
+"""write checkpoints in background"""
+from typing import Any, Callable, Optional
+import atexit
+import copy
+import os
+import pickle
+import queue
+import threading
+
+import torch
+
+from src import settings
+from .logging_utils import logger
+from .distributed import is_main_process
+
+
+def pickle_dump(obj: Any, path: str) -> None:
+    with open(path, "wb") as f:
+        pickle.dump(obj, f)
+
+
+def _snapshot(obj: Any) -> Any:
+    """copy all tensors in `obj` to cpu memory, so training can keep updating the originals"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((k, _snapshot(v)) for k, v in obj.items())
+        # versions of modules in state_dicts, used by `load_state_dict`
+        if hasattr(obj, "_metadata"):
+            snapshot._metadata = copy.deepcopy(obj._metadata)
+        return snapshot
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v) for v in obj)
+    return copy.deepcopy(obj)
+
+
+class CheckpointWriter:
+
+    def __init__(self, max_pending: int = 1, asynchronous: bool = True):
+        """serialize checkpoints on a background thread
+
+        `save` snapshots the state to cpu memory and returns, it only blocks when `max_pending`
+        checkpoints are still waiting to be written. every file is written to `{path}.tmp` first
+        and renamed, so an interrupted write never corrupts the last checkpoint
+
+        Args:
+            max_pending: max number of snapshots waiting in queue
+            asynchronous: write on the calling thread if `False`, e.g. for debugging
+        """
+        self._asynchronous = asynchronous
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error: Optional[BaseException] = None
+        if asynchronous:
+            self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+            self._thread.start()
+            # daemon thread is killed at exit, finish pending writes first
+            atexit.register(self.wait)
+
+    def save(self, obj: Any, path: str, save_fn: Callable[[Any, str], None] = torch.save) -> None:
+        """write `obj` to `path`, ignored on other ranks than rank 0 in distributed training"""
+        self._raise_error()
+        if not is_main_process():
+            return
+        snapshot = _snapshot(obj)
+        if self._asynchronous:
+            self._queue.put((snapshot, str(path), save_fn))
+        else:
+            self._write(snapshot, str(path), save_fn)
+
+    def wait(self) -> None:
+        """block until all pending checkpoints are written"""
+        if self._asynchronous:
+            self._queue.join()
+        self._raise_error()
+
+    def _run(self) -> None:
+        while True:
+            snapshot, path, save_fn = self._queue.get()
+            try:
+                self._write(snapshot, path, save_fn)
+            except BaseException as e:
+                self._error = e
+                logger.warning(f"failed to write checkpoint '{path}': {e}")
+            finally:
+                self._queue.task_done()
+
+    @staticmethod
+    def _write(snapshot: Any, path: str, save_fn: Callable[[Any, str], None]) -> None:
+        tmp_path = f"{path}.tmp"
+        save_fn(snapshot, tmp_path)
+        os.replace(tmp_path, path)
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("checkpoint writer failed") from error
+
+
+_checkpoint_writer: Optional[CheckpointWriter] = None
+
+
+def get_checkpoint_writer() -> CheckpointWriter:
+    """checkpoint writer shared by all trainers of current process"""
+    global _checkpoint_writer
+    if _checkpoint_writer is None:
+        _checkpoint_writer = CheckpointWriter(max_pending=settings.checkpoint_queue_size,
+                                              asynchronous=settings.async_checkpoint)
+    return _checkpoint_writer
@@ -1,12 +1,15 @@
 from .data_utils import (
     clamp,
     evaluate_accuracy,
-    WarmUpLR
+    WarmUpLR,
+    DevicePrefetcher
 )
 
 from .get_dataloader import (
     get_mean_and_std,
     get_subset_cifar_train_dataloader,
+    get_indexed_dataloader,
+    split_held_out_dataloader,
     get_cifar_train_dataloader,
     get_cifar_test_dataloader,
     get_mnist_test_dataloader,
@@ -1,4 +1,4 @@
-from typing import Dict, Any, Union
+from typing import Dict, Any, Iterator, Union
 import json
 
 from torch.utils.data import DataLoader
@@ -76,6 +76,63 @@ class WarmUpLR(_LRScheduler):
         return [base_lr * self.last_epoch / (self.total_iters + 1e-8) for base_lr in self.base_lrs]
 
 
+class DevicePrefetcher:
+    """wrap a dataloader, batches are pinned and copied to `device` one batch ahead
+
+    copies are issued on a side cuda stream, so the next batch is transferred while
+    the current one is being attacked and trained. tensors in nested tuples/lists/dicts
+    are moved, other items are kept unchanged. on cpu the dataloader is iterated as is
+    """
+
+    def __init__(self, data_loader: DataLoader, device: Union[str, torch.device]):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self) -> Iterator:
+        if self.device.type != "cuda":
+            yield from self.data_loader
+            return
+
+        stream = torch.cuda.Stream(device=self.device)
+        next_batch = None
+        for batch in self.data_loader:
+            with torch.cuda.stream(stream):
+                batch = self._to_device(batch)
+            if next_batch is not None:
+                yield next_batch
+            torch.cuda.current_stream(self.device).wait_stream(stream)
+            self._record_stream(batch)
+            next_batch = batch
+
+        if next_batch is not None:
+            yield next_batch
+
+    def _to_device(self, batch):
+        if isinstance(batch, Tensor):
+            if not batch.is_pinned():
+                batch = batch.pin_memory()
+            return batch.to(self.device, non_blocking=True)
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(self._to_device(item) for item in batch)
+        if isinstance(batch, dict):
+            return {key: self._to_device(value) for key, value in batch.items()}
+        return batch
+
+    def _record_stream(self, batch) -> None:
+        """memory of `batch` is allocated on side stream, mark it as used by current stream"""
+        if isinstance(batch, Tensor):
+            batch.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(batch, (list, tuple)):
+            for item in batch:
+                self._record_stream(item)
+        elif isinstance(batch, dict):
+            for value in batch.values():
+                self._record_stream(value)
+
+
 def attack_loss(X, y, model: torch.nn.Module, attacker, eps=0.1, loss=torch.nn.CrossEntropyLoss()) -> torch.Tensor:
     y_hat = model(X)
     adv_y_hat = attacker(model, eps=eps).cal_perturbation(X, y)
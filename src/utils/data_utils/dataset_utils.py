@@ -99,6 +99,21 @@ class SubsetDataset(Dataset):
         return True
 
 
+class IndexedDataset(Dataset):
+
+    def __init__(self, dataset: Dataset):
+        """wrap `dataset` to return `(inputs, labels, index)`, index is the position of sample in `dataset`"""
+        self._dataset = dataset
+
+    def __getitem__(self, idx) -> Tuple[Tensor, Tensor, int]:
+        inputs, labels = self._dataset[idx]
+
+        return inputs, labels, idx
+
+    def __len__(self):
+        return len(self._dataset)
+
+
 class GTSRB(VisionDataset):
 
     train_csv_path: str = "Train.csv"
@@ -1,16 +1,19 @@
 from typing import Tuple
 import os
 
+import torch
 import torchvision
 import torchvision.transforms as transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, RandomSampler, Subset
 
 from src import settings
 from ..logging_utils import logger
-from .dataset_utils import SubsetDataset, GTSRB
+from .dataset_utils import SubsetDataset, GTSRB, IndexedDataset
 
 DATA_DIR = "~/dataset"
 
+PIN_MEMORY = settings.pin_memory and torch.cuda.is_available()
+
 # default mean of cifar100
 CIFAR100_TRAIN_MEAN = (0.5070751592371323, 0.48654887331495095, 0.4409178433670343)
 # default std of cifar100
@@ -79,7 +82,37 @@ def get_subset_cifar_train_dataloader(partition_ratio: float, dataset=settings.d
     )
     subset_dataset = SubsetDataset(whole_cifar_dataloader, partition_ratio)
     logger.info(f"subset size: {len(subset_dataset)}")
-    return DataLoader(subset_dataset, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    return DataLoader(subset_dataset, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                      pin_memory=PIN_MEMORY)
+
+
+def get_indexed_dataloader(data_loader: DataLoader) -> DataLoader:
+    """rebuild `data_loader` so that every batch is `(inputs, labels, indices)`
+
+    indices are positions of samples in `data_loader.dataset`, batch size, workers and shuffle are kept
+    """
+    shuffle = isinstance(data_loader.sampler, RandomSampler)
+    return DataLoader(IndexedDataset(data_loader.dataset), shuffle=shuffle, num_workers=data_loader.num_workers,
+                      batch_size=data_loader.batch_size, pin_memory=data_loader.pin_memory)
+
+
+def split_held_out_dataloader(data_loader: DataLoader, held_out_size: int,
+                              seed: int = 0) -> Tuple[DataLoader, DataLoader]:
+    """split a fixed random slice of `held_out_size` samples off `data_loader.dataset`
+
+    return loader of the remaining samples(batch size, workers and shuffle are kept) and loader of the
+    held-out slice(not shuffled), the slice only depends on `seed` and size of dataset
+    """
+    indices = torch.randperm(len(data_loader.dataset), generator=torch.Generator().manual_seed(seed)).tolist()
+    shuffle = isinstance(data_loader.sampler, RandomSampler)
+    train_loader = DataLoader(Subset(data_loader.dataset, indices[held_out_size:]), shuffle=shuffle,
+                              num_workers=data_loader.num_workers, batch_size=data_loader.batch_size,
+                              pin_memory=data_loader.pin_memory)
+    held_out_loader = DataLoader(Subset(data_loader.dataset, indices[:held_out_size]), shuffle=False,
+                                 num_workers=data_loader.num_workers, batch_size=data_loader.batch_size,
+                                 pin_memory=data_loader.pin_memory)
+
+    return train_loader, held_out_loader
 
 
 def get_cifar_train_dataloader(dataset=settings.dataset_name, batch_size=settings.batch_size,
@@ -109,7 +142,8 @@ def get_cifar_train_dataloader(dataset=settings.dataset_name, batch_size=setting
     train_dataset = _data(root=os.path.join(DATA_DIR, "CIFAR"), train=True, download=True,
                           transform=transform_train)
 
-    train_loader = DataLoader(train_dataset, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    train_loader = DataLoader(train_dataset, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                              pin_memory=PIN_MEMORY)
 
     return train_loader
 
@@ -134,7 +168,8 @@ def get_cifar_test_dataloader(dataset=settings.dataset_name, batch_size=settings
         compose_list.append(transforms.Normalize(mean, std))
     transform_test = transforms.Compose(compose_list)
     test = _data(root=os.path.join(DATA_DIR, "CIFAR"), train=False, download=True, transform=transform_test)
-    test_loader = DataLoader(test, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    test_loader = DataLoader(test, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                             pin_memory=PIN_MEMORY)
 
     return test_loader
 
@@ -155,7 +190,8 @@ def get_mnist_train_dataloader(batch_size=settings.batch_size, num_workers=setti
 
     train_data = torchvision.datasets.MNIST(root=os.path.join(DATA_DIR, "MNIST"), train=True,
                                             download=True, transform=transform)
-    train_loader = DataLoader(train_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    train_loader = DataLoader(train_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                              pin_memory=PIN_MEMORY)
 
     return train_loader
 
@@ -175,7 +211,8 @@ def get_mnist_test_dataloader(batch_size=settings.batch_size, num_workers=settin
 
     test_data = torchvision.datasets.MNIST(root=os.path.join(DATA_DIR, "MNIST"), train=False,
                                            download=True, transform=transform)
-    test_loader = DataLoader(test_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    test_loader = DataLoader(test_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                             pin_memory=PIN_MEMORY)
 
     return test_loader
 
@@ -193,7 +230,8 @@ def get_mnist_test_dataloader_one_channel(batch_size=settings.batch_size, num_wo
 
     test_data = torchvision.datasets.MNIST(root=os.path.join(DATA_DIR, "MNIST"), train=False,
                                            download=True, transform=transform)
-    test_loader = DataLoader(test_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    test_loader = DataLoader(test_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                             pin_memory=PIN_MEMORY)
 
     return test_loader
 
@@ -210,7 +248,8 @@ def get_mnist_train_dataloader_one_channel(batch_size=settings.batch_size, num_w
 
     train_data = torchvision.datasets.MNIST(root=os.path.join(DATA_DIR, "MNIST"), train=True,
                                             download=True, transform=transform)
-    train_loader = DataLoader(train_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    train_loader = DataLoader(train_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                              pin_memory=PIN_MEMORY)
 
     return train_loader
 
@@ -227,7 +266,8 @@ def get_svhn_train_dataloder(batch_size=settings.batch_size, num_workers=setting
 
     train_data = torchvision.datasets.SVHN(root=os.path.join(DATA_DIR, "SVHN"), split="train",
                                            download=True, transform=transform)
-    train_loader = DataLoader(train_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    train_loader = DataLoader(train_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                              pin_memory=PIN_MEMORY)
 
     return train_loader
 
@@ -244,7 +284,8 @@ def get_svhn_test_dataloader(batch_size=settings.batch_size, num_workers=setting
 
     test_data = torchvision.datasets.SVHN(root=os.path.join(DATA_DIR, "SVHN"), split="test",
                                           download=True, transform=transform)
-    test_loader = DataLoader(test_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    test_loader = DataLoader(test_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                             pin_memory=PIN_MEMORY)
 
     return test_loader
 
@@ -262,7 +303,8 @@ def get_gtsrb_train_dataloder(batch_size=settings.batch_size, num_workers=settin
 
     train_data = GTSRB(root=os.path.join(DATA_DIR, "GTSRB"),
                        train=True, transform=transform)
-    train_loader = DataLoader(train_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    train_loader = DataLoader(train_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                              pin_memory=PIN_MEMORY)
 
     return train_loader
 
@@ -280,6 +322,7 @@ def get_gtsrb_test_dataloder(batch_size=settings.batch_size, num_workers=setting
 
     test_data = GTSRB(root=os.path.join(DATA_DIR, "GTSRB"),
                       train=False, transform=transform)
-    test_loader = DataLoader(test_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+    test_loader = DataLoader(test_data, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                             pin_memory=PIN_MEMORY)
 
     return test_loader
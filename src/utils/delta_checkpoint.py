@@ -0,0 +1,87 @@
+"""state_dicts stored as difference to a base(teacher) model file"""
+from typing import Any, Dict, Optional, Union
+from collections import OrderedDict
+import hashlib
+import os
+
+import torch
+
+from .logging_utils import logger
+
+# marks a delta state_dict, a plain state_dict never contains this key
+_DELTA_KEY = "__delta_of__"
+
+
+def file_digest(path: str) -> str:
+    """sha256 of file at `path`"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def is_delta_state_dict(obj: Any) -> bool:
+    return isinstance(obj, dict) and _DELTA_KEY in obj
+
+
+def make_delta_state_dict(state_dict: Dict[str, torch.Tensor], base_state_dict: Dict[str, torch.Tensor],
+                          base_path: str, base_digest: str) -> Dict[str, Any]:
+    """keep tensors of `state_dict` that differ from `base_state_dict`
+
+    Args:
+        state_dict: state_dict of current model
+        base_state_dict: state_dict loaded from `base_path`, kept in cpu memory
+        base_path: file of base model, saved as absolute path
+        base_digest: `file_digest` of `base_path`, checked when the delta is rebuilt
+
+    Notes:
+        keys of `state_dict` are kept in order, so keys missing from base model(e.g. `weight_orig`
+        of spectral norm layers) are stored as changed tensors. `_metadata` of `state_dict`(versions
+        of modules used by `load_state_dict`) is kept as well
+    """
+    changed = {}
+    for key, value in state_dict.items():
+        base_value = base_state_dict.get(key)
+        if base_value is None or base_value.shape != value.shape or \
+                not torch.equal(value.detach().cpu(), base_value):
+            changed[key] = value
+
+    return {
+        _DELTA_KEY: {"path": os.path.abspath(base_path), "sha256": base_digest},
+        "keys": list(state_dict.keys()),
+        "changed": changed,
+        "metadata": getattr(state_dict, "_metadata", None),
+    }
+
+
+def rebuild_state_dict(obj: Dict[str, Any],
+                       map_location: Optional[Union[str, torch.device]] = None) -> Dict[str, torch.Tensor]:
+    """return full state_dict of `obj`, plain state_dict is returned unchanged"""
+    if not is_delta_state_dict(obj):
+        return obj
+
+    base = obj[_DELTA_KEY]
+    if not os.path.exists(base["path"]):
+        raise FileNotFoundError(f"base model `{base['path']}` of delta state_dict does not exist")
+    if file_digest(base["path"]) != base["sha256"]:
+        raise ValueError(f"base model `{base['path']}` has been changed since delta state_dict was saved")
+    logger.debug(f"rebuild state_dict from base model `{base['path']}`")
+
+    # base model may be a delta state_dict as well
+    base_state_dict = load_model_state_dict(base["path"], map_location=map_location)
+    changed = obj["changed"]
+
+    state_dict = OrderedDict((key, changed[key] if key in changed else base_state_dict[key]) for key in obj["keys"])
+    # deltas saved before metadata was kept fall back to metadata of base model
+    metadata = obj.get("metadata", getattr(base_state_dict, "_metadata", None))
+    if metadata is not None:
+        state_dict._metadata = metadata
+
+    return state_dict
+
+
+def load_model_state_dict(path: str,
+                          map_location: Optional[Union[str, torch.device]] = None) -> Dict[str, torch.Tensor]:
+    """`torch.load` a model state_dict, delta state_dict is rebuilt from its base model"""
+    return rebuild_state_dict(torch.load(path, map_location=map_location), map_location=map_location)
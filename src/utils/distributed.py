@@ -0,0 +1,94 @@
+"""multi-process data parallel training with `torch.distributed`"""
+from typing import Callable, Optional
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn import Module
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data.distributed import DistributedSampler
+
+from .logging_utils import logger
+
+
+def init_distributed(backend: str = "gloo") -> None:
+    """join process group described by environment variables `RANK`, `WORLD_SIZE`,
+    `MASTER_ADDR` and `MASTER_PORT`(set by `src.launch` or `torchrun`), no-op if already joined"""
+    if dist.is_initialized():
+        return
+    if "WORLD_SIZE" not in os.environ:
+        raise ValueError("`settings.parallelism` is set, launch training with `python -m src.launch`")
+
+    dist.init_process_group(backend=backend, init_method="env://")
+    logger.info(f"joined process group, rank: {get_rank()}, world size: {get_world_size()}, backend: {backend}")
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    """only main process(rank 0) writes checkpoints, models and tensorboard logs"""
+    return get_rank() == 0
+
+
+def get_distributed_dataloader(data_loader: DataLoader) -> DataLoader:
+    """rebuild `data_loader` so that every rank iterates its own shard of dataset
+
+    batch size is divided by world size to keep the effective batch size, shards are padded
+    to the same length so that all ranks run the same number of steps
+    """
+    world_size = get_world_size()
+    if data_loader.batch_size % world_size:
+        logger.warning(f"batch size {data_loader.batch_size} is not divisible by world size {world_size}")
+    sampler = DistributedSampler(data_loader.dataset, num_replicas=world_size, rank=get_rank(),
+                                 shuffle=isinstance(data_loader.sampler, (RandomSampler, DistributedSampler)))
+
+    return DataLoader(data_loader.dataset, sampler=sampler, num_workers=data_loader.num_workers,
+                      batch_size=max(data_loader.batch_size // world_size, 1),
+                      pin_memory=data_loader.pin_memory)
+
+
+class _Forward(Module):
+    """`forward` run on parameters and buffers of `module`, see `distribute_module`"""
+
+    def __init__(self, module: Module, forward: Callable):
+        super().__init__()
+        self.module = module
+        self._forward = forward
+
+    def forward(self, *args, **kwargs):
+        return self._forward(*args, **kwargs)
+
+
+def distribute_module(module: Module, device: torch.device,
+                      forward: Optional[Callable] = None) -> DistributedDataParallel:
+    """wrap `module` by `DistributedDataParallel`
+
+    parameters and buffers(e.g. running statistics of BN) of rank 0 are copied to all ranks when it is built and
+    gradients are averaged over ranks in backward. only parameters that require gradients when it is built are
+    averaged, so it should be built after layers are frozen. buffers are not broadcast before every forward,
+    since trainers may forward several times before backward(e.g. adversarial and clean batches), every rank
+    then updates running statistics on its own shard and rank 0 saves its own ones
+
+    Args:
+        forward: run instead of `module.forward`, e.g. a forward of the last blocks of `module` only
+    """
+    if forward is not None:
+        module = _Forward(module, forward)
+
+    return DistributedDataParallel(module, device_ids=[device] if device.type == "cuda" else None,
+                                   broadcast_buffers=False)
@@ -0,0 +1,96 @@
+"""per-sample features of a frozen model prefix stored in memory-mapped files"""
+from typing import Callable, Tuple, Union
+import os
+
+import numpy as np
+import torch
+from torch import Tensor
+from torch.utils.data import DataLoader, Dataset
+
+from .logging_utils import logger
+
+
+def _features_path(path: str) -> str:
+    return f"{path}.npy"
+
+
+def _labels_path(path: str) -> str:
+    return f"{path}_labels.npy"
+
+
+def feature_store_exists(path: str) -> bool:
+    return os.path.exists(_features_path(path)) and os.path.exists(_labels_path(path))
+
+
+def build_feature_store(path: str, extract: Callable[[Tensor], Tensor], dataset: Dataset, views: int = 1,
+                        half: bool = True, batch_size: int = 128, num_workers: int = 0,
+                        device: Union[str, torch.device] = "cpu") -> None:
+    """write `extract(inputs)` of every sample of `dataset` to `{path}.npy` and labels to `{path}_labels.npy`
+
+    Args:
+        extract: maps a batch of inputs to a batch of features, called under `torch.no_grad`
+        views: number of passes over `dataset`, every pass is one view of each sample with
+               the (random) transforms of `dataset`
+        half: store features as float16
+
+    Notes:
+        features are stored as an array of shape `(views, num_samples, *feature_shape)`, features and
+        labels are written to temporary files first so that an interrupted build is never reused
+    """
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    num_samples = len(dataset)
+    features = None
+    labels = np.zeros(num_samples, dtype=np.int64)
+    tmp_path = f"{_features_path(path)}.tmp"
+
+    with torch.no_grad():
+        for view in range(views):
+            offset = 0
+            for data in loader:
+                batch_features = extract(data[0].to(device)).cpu()
+                if features is None:
+                    features = np.lib.format.open_memmap(
+                        tmp_path, mode="w+", dtype=np.float16 if half else np.float32,
+                        shape=(views, num_samples, *batch_features.shape[1:]))
+                batch_size = batch_features.shape[0]
+                features[view, offset:offset + batch_size] = batch_features.numpy()
+                labels[offset:offset + batch_size] = data[1].numpy()
+                offset += batch_size
+            logger.info(f"extracted features of view {view + 1}/{views}")
+
+    features.flush()
+    del features
+    os.replace(tmp_path, _features_path(path))
+    labels_tmp_path = f"{_labels_path(path)}.tmp"
+    with open(labels_tmp_path, "wb") as f:
+        np.save(f, labels)
+    os.replace(labels_tmp_path, _labels_path(path))
+    logger.info(f"feature store is saved to '{_features_path(path)}'")
+
+
+class FeatureDataset(Dataset):
+
+    def __init__(self, path: str):
+        """dataset of features written by `build_feature_store`, every access returns a random view
+
+        the memory-mapped file is opened lazily, so the dataset can be sent to dataloader workers
+        """
+        self._path = _features_path(path)
+        self._labels = torch.from_numpy(np.load(_labels_path(path)))
+        self._features = None
+        self.views, self.num_samples = np.load(self._path, mmap_mode="r").shape[:2]
+
+    def __len__(self) -> int:
+        return self.num_samples
+
+    def __getitem__(self, index: int) -> Tuple[Tensor, Tensor]:
+        if self._features is None:
+            self._features = np.load(self._path, mmap_mode="r")
+        view = torch.randint(self.views, ()).item() if self.views > 1 else 0
+        feature = torch.from_numpy(np.array(self._features[view, index], dtype=np.float32))
+
+        return feature, self._labels[index]
+
+    def __getstate__(self):
+        # memory map is reopened in dataloader workers
+        return {**self.__dict__, "_features": None}
@@ -1,5 +1,6 @@
 import toml
 
+import os
 import logging.config
 from typing import Union, Optional, Callable
 from pathlib import PurePath
@@ -67,6 +68,10 @@ class MyLogger:
         self._logger.warning(msg, *args, **kwargs)
 
     def set_log_file(self, filename: Union[str, PurePath]):
+        # in distributed training other ranks than rank 0 write their own log file
+        rank = int(os.environ.get("RANK", 0))
+        if rank:
+            filename = f"{filename}.rank{rank}"
         self._config_dict["handlers"]["file"]["filename"] = filename
 
     def set_logger(self, logger_name: str = settings.logger_name):
@@ -79,6 +84,9 @@ class MyLogger:
 
         logging.config.dictConfig(self._config_dict)
         self._logger = logging.getLogger(logger_name)
+        # only rank 0 logs training progress, other ranks only log warnings
+        if int(os.environ.get("RANK", 0)):
+            self._logger.setLevel(logging.WARNING)
 
     def change_log_file(self, filename: Union[str, PurePath]):
         """equals `set_log_file + set_logger`"""
@@ -0,0 +1,71 @@
+"""accumulate training metrics on device without synchronizing every batch"""
+from typing import Dict, Optional, Union
+
+import torch
+import torch.distributed as dist
+from torch import Tensor
+
+from .distributed import is_distributed, get_world_size
+
+
+class MetricsAccumulator:
+
+    def __init__(self, sync_every: Optional[int] = None):
+        """running sums of per-batch metrics
+
+        tensors are summed where they live, values are only copied to host(one synchronization for
+        all metrics) by `totals`/`averages`, or every `sync_every` updates if it is given
+
+        Args:
+            sync_every: move sums to host every `sync_every` updates, `None` means only when they are read
+
+        Notes:
+            in distributed training sums are also reduced over all ranks, so every rank must update the
+            same metrics the same number of times
+        """
+        self._sync_every = sync_every
+        self._device_sums: Dict[str, Union[Tensor, float]] = {}
+        self._host_sums: Dict[str, float] = {}
+        self._counts: Dict[str, int] = {}
+        self._updates = 0
+
+    def update(self, **metrics: Union[Tensor, float]) -> None:
+        for name, value in metrics.items():
+            if isinstance(value, Tensor):
+                value = value.detach().float()
+            self._device_sums[name] = self._device_sums.get(name, 0.) + value
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+        self._updates += 1
+        if self._sync_every and self._updates % self._sync_every == 0:
+            self._sync()
+
+    def _sync(self) -> None:
+        names = list(self._device_sums.keys())
+        if not names:
+            return
+
+        tensor_names = [name for name in names if isinstance(self._device_sums[name], Tensor)]
+        if tensor_names:
+            values = torch.stack([self._device_sums[name].to(self._device_sums[tensor_names[0]].device)
+                                  for name in tensor_names]).tolist()
+            for name, value in zip(tensor_names, values):
+                self._device_sums[name] = value
+
+        if is_distributed():
+            rank_sums = torch.tensor([self._device_sums[name] for name in names], dtype=torch.float64)
+            dist.all_reduce(rank_sums)
+            for name, value in zip(names, rank_sums.tolist()):
+                self._device_sums[name] = value
+
+        for name in names:
+            self._host_sums[name] = self._host_sums.get(name, 0.) + self._device_sums[name]
+        self._device_sums.clear()
+
+    def totals(self) -> Dict[str, float]:
+        self._sync()
+        return dict(self._host_sums)
+
+    def averages(self) -> Dict[str, float]:
+        """average of every metric over its updates(of all ranks)"""
+        return {name: value / (self._counts[name] * get_world_size()) for name, value in self.totals().items()}
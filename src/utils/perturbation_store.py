@@ -0,0 +1,99 @@
+"""per-sample adversarial perturbations kept across epochs"""
+from typing import Optional, Tuple
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch import Tensor
+
+from .checkpoint_writer import get_checkpoint_writer
+from .distributed import is_distributed
+
+
+class PerturbationStore:
+
+    def __init__(self, num_samples: int, sample_shape: Tuple[int, ...], memmap_path: Optional[str] = None):
+        """float16 buffer of perturbations indexed by dataset sample index
+
+        Args:
+            num_samples: size of dataset
+            sample_shape: shape of one input, e.g. `(3, 32, 32)`
+            memmap_path: store perturbations in a memory-mapped `.npy` file instead of host memory,
+                         an existing file with the same shape is reopened
+
+        Notes:
+            1. samples which have never been stored are marked as uninitialized by `get`
+            2. `save` only writes the buffer for in-memory store, memory-mapped store is flushed
+               and only its initialized mask is written
+            3. in distributed training every rank only sets samples of its own shard, `synchronize`
+               merges them so that all ranks(and the file written by rank 0) hold all samples
+        """
+        shape = (num_samples, *sample_shape)
+        self._memmap_path = memmap_path
+        if memmap_path:
+            reopen = os.path.exists(memmap_path) and np.load(memmap_path, mmap_mode="r").shape == shape
+            self._memmap = np.lib.format.open_memmap(memmap_path, mode="r+" if reopen else "w+",
+                                                     dtype=np.float16, shape=shape)
+            self._buffer = torch.from_numpy(self._memmap)
+        else:
+            self._buffer = torch.zeros(shape, dtype=torch.float16)
+        self._initialized = torch.zeros(num_samples, dtype=torch.bool)
+        # samples set on this rank since last `synchronize`
+        self._updated = torch.zeros(num_samples, dtype=torch.bool)
+
+    def get(self, indices: Tensor, device: torch.device) -> Tuple[Tensor, Tensor]:
+        """return float32 perturbations and initialized mask of `indices`"""
+        indices = indices.cpu()
+        delta = self._buffer[indices].to(device=device, dtype=torch.float32)
+        initialized = self._initialized[indices].to(device)
+
+        return delta, initialized
+
+    def set(self, indices: Tensor, delta: Tensor) -> None:
+        indices = indices.cpu()
+        self._buffer[indices] = delta.detach().to(device="cpu", dtype=torch.float16)
+        self._initialized[indices] = True
+        self._updated[indices] = True
+
+    def synchronize(self, chunk_size: int = 4096) -> None:
+        """merge samples set on all ranks since last call, no-op if not distributed
+
+        a sample set on several ranks(shards are padded with duplicated samples) gets the mean of
+        their perturbations. the buffer is reduced in chunks of `chunk_size` samples to bound memory
+        """
+        if not is_distributed():
+            return
+
+        for start in range(0, self._buffer.shape[0], chunk_size):
+            end = start + chunk_size
+            updated = self._updated[start:end]
+            counts = updated.to(torch.float32)
+            dist.all_reduce(counts)
+            merged = torch.where(updated.view(-1, *([1] * (self._buffer.dim() - 1))),
+                                 self._buffer[start:end].to(torch.float32), torch.zeros(()))
+            dist.all_reduce(merged)
+            received = counts > 0
+            self._buffer[start:end][received] = (merged[received] / counts[received].view(
+                -1, *([1] * (self._buffer.dim() - 1)))).to(torch.float16)
+            self._initialized[start:end] |= received
+        self._updated.zero_()
+        # ranks sharing a memory-mapped file write the same values, wait for all of them
+        dist.barrier()
+
+    def save(self, path: str) -> None:
+        """write store to `path`, this is a collective call in distributed training, see `synchronize`"""
+        self.synchronize()
+        if self._memmap_path:
+            self._memmap.flush()
+            get_checkpoint_writer().save({"initialized": self._initialized}, path)
+        else:
+            get_checkpoint_writer().save({"initialized": self._initialized, "buffer": self._buffer}, path)
+
+    def load(self, path: str) -> None:
+        state = torch.load(path)
+        if state["initialized"].shape != self._initialized.shape:
+            raise ValueError(f"perturbations saved in `{path}` do not match size of dataset")
+        self._initialized.copy_(state["initialized"])
+        if "buffer" in state:
+            self._buffer.copy_(state["buffer"])
@@ -0,0 +1,107 @@
+"""wall time of training steps split into phases"""
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Union
+import json
+import time
+
+import torch
+
+from .logging_utils import logger
+from .distributed import is_main_process
+
+
+class StepProfiler:
+
+    def __init__(self, device: Union[str, torch.device], enabled: bool = False):
+        """accumulate wall time of named phases, e.g. `data`, `h2d`, `attack`, `forward`, `backward`,
+        `optimizer`, `regularizer` and `eval`
+
+        Args:
+            device: training device, cuda is synchronized around every phase so that asynchronous
+                    kernels are counted in the phase which launched them
+            enabled: all methods are no-op if `False`
+
+        Notes:
+            1. phases must not be nested, otherwise the inner time is counted twice
+            2. feature hooks run inside `forward`, only costs computed from hooked features are
+               counted as `regularizer`
+        """
+        self.enabled = enabled
+        self._synchronize = enabled and torch.device(device).type == "cuda"
+        self._epoch_times: Dict[str, float] = defaultdict(float)
+        self._total_times: Dict[str, float] = defaultdict(float)
+        self._epoch_steps = 0
+        self._total_steps = 0
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+
+        self._sync()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            self._epoch_times[name] += time.perf_counter() - start_time
+
+    def _sync(self) -> None:
+        if self._synchronize:
+            torch.cuda.synchronize()
+
+    def iterate(self, loader: Iterable) -> Iterator:
+        """iterate `loader`, waiting for each batch is counted as `data` and each batch as a step"""
+        if not self.enabled:
+            yield from loader
+            return
+
+        iterator = iter(loader)
+        while True:
+            with self.phase("data"):
+                try:
+                    batch = next(iterator)
+                except StopIteration:
+                    return
+            self._epoch_steps += 1
+            yield batch
+
+    def end_epoch(self, ep: int, summary_writer=None) -> Dict[str, float]:
+        """write seconds of every phase in epoch `ep` to `summary_writer` and return them"""
+        if not self.enabled:
+            return {}
+
+        epoch_times = dict(self._epoch_times)
+        for name, seconds in epoch_times.items():
+            self._total_times[name] += seconds
+            if summary_writer is not None:
+                summary_writer.add_scalar(f"profile/{name}", seconds, ep)
+        self._total_steps += self._epoch_steps
+        logger.debug(f"phase time of epoch {ep}: " +
+                     "   ".join(f"{name}: {seconds:.2f}s" for name, seconds in epoch_times.items()))
+
+        self._epoch_times.clear()
+        self._epoch_steps = 0
+
+        return epoch_times
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        total = sum(self._total_times.values())
+        return {
+            "steps": self._total_steps,
+            "seconds": dict(self._total_times),
+            "seconds_per_step": {name: seconds / max(self._total_steps, 1)
+                                 for name, seconds in self._total_times.items()},
+            "fraction": {name: seconds / total if total else 0. for name, seconds in self._total_times.items()},
+        }
+
+    def dump(self, path: Optional[str]) -> None:
+        """write summary of all finished epochs to json file `path`, only on rank 0"""
+        if not self.enabled or not path or not is_main_process():
+            return
+
+        with open(path, "w", encoding="utf8") as f:
+            json.dump(self.summary(), f, indent=2)
+        logger.info(f"step profile is saved to '{path}'")
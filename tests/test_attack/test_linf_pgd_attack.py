@@ -0,0 +1,211 @@
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from src import settings
+from src import attack
+from src.attack import LinfPGDAttack, LinfFGSMAttack, L2PGDAttack, CWMarginLoss, attack_context
+from src.networks import resnet18
+from src.utils import get_mean_and_std
+
+DEVICE = "cpu"
+BATCH_SIZE = 8
+
+
+def make_model():
+    torch.manual_seed(settings.seed)
+    model = resnet18(num_classes=10)
+    model.eval()
+
+    return model
+
+
+def make_batch():
+    torch.manual_seed(settings.seed)
+    mean, std = get_mean_and_std("cifar10")
+    # normalized images in valid range
+    inputs = (torch.rand(BATCH_SIZE, 3, 32, 32) - torch.tensor(mean).view(3, 1, 1)) / torch.tensor(std).view(3, 1, 1)
+    labels = torch.randint(0, 10, (BATCH_SIZE,))
+
+    return inputs, labels
+
+
+def check_perturbation(attacker: LinfPGDAttack, inputs: torch.Tensor, adv_inputs: torch.Tensor):
+    assert adv_inputs.shape == inputs.shape
+    assert torch.all((adv_inputs - inputs).abs() <= attacker.epsilon + 1e-6)
+    assert torch.all(adv_inputs >= attacker.min - 1e-6)
+    assert torch.all(adv_inputs <= attacker.max + 1e-6)
+
+
+def test_early_stop_pgd():
+    model = make_model()
+    inputs, labels = make_batch()
+    # make every sample correctly classified at first
+    with torch.no_grad():
+        labels = model(inputs).argmax(dim=1)
+
+    attacker = LinfPGDAttack(model, num_steps=10, dataset_name="cifar10", device=DEVICE, early_stop=True)
+    adv_inputs = attacker.calc_perturbation(inputs, labels)
+    check_perturbation(attacker, inputs, adv_inputs)
+    assert not adv_inputs.requires_grad
+
+    # samples which are fooled must stay fooled
+    with torch.no_grad():
+        early_stop_correct = (model(adv_inputs).argmax(dim=1) == labels).sum().item()
+    assert early_stop_correct < BATCH_SIZE
+
+
+def test_restarts_pgd():
+    model = make_model()
+    inputs, labels = make_batch()
+
+    for restart_batch_size in [None, BATCH_SIZE // 2, BATCH_SIZE, 3 * BATCH_SIZE]:
+        attacker = LinfPGDAttack(model, num_steps=3, dataset_name="cifar10", device=DEVICE,
+                                 restarts=4, restart_batch_size=restart_batch_size)
+        adv_inputs = attacker.calc_perturbation(inputs, labels)
+        check_perturbation(attacker, inputs, adv_inputs)
+
+
+def test_restarts_are_scored_in_eval_mode():
+    model = make_model()
+    model.train()
+    inputs, labels = make_batch()
+    # training mode of forwards which do not compute gradients
+    scoring_modes = []
+    model.register_forward_hook(
+        lambda module, args, output: None if torch.is_grad_enabled() else scoring_modes.append(module.training))
+
+    attacker = LinfPGDAttack(model, num_steps=1, dataset_name="cifar10", device=DEVICE, restarts=2)
+    attacker.calc_perturbation(inputs, labels)
+
+    assert scoring_modes == [False]
+    assert model.training
+
+
+def test_restarts_need_random_init():
+    model = make_model()
+    try:
+        LinfPGDAttack(model, dataset_name="cifar10", device=DEVICE, random_init=0, restarts=2)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("restarts without random init are accepted")
+
+
+def test_attack_only_computes_input_gradients():
+    model = make_model()
+    model.train()
+    inputs, labels = make_batch()
+
+    attacker = LinfPGDAttack(model, num_steps=2, dataset_name="cifar10", device=DEVICE)
+    with attack_context(model):
+        assert not model.training
+        attacker.calc_perturbation(inputs, labels)
+
+    assert model.training
+    for p in model.parameters():
+        assert p.requires_grad
+        assert p.grad is None
+
+
+def test_fgsm_attack():
+    model = make_model()
+    inputs, labels = make_batch()
+
+    # params of pgd can be reused, `random_init` and `num_steps` are ignored
+    attacker = LinfFGSMAttack(model, dataset_name="cifar10", device=DEVICE, random_init=0, num_steps=20)
+    assert attacker.num_steps == 1 and attacker.random_init
+    assert torch.all(attacker.step_size > attacker.epsilon)
+
+    adv_inputs = attacker.calc_perturbation(inputs, labels)
+    check_perturbation(attacker, inputs, adv_inputs)
+
+
+def test_warm_start_pgd():
+    model = make_model()
+    inputs, labels = make_batch()
+
+    attacker = LinfPGDAttack(model, num_steps=1, dataset_name="cifar10", device=DEVICE, restarts=2)
+    # delta of last epoch may be out of the epsilon ball, e.g. after epsilon is changed
+    init_delta = 2 * attacker.random_delta(torch.zeros_like(inputs))
+    adv_inputs = attacker.calc_perturbation(inputs, labels, init_delta=init_delta)
+    check_perturbation(attacker, inputs, adv_inputs)
+
+
+def test_warm_start_is_one_of_restarts():
+    model = make_model()
+    inputs, labels = make_batch()
+
+    attacker = LinfPGDAttack(model, num_steps=2, dataset_name="cifar10", device=DEVICE, restarts=3)
+    init_delta = attacker.random_delta(torch.zeros_like(inputs))
+    adv_inputs = attacker.calc_perturbation(inputs, labels, init_delta=init_delta)
+    check_perturbation(attacker, inputs, adv_inputs)
+    assert attacker.gradient_evaluations == 3 * 2 * BATCH_SIZE
+
+    # kept perturbation is at least as strong as the one of the warm start alone
+    attacker.restarts = 1
+    warm_adv_inputs = attacker.calc_perturbation(inputs, labels, init_delta=init_delta)
+    with torch.no_grad():
+        outputs, warm_outputs = model(adv_inputs), model(warm_adv_inputs)
+    fooled, warm_fooled = outputs.argmax(dim=1) != labels, warm_outputs.argmax(dim=1) != labels
+    loss = torch.nn.functional.cross_entropy(outputs, labels, reduction="none")
+    warm_loss = torch.nn.functional.cross_entropy(warm_outputs, labels, reduction="none")
+    assert torch.all(fooled | ~warm_fooled)
+    assert torch.all(fooled | (loss >= warm_loss - 1e-5))
+
+
+def test_restarts_are_picked_by_attack_loss():
+    model = make_model()
+    inputs, labels = make_batch()
+    loss_function = CWMarginLoss()
+    attacker = LinfPGDAttack(model, dataset_name="cifar10", device=DEVICE, loss_function=loss_function)
+
+    with torch.no_grad():
+        outputs = model(inputs)
+    assert torch.allclose(attacker._sample_loss(outputs, labels), CWMarginLoss(reduction="none")(outputs, labels))
+    assert loss_function.reduction == "mean"
+
+
+def test_attack_epsilons_curve():
+    model = make_model()
+    inputs, labels = make_batch()
+    with torch.no_grad():
+        labels = model(inputs).argmax(dim=1)
+    test_loader = DataLoader(TensorDataset(inputs, labels), batch_size=BATCH_SIZE // 2)
+
+    params = {"random_init": 1, "step_size": 2 / 255, "num_steps": 5, "dataset_name": "cifar10"}
+    epsilons = [8 / 255, 1 / 255, 4 / 255]
+    curve = attack.test_attack_epsilons(model, test_loader, LinfPGDAttack, params, epsilons, DEVICE)
+
+    assert list(curve.keys()) == [0] + sorted(epsilons)
+    assert curve[0] == 1
+    accuracies = list(curve.values())
+    assert all(a >= b for a, b in zip(accuracies, accuracies[1:]))
+
+
+def test_l2_pgd():
+    model = make_model()
+    inputs, labels = make_batch()
+
+    for early_stop in [False, True]:
+        attacker = L2PGDAttack(model, epsilon=0.5, step_size=0.2, num_steps=5, dataset_name="cifar10",
+                               device=DEVICE, early_stop=early_stop)
+        adv_inputs = attacker.calc_perturbation(inputs, labels)
+        assert adv_inputs.shape == inputs.shape
+        # l2 norm is measured in [0, 1] input space
+        norm = ((adv_inputs - inputs) * attacker.std).flatten(start_dim=1).norm(dim=1)
+        assert torch.all(norm <= 0.5 + 1e-4)
+        assert torch.all(adv_inputs >= attacker.min - 1e-6)
+        assert torch.all(adv_inputs <= attacker.max + 1e-6)
+
+
+def test_cw_margin_loss():
+    y_hat = torch.tensor([[3., 1., 0.], [0., 2., 5.]])
+    labels = torch.tensor([0, 1])
+    loss = CWMarginLoss(reduction="none")(y_hat, labels)
+    assert torch.allclose(loss, torch.tensor([-2., 3.]))
+    assert torch.allclose(CWMarginLoss(kappa=1.)(y_hat, labels), torch.tensor(-0.5))
+
+    model = make_model()
+    inputs, labels = make_batch()
+    attacker = LinfPGDAttack(model, num_steps=3, dataset_name="cifar10", device=DEVICE, loss_function=CWMarginLoss())
+    check_perturbation(attacker, inputs, attacker.calc_perturbation(inputs, labels))
@@ -0,0 +1,35 @@
+import copy
+
+import torch
+
+from src.networks import (make_blocks, resnet18, wrn28_4, fold_bn, LowRankConv2d, add_conv_adapters,
+                          merge_conv_adapters, merge_adapter_state_dict)
+
+
+def test_adapters_start_from_conv_and_merge_into_plain_model():
+    torch.manual_seed(0)
+    inputs = torch.rand(4, 3, 32, 32)
+    for factory in (resnet18, wrn28_4):
+        model = factory(num_classes=10).eval()
+        with torch.no_grad():
+            outputs = model(inputs)
+
+        blocks = make_blocks(model)
+        adapters = add_conv_adapters(getattr(blocks, f"block{blocks.get_total_blocks() - 2}"), rank=2)
+        assert adapters and all(isinstance(adapter, LowRankConv2d) for adapter in adapters)
+        assert all(not adapter.weight.requires_grad and adapter.lora_up.requires_grad for adapter in adapters)
+        with torch.no_grad():
+            assert torch.allclose(model(inputs), outputs)
+            for adapter in adapters:
+                adapter.lora_up.normal_()
+            adapted_outputs = model(inputs)
+        assert not torch.allclose(adapted_outputs, outputs)
+
+        plain_model = factory(num_classes=10).eval()
+        plain_model.load_state_dict(merge_adapter_state_dict(model.state_dict()))
+        merged_model = copy.deepcopy(model)
+        merge_conv_adapters(merged_model)
+        with torch.no_grad():
+            assert torch.allclose(plain_model(inputs), adapted_outputs, atol=1e-4)
+            assert torch.allclose(merged_model(inputs), adapted_outputs, atol=1e-4)
+            assert torch.allclose(fold_bn(model)(inputs), adapted_outputs, atol=1e-4)
@@ -0,0 +1,42 @@
+import torch
+
+from src.networks import make_blocks, resnet18, wrn28_4
+
+
+def run_step(model, inputs):
+    features = []
+    blocks = make_blocks(model)
+    # hook input of a block inside a checkpointed stack
+    block = getattr(blocks, f"block{blocks.get_total_blocks() - 3}")
+    handle = block.register_forward_hook(lambda module, inputs, outputs: features.append(inputs[0]))
+    model.train()
+    # frozen BN layers keep their statistics in eval mode
+    for module in model.modules():
+        if isinstance(module, torch.nn.BatchNorm2d):
+            module.eval()
+    outputs = model(inputs)
+    loss = outputs.sum() + features[0].norm()
+    loss.backward()
+    handle.remove()
+    return features
+
+
+def test_checkpoint_segments_keep_gradients_and_frozen_bn():
+    torch.manual_seed(0)
+    inputs = torch.rand(4, 3, 32, 32)
+    for factory in (resnet18, wrn28_4):
+        model = factory(num_classes=10)
+        checkpoint_model = factory(num_classes=10, checkpoint_segments=2)
+        checkpoint_model.load_state_dict(model.state_dict())
+        state_dict = {name: buffer.clone() for name, buffer in model.state_dict().items()}
+
+        features = run_step(model, inputs)
+        checkpoint_features = run_step(checkpoint_model, inputs)
+
+        # features of forward are the same, recomputation in backward calls the hook again
+        assert len(features) == 1 and len(checkpoint_features) >= 1
+        assert torch.allclose(features[0], checkpoint_features[0])
+        for p, checkpoint_p in zip(model.parameters(), checkpoint_model.parameters()):
+            assert torch.allclose(p.grad, checkpoint_p.grad, atol=1e-5)
+        for name, buffer in checkpoint_model.state_dict().items():
+            assert torch.equal(buffer, state_dict[name]), name
@@ -0,0 +1,28 @@
+import functools
+
+import torch
+
+from src.networks import fold_bn, resnet18, wrn28_4, parseval_resnet18, parseval_retrain_wrn28_4
+
+
+def test_folded_model_gives_outputs_of_model_in_eval_mode():
+    torch.manual_seed(0)
+    inputs = torch.rand(4, 3, 32, 32)
+    for factory in (resnet18, wrn28_4, functools.partial(parseval_resnet18, k=3),
+                    functools.partial(parseval_retrain_wrn28_4, k=3)):
+        model = factory(num_classes=10)
+        # update running statistics, and keep a graph in `_feature_representations` of wrn
+        model(torch.rand(8, 3, 32, 32)).sum().backward()
+        model.train()
+
+        folded = fold_bn(model)
+        model.eval()
+        with torch.no_grad():
+            outputs = model(inputs)
+            folded_outputs = folded(inputs)
+
+        assert torch.allclose(outputs, folded_outputs, atol=1e-4)
+        num_bn = sum(isinstance(m, torch.nn.BatchNorm2d) for m in model.modules())
+        # `bn1` of pre-activation wrn blocks and the last BN of wrn are kept
+        assert sum(isinstance(m, torch.nn.BatchNorm2d) for m in folded.modules()) <= num_bn // 2 + 1
+        assert not any(p.requires_grad for p in folded.parameters())
@@ -72,3 +72,16 @@ def test_resnet_make_blocks():
         assert isinstance(blocks.get_block(i), parseval_resnet.ParsevalBasicBlock)
     for i in range(1, 7):
         assert isinstance(blocks.get_block(i), resnet.BasicBlock)
+
+
+def test_forward_prefix_and_suffix():
+    inputs = torch.rand(2, 3, 32, 32)
+    for model in [WideResNet(16, num_classes=10, widen_factor=2), resnet18(num_classes=10),
+                  parseval_resnet18(k=3, num_classes=10)]:
+        model.eval()
+        blocks = make_blocks(model)
+        with torch.no_grad():
+            outputs = model(inputs)
+            for i in range(1, blocks.get_total_blocks() + 1):
+                h = blocks.forward_prefix(inputs, upto=i)
+                assert torch.allclose(blocks.forward_suffix(h, from_=i), outputs, atol=1e-5)
@@ -0,0 +1,46 @@
+import os
+import tempfile
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from src import settings
+from src.attack import LinfPGDAttack
+from src.networks import resnet18
+from src.trainer import ADVTrainer
+
+
+def test_evaluates_every_eval_every_epochs():
+    saved_settings = {name: getattr(settings, name) for name in
+                      ("train_epochs", "warm_up_epochs", "eval_every", "tensorboard_log_dir")}
+    settings.train_epochs = 3
+    settings.warm_up_epochs = 1
+    settings.eval_every = 2
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            settings.tensorboard_log_dir = settings.root_dir / tmp_dir
+            torch.manual_seed(0)
+            loader = DataLoader(TensorDataset(torch.rand(4, 3, 32, 32), torch.randint(10, (4,))), batch_size=2)
+            trainer = ADVTrainer(
+                model=resnet18(num_classes=10),
+                train_loader=loader,
+                test_loader=loader,
+                attacker=LinfPGDAttack,
+                params={"epsilon": 8 / 255, "num_steps": 1, "dataset_name": "cifar10", "device": "cpu"},
+                checkpoint_path=os.path.join(tmp_dir, "adv.pth")
+            )
+            evaluated_epochs = []
+            record_test_accuracy = trainer._record_test_accuracy
+
+            def record(save_path, ep, *args):
+                evaluated_epochs.append(ep)
+                return record_test_accuracy(save_path, ep, *args)
+
+            trainer._record_test_accuracy = record
+            trainer.train(os.path.join(tmp_dir, "adv"))
+    finally:
+        for name, value in saved_settings.items():
+            setattr(settings, name, value)
+
+    # epoch 2 by `eval_every`, epoch 3 as the last one
+    assert evaluated_epochs == [2, 3]
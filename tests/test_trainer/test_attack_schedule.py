@@ -0,0 +1,76 @@
+import os
+import tempfile
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from src.attack import LinfPGDAttack
+from src.networks import resnet18
+from src.trainer import LinearRampSchedule, PlateauSchedule, ADVTrainer
+from src.utils import get_checkpoint_writer
+
+
+def make_attacker():
+    return LinfPGDAttack(resnet18(num_classes=10), num_steps=7, dataset_name="cifar10", device="cpu")
+
+
+def test_linear_ramp_schedule():
+    attacker = make_attacker()
+    base_step_size = attacker.step_size.clone()
+    schedule = LinearRampSchedule(start_steps=2, end_steps=7, ramp_epochs=6)
+
+    steps = []
+    for ep in range(1, 9):
+        schedule(attacker, ep)
+        steps.append(attacker.num_steps)
+        # total length of steps is kept
+        assert torch.allclose(attacker.step_size * attacker.num_steps, base_step_size * 7)
+
+    assert steps == [2, 3, 4, 5, 6, 7, 7, 7]
+
+
+def test_plateau_schedule():
+    attacker = make_attacker()
+    schedule = PlateauSchedule(start_steps=2, end_steps=4, patience=2)
+
+    steps = []
+    for ep, loss in enumerate([None, 2., 1., 1., 1., 1., 1., 1., 1.], start=1):
+        schedule(attacker, ep, loss)
+        steps.append(attacker.num_steps)
+
+    assert steps == [2, 2, 2, 2, 3, 3, 3, 4, 4]
+
+
+def make_trainer(checkpoint_path):
+    loader = DataLoader(TensorDataset(torch.rand(4, 3, 32, 32), torch.randint(10, (4,))), batch_size=2)
+    return ADVTrainer(
+        model=resnet18(num_classes=10),
+        train_loader=loader,
+        test_loader=loader,
+        attacker=LinfPGDAttack,
+        params={"num_steps": 4, "dataset_name": "cifar10", "device": "cpu"},
+        checkpoint_path=checkpoint_path,
+        attack_schedule=PlateauSchedule(start_steps=2, end_steps=4, patience=2)
+    )
+
+
+def test_resumed_trainer_continues_schedule():
+    losses = [None, 2., 1., 1., 1., 1., 1., 1., 1.]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_path = os.path.join(tmp_dir, "adv.pth")
+        trainer = make_trainer(checkpoint_path)
+        for ep, loss in enumerate(losses[:5], start=1):
+            trainer.attack_schedule(trainer.attacker, ep, loss)
+        trainer._last_loss = losses[5]
+        trainer._save_checkpoint(5, 0.)
+        get_checkpoint_writer().wait()
+
+        resumed = make_trainer(checkpoint_path)
+
+    assert resumed.start_epoch == 6 and resumed._last_loss == losses[5]
+    steps = []
+    for ep, loss in enumerate(losses[5:], start=6):
+        resumed.attack_schedule(resumed.attacker, ep, loss)
+        steps.append(resumed.attacker.num_steps)
+    # steps of epochs 6 to 9 of an uninterrupted schedule, see `test_plateau_schedule`
+    assert steps == [3, 3, 4, 4]
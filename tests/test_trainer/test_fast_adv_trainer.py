@@ -0,0 +1,56 @@
+import os
+import tempfile
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from src.attack import LinfFGSMAttack, LinfPGDAttack
+from src.networks import resnet18
+from src.trainer import FastADVTrainer
+from src.utils import get_checkpoint_writer
+
+
+def make_trainer(checkpoint_path):
+    torch.manual_seed(0)
+    train_loader = DataLoader(TensorDataset(torch.rand(16, 3, 32, 32), torch.randint(10, (16,))), batch_size=4)
+    test_loader = DataLoader(TensorDataset(torch.rand(8, 3, 32, 32), torch.randint(10, (8,))), batch_size=4)
+    return FastADVTrainer(
+        model=resnet18(num_classes=10),
+        train_loader=train_loader,
+        test_loader=test_loader,
+        attacker=LinfFGSMAttack,
+        params={"epsilon": 8 / 255, "step_size": 10 / 255, "dataset_name": "cifar10", "device": "cpu"},
+        pgd_params={"random_init": 1, "epsilon": 8 / 255, "step_size": 2 / 255, "num_steps": 2,
+                    "dataset_name": "cifar10", "device": "cpu"},
+        check_batches=1,
+        check_steps=2,
+        checkpoint_path=checkpoint_path
+    )
+
+
+def test_check_uses_held_out_train_slice():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        trainer = make_trainer(os.path.join(tmp_dir, "fast.pth"))
+
+    train_indices = set(trainer._train_loader.dataset.indices)
+    check_indices = set(trainer._check_loader.dataset.indices)
+    assert len(check_indices) == 4 and len(train_indices) == 12
+    assert not train_indices & check_indices
+    assert 0. <= trainer._robustness_check() <= 1.
+
+
+def test_resumed_trainer_keeps_pgd_epochs():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_path = os.path.join(tmp_dir, "fast.pth")
+        trainer = make_trainer(checkpoint_path)
+        assert isinstance(trainer.attacker, LinfFGSMAttack)
+        trainer._remaining_pgd_epochs = 1
+        trainer._best_check_acc = 0.5
+        trainer._save_checkpoint(1, 0.)
+        get_checkpoint_writer().wait()
+
+        resumed = make_trainer(checkpoint_path)
+
+    assert resumed.start_epoch == 2
+    assert resumed._remaining_pgd_epochs == 1 and resumed._best_check_acc == 0.5
+    assert isinstance(resumed.attacker, LinfPGDAttack)
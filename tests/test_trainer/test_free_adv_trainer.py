@@ -0,0 +1,42 @@
+import os
+import tempfile
+
+import pytest
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from src import settings
+from src.attack import LinfPGDAttack
+from src.networks import resnet18
+from src.trainer import FreeADVTrainer
+
+
+def test_warm_up_is_counted_in_replayed_passes():
+    saved_settings = {name: getattr(settings, name) for name in
+                      ("train_epochs", "warm_up_epochs", "start_lr", "tensorboard_log_dir")}
+    settings.train_epochs = 4
+    settings.warm_up_epochs = 1
+    settings.start_lr = 0.01
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            settings.tensorboard_log_dir = settings.root_dir / tmp_dir
+            torch.manual_seed(0)
+            loader = DataLoader(TensorDataset(torch.rand(8, 3, 32, 32), torch.randint(10, (8,))), batch_size=2)
+            trainer = FreeADVTrainer(
+                model=resnet18(num_classes=10),
+                train_loader=loader,
+                test_loader=loader,
+                attacker=LinfPGDAttack,
+                params={"epsilon": 8 / 255, "dataset_name": "cifar10", "device": "cpu"},
+                replay_times=4,
+                checkpoint_path=os.path.join(tmp_dir, "free.pth")
+            )
+            lrs = []
+            trainer.optimizer.register_step_pre_hook(lambda optimizer, args, kwargs: lrs.append(trainer.current_lr))
+            trainer.train(os.path.join(tmp_dir, "free"))
+    finally:
+        for name, value in saved_settings.items():
+            setattr(settings, name, value)
+
+    # one epoch of 4 batches replayed 4 times, warm-up lasts one replayed pass(4 replays)
+    assert lrs == pytest.approx([0., 0.0025, 0.005, 0.0075] + [0.01] * 12)
@@ -0,0 +1,97 @@
+import os
+import tempfile
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from src import settings
+from src.attack import LinfPGDAttack
+from src.networks import resnet18
+from src.trainer import NormalTrainer, RobustPlusSingularRegularizationTrainer
+
+
+def make_trainer():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(3 * 4 * 4, 10))
+    dataset = TensorDataset(torch.rand(10, 3, 4, 4), torch.randint(10, (10,)))
+    loader = DataLoader(dataset, batch_size=10)
+    return NormalTrainer(model=model, train_loader=loader, test_loader=loader), dataset.tensors
+
+
+def accumulated_gradients(micro_batch_size):
+    settings.micro_batch_size = micro_batch_size
+    trainer, (inputs, labels) = make_trainer()
+    gradients = []
+    trainer.optimizer.register_step_pre_hook(
+        lambda optimizer, args, kwargs: gradients.extend(p.grad.clone() for p in trainer.model.parameters()))
+    loss, acc = trainer._accumulate_step_batch(trainer.step_batch, inputs, labels)
+    return gradients, loss, acc
+
+
+def test_micro_batches_give_gradients_of_whole_batch():
+    micro_batch_size = settings.micro_batch_size
+    try:
+        full_gradients, full_loss, full_acc = accumulated_gradients(None)
+        # 4 + 4 + 2 samples, the last micro-batch is smaller
+        gradients, loss, acc = accumulated_gradients(4)
+    finally:
+        settings.micro_batch_size = micro_batch_size
+
+    for full_gradient, gradient in zip(full_gradients, gradients):
+        assert torch.allclose(full_gradient, gradient, atol=1e-6)
+    assert torch.allclose(full_loss, loss, atol=1e-6)
+    assert torch.allclose(full_acc, acc)
+
+
+def test_robust_accuracy_is_weighted_by_micro_batch_size():
+    saved_settings = {name: getattr(settings, name) for name in ("micro_batch_size", "tensorboard_log_dir")}
+    settings.micro_batch_size = 4
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            settings.tensorboard_log_dir = settings.root_dir / tmp_dir
+            torch.manual_seed(0)
+            dataset = TensorDataset(torch.rand(10, 3, 32, 32), torch.randint(10, (10,)))
+            trainer = RobustPlusSingularRegularizationTrainer(
+                k=2, _lambda=0.1, model=resnet18(num_classes=10),
+                train_loader=DataLoader(dataset, batch_size=10), test_loader=DataLoader(dataset, batch_size=10),
+                attacker=LinfPGDAttack, params={"num_steps": 1, "dataset_name": "cifar10", "device": "cpu"},
+                checkpoint_path=os.path.join(tmp_dir, "singular.pth")
+            )
+            micro_results = []
+
+            def step_batch(inputs, labels):
+                results = trainer.step_batch(inputs, labels)
+                micro_results.append((labels.shape[0], results[-1]))
+                return results
+
+            robust_acc = trainer._accumulate_step_batch(step_batch, *dataset.tensors)[-1]
+    finally:
+        for name, value in saved_settings.items():
+            setattr(settings, name, value)
+
+    # 4 + 4 + 2 samples, the last micro-batch is smaller
+    assert [size for size, _ in micro_results] == [4, 4, 2]
+    assert torch.allclose(robust_acc, sum(size * acc for size, acc in micro_results) / 10)
+
+
+def test_failed_micro_batch_leaves_optimizer_stepping():
+    micro_batch_size = settings.micro_batch_size
+    settings.micro_batch_size = 4
+    try:
+        trainer, (inputs, labels) = make_trainer()
+
+        def step_batch(*args):
+            raise RuntimeError("out of memory")
+
+        try:
+            trainer._accumulate_step_batch(step_batch, inputs, labels)
+        except RuntimeError:
+            pass
+        # steps outside of accumulation are not skipped
+        steps = []
+        trainer.optimizer.register_step_pre_hook(lambda optimizer, args, kwargs: steps.append(optimizer))
+        trainer.step_batch(inputs, labels)
+    finally:
+        settings.micro_batch_size = micro_batch_size
+
+    assert steps == [trainer.optimizer]
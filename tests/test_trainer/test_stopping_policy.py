@@ -0,0 +1,38 @@
+from src.trainer import PlateauStopping
+
+
+def run(policy, accuracies):
+    epochs = []
+    for ep, acc in enumerate(accuracies, start=1):
+        if policy.finished(ep):
+            break
+        epochs.append(policy.lr_epoch(ep))
+        policy.update(ep, acc)
+    return epochs
+
+
+def test_plateau_skips_milestones_then_stops():
+    policy = PlateauStopping(patience=2, milestones=[4, 8], train_epochs=10)
+    # no improvement after epoch 1: skip to 4, then to 8, then stop
+    epochs = run(policy, [0.5] * 10)
+
+    assert epochs == [1, 2, 3, 5, 6, 9, 10]
+    assert policy.finished(8)
+
+
+def test_plateau_stops_without_skipping():
+    policy = PlateauStopping(patience=2, milestones=[4, 8], train_epochs=10, skip_milestones=False)
+    epochs = run(policy, [0.1, 0.2, 0.3, 0.3, 0.3, 0.4])
+
+    assert epochs == [1, 2, 3, 4, 5]
+
+
+def test_disabled_policy_and_state_dict():
+    policy = PlateauStopping(patience=None, milestones=[4, 8], train_epochs=10)
+    assert run(policy, [0.5] * 10) == list(range(1, 11))
+
+    policy = PlateauStopping(patience=1, milestones=[4, 8], train_epochs=10)
+    run(policy, [0.5, 0.5])
+    resumed = PlateauStopping(patience=1, milestones=[4, 8], train_epochs=10)
+    resumed.load_state_dict(policy.state_dict())
+    assert resumed.lr_epoch(3) == policy.lr_epoch(3) == 5
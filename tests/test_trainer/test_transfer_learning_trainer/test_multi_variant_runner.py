@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from src import settings
+from src.networks import parseval_resnet18
+from src.trainer import ParsevalTransferLearningTrainer, MultiVariantTLRunner
+
+BETAS = (0.1, 0.5)
+
+
+def make_trainer(tmp_dir, loader, beta, name):
+    torch.manual_seed(1)
+    return ParsevalTransferLearningTrainer(
+        beta=beta,
+        k=3,
+        teacher_model_path=os.path.join(tmp_dir, "teacher"),
+        model=parseval_resnet18(k=3, num_classes=10),
+        train_loader=loader,
+        test_loader=loader,
+        checkpoint_path=os.path.join(tmp_dir, f"{name}.pth")
+    )
+
+
+def test_variants_train_as_if_separately():
+    saved_settings = {name: getattr(settings, name) for name in
+                      ("train_epochs", "start_lr", "delta_checkpoint", "tensorboard_log_dir")}
+    settings.train_epochs = 1
+    settings.start_lr = 0.01
+    settings.delta_checkpoint = False
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            settings.tensorboard_log_dir = settings.root_dir / tmp_dir
+            torch.manual_seed(0)
+            torch.save(parseval_resnet18(k=3, num_classes=10).state_dict(), os.path.join(tmp_dir, "teacher"))
+            dataset = TensorDataset(torch.rand(8, 3, 32, 32), torch.randint(10, (8,)))
+            loader = DataLoader(dataset, batch_size=4)
+
+            for i, beta in enumerate(BETAS):
+                make_trainer(tmp_dir, loader, beta, f"separate{i}").train(os.path.join(tmp_dir, f"separate{i}"))
+
+            variants = [make_trainer(tmp_dir, loader, beta, f"variant{i}") for i, beta in enumerate(BETAS)]
+            MultiVariantTLRunner(variants).train([os.path.join(tmp_dir, f"variant{i}") for i in range(len(BETAS))])
+
+            for i in range(len(BETAS)):
+                assert os.path.exists(os.path.join(tmp_dir, f"variant{i}.pth"))
+                separate = torch.load(os.path.join(tmp_dir, f"separate{i}-last"))
+                variant = torch.load(os.path.join(tmp_dir, f"variant{i}-last"))
+                for name, tensor in separate.items():
+                    assert torch.allclose(tensor.float(), variant[name].float(), atol=1e-6)
+    finally:
+        for name, value in saved_settings.items():
+            setattr(settings, name, value)
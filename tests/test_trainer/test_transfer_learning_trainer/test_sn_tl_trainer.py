@@ -0,0 +1,100 @@
+import json
+import os
+import tempfile
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from torchvision import transforms
+
+from src import settings
+from src.networks import resnet18, make_blocks
+from src.trainer import SpectralNormTransferLearningTrainer
+from src.trainer.transfer_learning_trainer.mixins import dataset_cache_key
+from src.utils import FeatureDataset
+
+
+def make_trainer(tmp_dir, loader, seed):
+    torch.manual_seed(seed)
+    return SpectralNormTransferLearningTrainer(
+        k=3,
+        teacher_model_path=os.path.join(tmp_dir, "teacher"),
+        model=resnet18(num_classes=10),
+        train_loader=loader,
+        test_loader=loader,
+        checkpoint_path=os.path.join(tmp_dir, "sntl.pth")
+    )
+
+
+def test_resumed_trainer_folds_frozen_blocks_of_checkpoint():
+    saved_settings = {name: getattr(settings, name) for name in
+                      ("train_epochs", "start_lr", "fold_frozen_bn", "tensorboard_log_dir")}
+    settings.train_epochs = 1
+    settings.start_lr = 0.01
+    settings.fold_frozen_bn = True
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            settings.tensorboard_log_dir = settings.root_dir / tmp_dir
+            torch.manual_seed(0)
+            torch.save(resnet18(num_classes=10).state_dict(), os.path.join(tmp_dir, "teacher"))
+            dataset = TensorDataset(torch.rand(8, 3, 32, 32), torch.randint(10, (8,)))
+            loader = DataLoader(dataset, batch_size=4)
+
+            trainer = make_trainer(tmp_dir, loader, seed=1)
+            trainer.train(os.path.join(tmp_dir, "sntl"))
+            # model of resumed trainer is initialized differently before checkpoint is loaded
+            resumed = make_trainer(tmp_dir, loader, seed=2)
+            assert resumed.start_epoch == 2
+
+            inputs = torch.rand(4, 3, 32, 32)
+            assert torch.allclose(resumed._forward_prefix(inputs), trainer._forward_prefix(inputs), atol=1e-5)
+    finally:
+        for name, value in saved_settings.items():
+            setattr(settings, name, value)
+
+
+def test_resumed_trainer_caches_features_of_teacher_model():
+    saved_settings = {name: getattr(settings, name) for name in
+                      ("train_epochs", "start_lr", "feature_cache", "feature_cache_dir", "feature_cache_half",
+                       "tensorboard_log_dir")}
+    settings.train_epochs = 1
+    settings.start_lr = 0.01
+    settings.feature_cache_half = False
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            settings.tensorboard_log_dir = settings.root_dir / tmp_dir
+            settings.feature_cache_dir = settings.root_dir / tmp_dir / "features"
+            torch.manual_seed(0)
+            teacher = resnet18(num_classes=10).eval()
+            torch.save(teacher.state_dict(), os.path.join(tmp_dir, "teacher"))
+            dataset = TensorDataset(torch.rand(8, 3, 32, 32), torch.randint(10, (8,)))
+            loader = DataLoader(dataset, batch_size=4)
+            make_trainer(tmp_dir, loader, seed=1).train(os.path.join(tmp_dir, "sntl"))
+
+            # no store exists yet, it is built before the checkpoint is loaded
+            settings.feature_cache = True
+            resumed = make_trainer(tmp_dir, loader, seed=2)
+            features = resumed._train_loader.dataset
+            assert isinstance(features, FeatureDataset)
+            with torch.no_grad():
+                expected = make_blocks(teacher).forward_prefix(dataset.tensors[0],
+                                                               upto=resumed._first_trainable_block)
+            for i in range(len(dataset)):
+                assert torch.allclose(features[i][0], expected[i], atol=1e-5)
+    finally:
+        for name, value in saved_settings.items():
+            setattr(settings, name, value)
+
+
+def test_feature_cache_key_depends_on_split_and_transform():
+    class ImageDataset(TensorDataset):
+        def __init__(self, train, transform):
+            super().__init__(torch.rand(4, 3, 32, 32), torch.randint(10, (4,)))
+            self.train = train
+            self.transform = transform
+
+    normalize = transforms.Normalize((0.5, 0.5, 0.5), (0.2, 0.2, 0.2))
+    keys = [dataset_cache_key(ImageDataset(train=True, transform=normalize)),
+            dataset_cache_key(ImageDataset(train=False, transform=normalize)),
+            dataset_cache_key(ImageDataset(train=True, transform=transforms.Normalize((0.5,) * 3, (0.25,) * 3)))]
+    assert len({json.dumps(key, sort_keys=True) for key in keys}) == 3
+    assert keys[0] == dataset_cache_key(ImageDataset(train=True, transform=normalize))
@@ -0,0 +1,39 @@
+import os
+import tempfile
+
+import torch
+
+from src.utils import CheckpointWriter
+
+
+def test_checkpoint_writer_snapshots_state():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "checkpoint.pth")
+        writer = CheckpointWriter(max_pending=1)
+
+        weights = torch.zeros(4)
+        for epoch in range(3):
+            weights += 1
+            writer.save({"model_weights": {"w": weights}, "current_epoch": epoch}, path)
+        # state is snapshotted when `save` returns, later updates are not written
+        weights += 100
+        writer.wait()
+
+        checkpoint = torch.load(path)
+        assert checkpoint["current_epoch"] == 2
+        assert torch.equal(checkpoint["model_weights"]["w"], torch.full((4,), 3.))
+        assert not os.path.exists(f"{path}.tmp")
+
+
+def test_checkpoint_writer_reports_errors():
+    def failed_save(obj, path):
+        raise IOError("disk is full")
+
+    writer = CheckpointWriter()
+    writer.save({}, "unused.pth", failed_save)
+    try:
+        writer.wait()
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("error of background write is not raised")
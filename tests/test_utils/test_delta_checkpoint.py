@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+import torch
+
+from src.utils import make_delta_state_dict, load_model_state_dict, file_digest
+
+
+def test_delta_state_dict_rebuilds_model():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        teacher_path = os.path.join(tmp_dir, "teacher")
+        teacher = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.BatchNorm1d(4), torch.nn.Linear(4, 2))
+        torch.save(teacher.state_dict(), teacher_path)
+
+        student = torch.nn.Sequential(torch.nn.Linear(4, 4), torch.nn.BatchNorm1d(4), torch.nn.Linear(4, 2))
+        student.load_state_dict(teacher.state_dict())
+        torch.nn.init.zeros_(student[2].weight)
+
+        delta = make_delta_state_dict(student.state_dict(), teacher.state_dict(),
+                                      teacher_path, file_digest(teacher_path))
+        assert list(delta["changed"].keys()) == ["2.weight"]
+
+        student_path = os.path.join(tmp_dir, "student")
+        torch.save(delta, student_path)
+        state_dict = load_model_state_dict(student_path)
+        assert list(state_dict.keys()) == list(student.state_dict().keys())
+        assert state_dict._metadata == student.state_dict()._metadata
+        for key, value in student.state_dict().items():
+            assert torch.equal(state_dict[key], value)
+
+        # rebuilding from a modified teacher must fail
+        torch.save(student.state_dict(), teacher_path)
+        try:
+            load_model_state_dict(student_path)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("changed teacher is not detected")
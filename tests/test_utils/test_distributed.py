@@ -0,0 +1,82 @@
+import copy
+import os
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, TensorDataset
+
+
+def _make_batch(rank):
+    torch.manual_seed(rank)
+    return torch.rand(10, 3, 4, 4), torch.randint(10, (10,))
+
+
+def _run(rank, init_file):
+    dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=2)
+    from src import settings
+    from src.trainer import NormalTrainer
+    from src.utils import MetricsAccumulator
+
+    # ranks start from different weights, those of rank 0 are copied when the model is distributed
+    torch.manual_seed(rank)
+    model = torch.nn.Sequential(torch.nn.Flatten(), torch.nn.Linear(3 * 4 * 4, 10))
+    loader = DataLoader(TensorDataset(*_make_batch(rank)), batch_size=10)
+    trainer = NormalTrainer(model=model, train_loader=loader, test_loader=loader)
+    reference = copy.deepcopy(trainer._distributed_model().module.module)
+
+    gradients = []
+    trainer.optimizer.register_step_pre_hook(
+        lambda optimizer, args, kwargs: gradients.extend(p.grad.clone() for p in model.parameters()))
+    # 4 + 4 + 2 samples, gradients are averaged over ranks in the last micro-batch only
+    settings.micro_batch_size = 4
+    trainer._accumulate_step_batch(trainer.step_batch, *_make_batch(rank))
+
+    # gradients of the whole batches of both ranks
+    reference_gradients = [torch.zeros_like(p) for p in reference.parameters()]
+    for batch_rank in range(2):
+        reference.zero_grad()
+        inputs, labels = _make_batch(batch_rank)
+        torch.nn.functional.cross_entropy(reference(inputs), labels).backward()
+        for reference_gradient, p in zip(reference_gradients, reference.parameters()):
+            reference_gradient += p.grad / 2
+    for gradient, reference_gradient in zip(gradients, reference_gradients):
+        assert torch.allclose(gradient, reference_gradient, atol=1e-6)
+
+    metrics = MetricsAccumulator()
+    metrics.update(loss=torch.tensor(float(rank)), items=2)
+    assert metrics.totals() == {"loss": 1., "items": 4.}
+    assert metrics.averages() == {"loss": 0.5, "items": 2.}
+    dist.destroy_process_group()
+
+
+def test_gradients_and_metrics_are_reduced_over_ranks():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mp.spawn(_run, args=(os.path.join(tmp_dir, "init"),), nprocs=2)
+
+
+def _run_perturbation_store(rank, tmp_dir):
+    dist.init_process_group("gloo", init_method=f"file://{os.path.join(tmp_dir, 'init')}", rank=rank, world_size=2)
+    from src.utils import PerturbationStore, get_checkpoint_writer
+
+    store = PerturbationStore(5, (2,))
+    # sample 2 is in both shards, e.g. padding of the shorter shard
+    indices = torch.tensor([0, 2, 4]) if rank == 0 else torch.tensor([1, 2, 3])
+    store.set(indices, torch.full((3, 2), float(rank + 1)))
+    store.save(os.path.join(tmp_dir, "delta"))
+    get_checkpoint_writer().wait()
+
+    expected = torch.tensor([1., 2., 1.5, 2., 1.]).view(-1, 1).expand(5, 2)
+    delta, initialized = store.get(torch.arange(5), torch.device("cpu"))
+    assert initialized.all() and torch.equal(delta, expected)
+    dist.barrier()
+    if rank == 0:
+        saved = torch.load(os.path.join(tmp_dir, "delta"))
+        assert saved["initialized"].all() and torch.equal(saved["buffer"].float(), expected)
+    dist.destroy_process_group()
+
+
+def test_perturbation_store_saves_samples_of_all_ranks():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        mp.spawn(_run_perturbation_store, args=(tmp_dir,), nprocs=2)
@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+from torch.utils.data import TensorDataset
+
+from src.utils import build_feature_store, feature_store_exists, FeatureDataset
+
+
+def test_build_and_read_feature_store():
+    inputs, labels = torch.rand(10, 3, 4, 4), torch.randint(10, (10,))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "features")
+        assert not feature_store_exists(path)
+
+        build_feature_store(path, lambda x: x.mean(dim=1), TensorDataset(inputs, labels), views=2, batch_size=4)
+        assert feature_store_exists(path)
+        assert sorted(os.listdir(tmp_dir)) == ["features.npy", "features_labels.npy"]
+        assert np.load(f"{path}.npy", mmap_mode="r").dtype == np.float16
+
+        dataset = FeatureDataset(path)
+        assert len(dataset) == 10 and dataset.views == 2
+        for i in range(len(dataset)):
+            feature, label = dataset[i]
+            assert feature.dtype == torch.float32 and feature.shape == (4, 4)
+            assert torch.allclose(feature, inputs[i].mean(dim=0), atol=1e-3)
+            assert label == labels[i]
@@ -0,0 +1,26 @@
+import torch
+
+from src.utils import MetricsAccumulator
+
+
+def test_metrics_accumulator():
+    for sync_every in [None, 1, 2]:
+        metrics = MetricsAccumulator(sync_every=sync_every)
+        for i in range(1, 6):
+            metrics.update(loss=torch.tensor(float(i)), acc=i / 10, correct=torch.tensor(i))
+
+        assert metrics.totals() == {"loss": 15., "acc": 1.5, "correct": 15.}
+        averages = metrics.averages()
+        assert averages["loss"] == 3. and abs(averages["acc"] - 0.3) < 1e-9
+
+
+def test_metrics_accumulator_keeps_tensors_on_device():
+    metrics = MetricsAccumulator()
+    loss = torch.tensor(2., requires_grad=True) * 2
+    metrics.update(loss=loss)
+    metrics.update(loss=loss)
+
+    # nothing is copied to host before reading
+    assert isinstance(metrics._device_sums["loss"], torch.Tensor)
+    assert not metrics._device_sums["loss"].requires_grad
+    assert metrics.averages() == {"loss": 4.}
@@ -0,0 +1,34 @@
+import json
+import os
+import tempfile
+
+from src.utils import StepProfiler
+
+
+def test_step_profiler_counts_steps_and_phases():
+    profiler = StepProfiler("cpu", enabled=True)
+    for ep in range(1, 3):
+        for _ in profiler.iterate(range(3)):
+            with profiler.phase("forward"):
+                pass
+        epoch_times = profiler.end_epoch(ep)
+        assert set(epoch_times.keys()) == {"data", "forward"}
+
+    summary = profiler.summary()
+    assert summary["steps"] == 6
+    assert abs(sum(summary["fraction"].values()) - 1) < 1e-6
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "profile.json")
+        profiler.dump(path)
+        with open(path) as f:
+            assert json.load(f)["steps"] == 6
+
+
+def test_disabled_step_profiler_is_noop():
+    profiler = StepProfiler("cpu")
+    assert list(profiler.iterate(range(3))) == [0, 1, 2]
+    with profiler.phase("forward"):
+        pass
+    assert profiler.end_epoch(1) == {}
+    assert profiler.summary()["steps"] == 0